@@ -5,8 +5,23 @@ https://stackoverflow.com/questions/18551558/how-to-use-terminal-color-palette-w
 """
 
 import sys
+import gc
 import logging
 import re
+import queue
+import heapq
+import functools
+import threading
+import weakref
+import signal
+import asyncio
+import struct
+import mmap
+import xml.etree.ElementTree as ElementTree
+import multiprocessing
+import concurrent.futures
+from array import array
+from multiprocessing.shared_memory import SharedMemory
 from copy import deepcopy
 from time import time
 
@@ -15,6 +30,7 @@ os.environ.setdefault('ESCDELAY', '25')
 # ESC has a special delay to capture any valid escape sequence...
 KEY_ESC = 27
 KEY_CTRLW = 23
+KEY_CTRLF = 6
 # it also has a problem of confusing esc and alt...
 # esc = 27
 # alt A = 27 65 ...
@@ -111,15 +127,67 @@ xml_options = '''<?xml version="1.0"?>
 </data>
 '''
 
-from collections.abc import Mapping
+from collections.abc import Mapping, Sequence
+
+class MatchSpans:
+    '''MatchSpans()
+
+    The highlights of one query: the matched name span of a node,
+    and whether its value matched. The nodes do not keep them,
+    so a tree can be matched by several queries at once,
+    and there is nothing to clear after a query.
+    '''
+
+    def __init__(self):
+        self.names  = {} # node -> (start, end) of the matched name
+        self.values = set() # the nodes with the matched values
+
+    def __len__(self):
+        return len(self.names) + len(self.values)
+
+    def __repr__(self):
+        return f'MatchSpans({len(self.names)} names, {len(self.values)} values)'
+
+    def add_name(self, node, start, end):
+        assert start < end <= len(node.name)
+        self.names[node] = start, end
+
+    def add_value(self, node):
+        # TODO: value is not necessarily a string, what if it is a dictionary?
+        # let's just highlight all of it now
+        self.values.add(node)
+
+    def name_span(self, node):
+        return self.names.get(node, (0, 0))
+
+    def value_matched(self, node):
+        return node in self.values
 
 class OptNode:
-    def __init__(self, name, value=None, children=set(), parents=set(), logger=None):
+    # bumped on every change of the tree structure,
+    # the path tables check it to know when to rebuild
+    tree_version = 0
+    # bumped on every change of a node value,
+    # the cached matches of the value and type selectors check it
+    value_version = 0
+    # weak references to the objects that follow the value changes,
+    # with the method value_changed(node, old_value, new_value)
+    value_watchers = ()
+    # and the ones that follow the tree changes, with tree_changed()
+    tree_watchers = ()
+
+    # no __dict__ per node, there may be millions of them
+    __slots__ = ('name', '_value', 'children', 'parents', 'selected', '__weakref__')
+
+    def __init__(self, name, value=None, children=None, parents=None, logger=None):
         #super().__init__(*args) # not needed?
-        self.name = str(name) # TODO: not sure if name is always str
-        self.value = value
-        self.children = children
-        self.parents  = parents
+        # TODO: not sure if name is always str
+        # the same names repeat a lot in the trees, keep one copy of each
+        self.name = sys.intern(str(name))
+        self._value = value # a new node is not watched yet
+        # the default sets must not be shared between the nodes
+        self.children = children if children is not None else set()
+        self.parents  = parents  if parents  is not None else set()
         self.selected = False
 
         #
@@ -130,11 +198,75 @@ class OptNode:
             for item in set_param:
                 assert isinstance(item, OptNode)
 
-        self._highlight_name = 0, 0 # no highlight
-        self._highlight_value = False
-
     def __hash__(self):
-        return hash((self.name, self.value))
+        # the values change, the nodes stay the same in the sets
+        return id(self)
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, new_value):
+        old_value = self._value
+        self._value = new_value
+        self._value_changed(old_value, new_value)
+
+    def _value_changed(self, old_value, new_value):
+        OptNode.value_version += 1
+
+        for watcher_ref in OptNode.value_watchers:
+            watcher = watcher_ref()
+            if watcher is not None:
+                watcher.value_changed(self, old_value, new_value)
+
+    @classmethod
+    def watch_values(cls, watcher):
+        '''watch_values(cls, watcher)
+
+        Call `watcher.value_changed(node, old_value, new_value)` on every
+        value change, while the watcher is alive.
+        '''
+        # the tuple is replaced, not changed, so it is safe to iterate
+        cls.value_watchers = tuple(ref for ref in cls.value_watchers if ref() is not None) + (weakref.ref(watcher),)
+
+    @classmethod
+    def watch_tree(cls, watcher):
+        '''watch_tree(cls, watcher)
+
+        Call `watcher.tree_changed()` on every change of the tree structure,
+        while the watcher is alive. It may be called from the other threads.
+        '''
+        cls.tree_watchers = tuple(ref for ref in cls.tree_watchers if ref() is not None) + (weakref.ref(watcher),)
+
+    @classmethod
+    def unwatch_values(cls, watcher):
+        '''unwatch_values(cls, watcher)
+
+        Stop calling the `watcher` of `watch_values`.
+        '''
+        cls.value_watchers = tuple(ref for ref in cls.value_watchers if ref() not in (None, watcher))
+
+    @classmethod
+    def unwatch_tree(cls, watcher):
+        '''unwatch_tree(cls, watcher)
+
+        Stop calling the `watcher` of `watch_tree`.
+        '''
+        cls.tree_watchers = tuple(ref for ref in cls.tree_watchers if ref() not in (None, watcher))
+
+    @staticmethod
+    def _tree_changed():
+        OptNode.tree_version += 1
+
+        for watcher_ref in OptNode.tree_watchers:
+            watcher = watcher_ref()
+            if watcher is not None:
+                watcher.tree_changed()
+
+    # the lazy trees fetch the children of a node only when they are needed,
+    # see `expand_nodes`, the other nodes have all their children
+    expanded = True
 
     def __repr__(self):
         return f'OptNode({repr(self.name)}, {repr(self.value)}, {repr(self.children)})'
@@ -146,39 +278,45 @@ class OptNode:
         else:
             return f'{self.name}'
 
-    def highlight_name(self, start, end):
-        assert start < end <= len(self.name)
-        self._highlight_name = start, end
+    def add_child(self, child):
+        '''add_child(self, child)
 
-    def highlight_value(self, new_bool):
-        # TODO: value is not necessarily a string, what if it is a dictionary?
-        # let's just highlight all of it now
-        self._highlight_value = new_bool
+        Attach a child node. Use it instead of `children.add`,
+        so that the path tables see that the tree changed.
+        '''
+        assert isinstance(child, OptNode)
+        self.children.add(child)
+        child.parents.add(self)
+        OptNode._tree_changed()
 
-    def clear_highlights(self):
-        self._highlight_name = 0, 0
-        self._highlight_value = False
-        #self.selected = False
+    def new_child(self, name, value=None):
+        '''new_child(self, name, value=None)
 
-        for c in self.children:
-            c.clear_highlights()
+        Make a new node and attach it as a child. Returns the new node,
+        of the same kind as this one.
+        '''
+        child = OptNode(name, value)
+        self.add_child(child)
+        return child
 
-    def print_to_menu(self, cursor, styleMatchedText, styleNormalText, coord=None):
-        '''print_to_menu(self, cursor, coord=None)
+    def print_to_menu(self, cursor, styleMatchedText, styleNormalText, coord=None, spans=None):
+        '''print_to_menu(self, cursor, styleMatchedText, styleNormalText, coord=None, spans=None)
 
         prints it to curses, with necessary highlights
 
         cursor -- the curses cursor
         coord = (line_num, char_pos) -- optional setting for cursor position
+        spans -- optional `MatchSpans` of the query, with the highlights
         '''
 
         if coord is not None:
             line_num, char_pos = coord
             cursor.move(line_num, char_pos)
 
-        pre = self.name[:self._highlight_name[0]]
-        highlight = self.name[self._highlight_name[0]:self._highlight_name[1]]
-        post = self.name[self._highlight_name[1]:]
+        start, end = spans.name_span(self) if spans is not None else (0, 0)
+        pre = self.name[:start]
+        highlight = self.name[start:end]
+        post = self.name[end:]
 
         cursor.addstr(pre, styleNormalText)
         cursor.addstr(highlight, styleMatchedText)
@@ -189,7 +327,8 @@ class OptNode:
             # add =
             cursor.addstr('=', styleNormalText)
             # value
-            to_highlight = styleMatchedText if self._highlight_value else styleNormalText
+            value_matched = spans is not None and spans.value_matched(self)
+            to_highlight = styleMatchedText if value_matched else styleNormalText
             cursor.addstr(str(self.value), to_highlight)
 
     def opt_list(self, prefix_list=[]):
@@ -214,38 +353,51 @@ class OptNode:
         for opt in self.opt_list():
             print(delimeter.join(str(i) for i in opt))
 
-    def match_name(self, substr):
-        # TODO: just add full regexp
-        match_last = False
-        if substr[-1] == '$':
-            substr = substr[:-1]
-            match_last = True
-
-        if substr not in self.name:
+    def match_name(self, substr, spans=None, fuzzy=False):
+        # the /regex/ selectors are not fuzzy
+        if fuzzy and not _is_regex_selector(substr):
+            match = _fuzzy_name_match(self.name, substr)
+            if match is None:
+                return 0
+
+            score, start, end = match
+            if spans is not None and start < end:
+                spans.add_name(self, start, end)
+            # a matched name is always true, even with a poor score
+            return max(score, 1)
+
+        span = _name_match_span(self.name, substr)
+        if span is None:
             return False
 
-        match_ind = self.name.index(substr)
-
-        if substr in self.name and match_last and self.name[match_ind:] != substr:
-            return False
+        start, end = span
+        if spans is not None and start < end:
+            spans.add_name(self, start, end)
 
-        self.highlight_name(match_ind, match_ind+len(substr))
+        if fuzzy:
+            return FUZZY_SCORE_MATCH * max(end - start, 1)
         return True
 
-    def match_selector(self, selector):
-        '''match_selector(self, selector)
+    def match_selector(self, selector, spans=None, fuzzy=False):
+        '''match_selector(self, selector, spans=None, fuzzy=False)
 
         Returns True or False. Matches the basic selectors:
         = for value
         . for basic type
         the rest is name match
+        /regex/ for the name or, after =, the value
+
+        spans -- optional `MatchSpans` to record the highlights in
+        fuzzy -- match the names as fuzzy subsequences,
+                 then it returns the match score, 0 for no match
         '''
         assert len(selector) > 0
         if selector[0] in ('=', '.'):
             assert len(selector) > 1
 
-        if selector[0] == '=' and selector[1:] == str(self.value):
-            self.highlight_value(True)
+        if selector[0] == '=' and _value_match(str(self.value), selector[1:]):
+            if spans is not None:
+                spans.add_value(self)
             return True
 
         if selector[0] == '.':
@@ -255,15 +407,15 @@ class OptNode:
             type_matched |= selector[1:] == 'str' and type(self.value) == str
             return type_matched
 
-        return self.match_name(selector)
+        return self.match_name(selector, spans, fuzzy)
 
     def match_selectors(self, selectors, prev_nodes=[]):
         '''match_selectors(self, selectors, prev_nodes=[]):
 
         In general, matching returns an option list from the tree of OptNode-s.
         Therefore `match_selector` returns True or False whether this node
-        matched the selector, and sets the highlights in self node, and in the
-        child nodes if needed.
+        matched the selector. The highlights are not recorded here,
+        match the paths with `match_opts_table` to get them.
 
         Special selectors:
         = for value
@@ -325,94 +477,2192 @@ class OptNode:
         else:
             matched = matched_self = self.match_selector(sel)
 
-        next_selectors = selectors[1:] if matched else selectors
-        if len(next_selectors) == 0:
-            # done
-            for opt in self.opt_list():
-                yield prev_nodes + opt
+        next_selectors = selectors[1:] if matched else selectors
+        if len(next_selectors) == 0:
+            # done
+            for opt in self.opt_list():
+                yield prev_nodes + opt
+
+        elif matched and not matched_self:
+            # matched something in child nodes
+            # the matching process stays at this node
+            yield from self._match_selectors(next_selectors, prev_nodes)
+
+        else:
+            for c in self.children:
+                yield from c._match_selectors(next_selectors, prev_nodes + [self])
+
+class OptTreeStore:
+    '''OptTreeStore()
+
+    A compact tree of options, as columns instead of `OptNode` objects:
+    an interned name table, the parent, first child and next sibling
+    node ids, and the value column. A node is just its id in the columns.
+    The children of a node keep the order they were added in.
+
+    Use `node(node_id)` to get a `StoredOptNode` view of a node,
+    it works like `OptNode` for the matching and the menu.
+    It is a tree: a node has at most one parent.
+    The links change under `lock`, so another thread can patch the tree
+    while the menu reads it.
+
+    A lazy tree marks the nodes whose children are not fetched yet
+    in `unexpanded`, and its `expander(node_ids, prefetch)` fetches them,
+    see `expand`.
+    '''
+
+    def __init__(self):
+        self.names = [] # name id -> the name string
+        self._name_ids = {} # the name string -> name id
+        self.name_ids     = array('i') # node id -> name id
+        self.parents      = array('i') # node id -> parent node id, -1 for the roots
+        self.first_child  = array('i') # node id -> first child node id, or -1
+        self.next_sibling = array('i') # node id -> next sibling node id, or -1
+        self.last_child   = array('i') # node id -> last child node id, to append fast
+        self.values = [] # node id -> value
+        self.lock = threading.RLock()
+        self.unexpanded = set() # the node ids with the children not fetched yet
+        self.expander = None
+        self.dropped = set() # the roots of the dropped subtrees, see drop
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return f'OptTreeStore({len(self)} nodes, {len(self.names)} names)'
+
+    def _name_id(self, name):
+        name = str(name)
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        return name_id
+
+    def add(self, name, value=None, parent=-1):
+        '''add(self, name, value=None, parent=-1)
+
+        Adds a node, as the last child of the `parent` node id
+        or as a root. Returns the new node id.
+        '''
+        node_id = len(self.values)
+        self.name_ids.append(self._name_id(name))
+        self.values.append(value)
+        self.parents.append(-1)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.last_child.append(-1)
+
+        if parent >= 0:
+            self.attach(node_id, parent)
+
+        return node_id
+
+    def attach(self, node_id, parent):
+        '''attach(self, node_id, parent)
+
+        Makes the root `node_id` the last child of `parent`.
+        '''
+        with self.lock:
+            assert self.parents[node_id] < 0, f'node {node_id} already has a parent'
+            self.parents[node_id] = parent
+            last = self.last_child[parent]
+            if last < 0:
+                self.first_child[parent] = node_id
+            else:
+                self.next_sibling[last] = node_id
+            self.last_child[parent] = node_id
+            OptNode._tree_changed()
+
+    def expand(self, node_ids, prefetch=False):
+        '''expand(self, node_ids, prefetch=False)
+
+        Asks the `expander` to fetch the children of the unexpanded nodes
+        among `node_ids`, in the background. The prefetch requests
+        may be dropped, when the expander is busy.
+        '''
+        node_ids = [node_id for node_id in node_ids if node_id in self.unexpanded]
+        if node_ids and self.expander is not None:
+            self.expander(node_ids, prefetch)
+
+    def mark_expanded(self, node_id, unexpanded=()):
+        '''mark_expanded(self, node_id, unexpanded=())
+
+        The expander got the children of `node_id`: it is not marked anymore,
+        and the `unexpanded` new node ids are marked instead.
+        '''
+        with self.lock:
+            self.unexpanded.discard(node_id)
+            self.unexpanded.update(unexpanded)
+            # the marks change the matches of the query frontier
+            OptNode._tree_changed()
+
+    def set_children(self, node_id, child_ids):
+        '''set_children(self, node_id, child_ids)
+
+        Replaces the children of `node_id` with `child_ids`, in this order.
+        They are its current children or roots. The dropped children
+        get detached with their subtrees, they become roots.
+        '''
+        with self.lock:
+            for child in list(self.children_ids(node_id)):
+                self.parents[child] = -1
+                self.next_sibling[child] = -1
+            self.first_child[node_id] = self.last_child[node_id] = -1
+
+            for child in child_ids:
+                self.attach(child, node_id)
+            OptNode._tree_changed()
+
+    def drop(self, node_id):
+        '''drop(self, node_id)
+
+        Drops the detached subtree of the root `node_id` for good:
+        it is not in `roots` anymore, and its values are freed.
+        The node ids are not reused, the old views just read None values.
+        Returns the dropped node ids.
+        '''
+        with self.lock:
+            assert self.parents[node_id] < 0, f'node {node_id} is still attached'
+            dropped = []
+            stack = [node_id]
+            while stack:
+                i = stack.pop()
+                dropped.append(i)
+                self.values[i] = None
+                stack.extend(self.children_ids(i))
+
+            self.dropped.add(node_id)
+            self.unexpanded.difference_update(dropped)
+            return dropped
+
+    def add_tree(self, pydict, parent=-1):
+        '''add_tree(self, pydict, parent=-1)
+
+        Adds the nodes of a Python mapping, like `opt_tree` does.
+        Returns the list of the added top node ids.
+        '''
+        if isinstance(pydict, tuple):
+            node_name, node_val = pydict
+            return [self.add(node_name, node_val, parent)]
+
+        if not isinstance(pydict, Mapping):
+            # it is just one value
+            # we save it as the node name
+            return [self.add(pydict, None, parent)]
+
+        node_ids = []
+        for k, v in pydict.items():
+            if isinstance(k, tuple):
+                name, val = k
+                node_id = self.add(name, val, parent)
+                self.add_tree(v, node_id)
+
+            # leaf in the Python dict
+            elif not isinstance(v, Mapping):
+                node_id = self.add(k, v, parent)
+
+            else:
+                node_id = self.add(k, None, parent)
+                self.add_tree(v, node_id)
+
+            node_ids.append(node_id)
+
+        return node_ids
+
+    def children_ids(self, node_id):
+        child = self.first_child[node_id]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def node(self, node_id):
+        return StoredOptNode(self, node_id)
+
+    def roots(self):
+        return [self.node(i) for i, parent in enumerate(self.parents) if parent < 0 and i not in self.dropped]
+
+class StoredOptNode(OptNode):
+    '''StoredOptNode(store, node_id)
+
+    The `OptNode` view of a node in `OptTreeStore` or `MappedOptTree`. The views are made
+    on the fly, two views of the same node are equal.
+    The children and parents are tuples of views, not sets.
+    '''
+
+    __slots__ = ('store', 'node_id')
+
+    def __init__(self, store, node_id):
+        self.store = store
+        self.node_id = node_id
+
+    def __hash__(self):
+        return hash((id(self.store), self.node_id))
+
+    def __eq__(self, other):
+        if not isinstance(other, StoredOptNode):
+            return NotImplemented
+        return self.store is other.store and self.node_id == other.node_id
+
+    @property
+    def name(self):
+        return self.store.names[self.store.name_ids[self.node_id]]
+
+    @property
+    def value(self):
+        return self.store.values[self.node_id]
+
+    @value.setter
+    def value(self, new_value):
+        old_value = self.store.values[self.node_id]
+        self.store.values[self.node_id] = new_value
+        self._value_changed(old_value, new_value)
+
+    @property
+    def children(self):
+        with self.store.lock:
+            return tuple(StoredOptNode(self.store, i) for i in self.store.children_ids(self.node_id))
+
+    @property
+    def parents(self):
+        parent = self.store.parents[self.node_id]
+        return (StoredOptNode(self.store, parent),) if parent >= 0 else ()
+
+    @property
+    def selected(self):
+        return False
+
+    @property
+    def expanded(self):
+        return self.node_id not in self.store.unexpanded
+
+    def add_child(self, child):
+        assert isinstance(child, StoredOptNode) and child.store is self.store
+        self.store.attach(child.node_id, self.node_id)
+
+    def new_child(self, name, value=None):
+        return StoredOptNode(self.store, self.store.add(name, value, self.node_id))
+
+# match the flat list of options, not the graph
+def match_opts_list(prev_opts, selectors, remaining_opts, spans=None):
+    #assert len(selectors) > 0
+    if len(selectors) == 0:
+        # the all selectors got mathed
+        return True # prev_opts + remaining_opts
+
+    sel = selectors[0]
+    assert len(sel) > 0
+
+    if len(remaining_opts) == 0:
+        # no match
+        return False # []
+
+    cur_node = remaining_opts[0]
+
+    # skip empty special selectors
+    #if sel[0] in ('>', '=', '.') and len(sel) == 1:
+    if all(ch in ('>', '=', '.') for ch in sel):
+        if logger is not None: # TODO: add a default logger
+            logger.warning(f'got an empty special selector: {sel}')
+        #selectors = selectors[1:]
+        #sel = selectors[0]
+        return match_opts_list(prev_opts, selectors[1:], remaining_opts, spans)
+
+    matched = False
+    matched_self = False
+    if sel[0] == '>':
+        # children names
+        cnode_selector = sel[1:]
+
+        for c in cur_node.children:
+            #yield from c.match_selectors([sel[0][1:]] + selectors[1:], prev_nodes + [self])
+            matched |= c.match_selector(cnode_selector, spans)
+
+    else:
+        matched = matched_self = cur_node.match_selector(sel, spans)
+
+    next_selectors = selectors[1:] if matched else selectors
+    #if len(next_selectors) == 0:
+    #    # done
+    #    #for opt in self.opt_list():
+    #    #    yield prev_nodes + opt
+    #    return 
+
+    if matched and not matched_self:
+        # matched something in child nodes
+        # the matching process stays at this node
+        #yield from self._match_selectors(next_selectors, prev_nodes)
+        # basically repeat matching the current node
+        return match_opts_list(prev_opts, next_selectors, remaining_opts, spans)
+
+    else:
+        # matched or no this node - check children
+        # first check if all is fine
+        # TODO: all this logic needs to be corrected, including at the beginning of the func
+        if len(next_selectors)==0:
+            # all matched
+            return True # prev_opts + remaining_opts
+
+        # matched self, but more selectors remain -- need to check children
+        # no children nodes -- no match
+        if not cur_node.children:
+            return False # []
+
+        for c in cur_node.children:
+            #yield from c._match_selectors(next_selectors, prev_nodes + [self])
+            return match_opts_list(prev_opts+[cur_node], next_selectors, remaining_opts[1:], spans)
+
+    assert False
+
+class OptPathTable:
+    '''OptPathTable(opts_graph)
+
+    The flat table of all option paths in a forest of `OptNode`-s.
+    It holds the same paths that `OptNode.opt_list` yields,
+    in the same order, but it is built only once:
+    each path gets an integer id, and it is stored as
+    the last node of the path and the id of the parent path.
+    So, the paths are not copied around as lists of nodes.
+
+    The parent path always has a smaller id than its children paths,
+    and the paths of a subtree have the ids from the subtree root path
+    till its end in `ends`. The nodes get their own ids in `node_ids`,
+    the same node may end several paths.
+
+    The table does not follow the changes in the tree by itself,
+    check `is_stale()` and rebuild it when the tree changes.
+    '''
+
+    def __init__(self, opts_graph):
+        self.roots = list(opts_graph)
+        self.version = OptNode.tree_version
+        self.tree = None # the `MappedOptTree` of the columns
+
+        self.nodes   = [] # path id -> the last node of the path
+        self.parents = [] # path id -> the parent path id, -1 for the roots
+        self.depths  = [] # path id -> the number of nodes in the path - 1
+
+        # iterative depth-first walk, in the order of opt_list
+        stack = [(root, -1) for root in reversed(self.roots)]
+        while stack:
+            node, parent_id = stack.pop()
+            path_id = len(self.nodes)
+            self.nodes.append(node)
+            self.parents.append(parent_id)
+            self.depths.append(self.depths[parent_id] + 1 if parent_id >= 0 else 0)
+
+            # case of a cycle in the graph:
+            # the path ends at the repeated node, like in opt_list
+            if self._in_path(parent_id, node):
+                continue
+
+            stack.extend((c, path_id) for c in reversed(list(node.children)))
+
+        self._number_nodes()
+
+    @classmethod
+    def from_columns(cls, nodes, parents):
+        '''from_columns(cls, nodes, parents)
+
+        Make a table straight from its columns, with no tree walk.
+        The parent path ids must be smaller than the children ones.
+        '''
+        table = cls.__new__(cls)
+        table.version = OptNode.tree_version
+        table.tree    = None
+        table.nodes   = nodes
+        table.parents = parents
+        table.depths  = []
+        for parent_id in parents:
+            table.depths.append(table.depths[parent_id] + 1 if parent_id >= 0 else 0)
+        table.roots = [node for node, parent_id in zip(nodes, parents) if parent_id < 0]
+        table._number_nodes()
+        return table
+
+    @classmethod
+    def from_mapped(cls, tree):
+        '''from_mapped(cls, tree)
+
+        The table of a `MappedOptTree`, straight from its columns:
+        the file nodes are in the order of the paths, one node per path,
+        and the node views are made only when they are looked at.
+        '''
+        table = cls.__new__(cls)
+        table.version = OptNode.tree_version
+        table.tree    = tree
+        table.roots   = list(tree)
+        table.nodes   = table.unique_nodes = _MappedNodes(tree)
+        table.node_ids = range(len(tree.parents))
+        table.parents = tree.parents
+        table.depths  = tree.depths
+        table.ends    = tree.ends
+        return table
+
+    def _number_nodes(self):
+        self._unique_ids = None # node -> node id, made on demand
+        self.unique_nodes = [] # node id -> node
+        self.node_ids = array('i') # path id -> node id
+        node_ids = {}
+        for node in self.nodes:
+            node_id = node_ids.get(node)
+            if node_id is None:
+                node_id = node_ids[node] = len(self.unique_nodes)
+                self.unique_nodes.append(node)
+            self.node_ids.append(node_id)
+
+        # path id -> the end of its subtree paths
+        self.ends = array('i', range(1, len(self.nodes)+1))
+        for path_id in range(len(self.nodes)-1, -1, -1):
+            parent_id = self.parents[path_id]
+            if parent_id >= 0 and self.ends[parent_id] < self.ends[path_id]:
+                self.ends[parent_id] = self.ends[path_id]
+
+    def _in_path(self, path_id, node):
+        while path_id >= 0:
+            if self.nodes[path_id] == node:
+                return True
+            path_id = self.parents[path_id]
+        return False
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return f'OptPathTable({len(self.roots)} roots, {len(self)} paths)'
+
+    def node_id_of(self, node):
+        '''node_id_of(self, node)
+
+        The node id of `node` in the table, or None if it is not there.
+        '''
+        if self.tree is not None:
+            return node.node_id if getattr(node, 'store', None) is self.tree else None
+
+        if self._unique_ids is None:
+            self._unique_ids = {node: node_id for node_id, node in enumerate(self.unique_nodes)}
+        return self._unique_ids.get(node)
+
+    def name_groups(self):
+        '''name_groups(self)
+
+        returns: the list of the distinct node names,
+                 and the list of the node ids of each name
+        '''
+        if self.tree is not None:
+            return self.tree.name_groups()
+
+        names, name_nodes = [], []
+        name_ids = {}
+        for node_id, node in enumerate(self.unique_nodes):
+            name_id = name_ids.get(node.name)
+            if name_id is None:
+                name_id = name_ids[node.name] = len(names)
+                names.append(node.name)
+                name_nodes.append(array('i'))
+            name_nodes[name_id].append(node_id)
+        return names, name_nodes
+
+    def value_groups(self):
+        '''value_groups(self)
+
+        returns: the dicts from str(value) and from type(value)
+                 to the sets of the node ids with such values
+        '''
+        if self.tree is not None:
+            return self.tree.value_groups()
+
+        values, types = {}, {}
+        for node_id, node in enumerate(self.unique_nodes):
+            value = node.value
+            values.setdefault(str(value), set()).add(node_id)
+            types.setdefault(type(value), set()).add(node_id)
+        return values, types
+
+    def is_stale(self, opts_graph=None):
+        '''is_stale(self, opts_graph=None)
+
+        True if the tree changed since the table was built.
+        '''
+        if self.version != OptNode.tree_version:
+            return True
+
+        return opts_graph is not None and len(opts_graph) != len(self.roots)
+
+    def grown_from(self, old):
+        '''grown_from(self, old)
+
+        Compares the table with an older table `old` of the same forest.
+        If only new paths were added to the forest since, returns the pair:
+        the list of the path ids here of the old paths, by their old ids,
+        and the ascending list of the ids of the new paths.
+        Otherwise, when some paths were moved or removed, or when a node
+        ends several paths, so the paths cannot be told by their nodes,
+        returns None.
+        '''
+        if len(self.unique_nodes) != len(self.nodes) or len(old.unique_nodes) != len(old.nodes):
+            return None
+
+        # each node ends one path, the node ids are the path ids
+        path_ids = {node: path_id for path_id, node in enumerate(self.nodes)}
+        kept = array('i')
+        for old_id, node in enumerate(old.nodes):
+            path_id = path_ids.get(node)
+            if path_id is None:
+                return None
+
+            # the same node under another parent is a moved path
+            old_parent, parent = old.parents[old_id], self.parents[path_id]
+            if (old_parent < 0) != (parent < 0) or (parent >= 0 and self.nodes[parent] != old.nodes[old_parent]):
+                return None
+
+            kept.append(path_id)
+
+        is_kept = bytearray(len(self.nodes))
+        for path_id in kept:
+            is_kept[path_id] = 1
+        new_ids = [path_id for path_id, was_there in enumerate(is_kept) if not was_there]
+        return kept, new_ids
+
+    def path(self, path_id):
+        '''path(self, path_id)
+
+        Returns the list of nodes of the path, from the root,
+        like the lists that `OptNode.opt_list` yields.
+        '''
+        path = []
+        while path_id >= 0:
+            path.append(self.nodes[path_id])
+            path_id = self.parents[path_id]
+        path.reverse()
+        return path
+
+    def paths(self, path_ids=None):
+        path_ids = range(len(self)) if path_ids is None else path_ids
+        for path_id in path_ids:
+            yield self.path(path_id)
+
+class QuerySelector:
+    '''QuerySelector(text)
+
+    One selector of a query, parsed once: whether it is for the child nodes,
+    what it matches (the name, the value or the value type), and its operand,
+    with the trailing $ anchor and the /regex/ compiled.
+    `match(node, spans=None)` does what `OptNode.match_selector` does,
+    but it does not look at the selector text again.
+    '''
+
+    __slots__ = ('text', 'inner', 'child', 'kind', 'operand', 'value_type',
+                 'value_is_regex', 'value_regex', 'name_substr', 'name_anchored',
+                 'name_is_regex', 'name_regex')
+
+    def __init__(self, text):
+        assert len(text) > 0
+        self.text = text
+        self.child = text[0] == '>'
+        # the selector for the node itself
+        self.inner = text[1:] if self.child else text
+
+        self.kind = 'name'
+        if not self.inner or all(ch in ('>', '=', '.') for ch in self.inner):
+            self.kind = 'empty'
+        elif self.inner[0] == '=':
+            self.kind = 'value'
+        elif self.inner[0] == '.':
+            self.kind = 'type'
+
+        self.operand = self.inner[1:] if self.kind in ('value', 'type') else self.inner
+        self.value_type = _SELECTOR_TYPES.get(self.operand) if self.kind == 'type' else None
+        self.value_is_regex = self.kind == 'value' and _is_regex_selector(self.operand)
+        self.value_regex = _compile_regex(self.operand[1:-1]) if self.value_is_regex else None
+
+        # the names are matched by the name selectors,
+        # and by the whole value selector when the value does not match
+        name_text = self.inner
+        self.name_is_regex = _is_regex_selector(name_text)
+        self.name_regex = _compile_regex(name_text[1:-1]) if self.name_is_regex else None
+        self.name_anchored = name_text[-1:] == '$' and not self.name_is_regex
+        self.name_substr = name_text[:-1] if self.name_anchored else name_text
+
+    def __repr__(self):
+        return f'QuerySelector({self.text!r}, {self.kind}{", child" if self.child else ""})'
+
+    @property
+    def value_dependent(self):
+        return self.kind in ('value', 'type')
+
+    def match(self, node, spans=None):
+        '''match(self, node, spans=None)
+
+        True if the node matches, or for a child selector
+        if any of its children matches.
+        '''
+        if not self.child:
+            return self._match_node(node, spans)
+
+        if spans is None:
+            return any(self._match_node(c, None) for c in node.children)
+
+        # all matched children get highlighted
+        matched = False
+        for c in node.children:
+            matched |= self._match_node(c, spans)
+        return matched
+
+    def _match_node(self, node, spans):
+        if self.kind == 'type':
+            return self.value_type is not None and type(node.value) == self.value_type
+
+        if self.kind == 'value':
+            value_text = str(node.value)
+            if self.value_is_regex:
+                value_matched = self.value_regex is not None and self.value_regex.search(value_text) is not None
+            else:
+                value_matched = value_text == self.operand
+
+            if value_matched:
+                if spans is not None:
+                    spans.add_value(node)
+                return True
+
+        return self._match_name(node, spans)
+
+    def _match_name(self, node, spans):
+        name = node.name
+        if self.name_is_regex:
+            match = self.name_regex.search(name) if self.name_regex is not None else None
+            if match is None:
+                return False
+            start, end = match.span()
+
+        else:
+            start = name.find(self.name_substr)
+            if start < 0:
+                return False
+            end = start + len(self.name_substr)
+            # the first occurrence must be at the end, like in _name_match_span
+            if self.name_anchored and end != len(name):
+                return False
+
+        if spans is not None and start < end:
+            spans.add_name(node, start, end)
+        return True
+
+class QueryPlan:
+    '''QueryPlan(selectors)
+
+    The compiled query: the list of `QuerySelector`s, without the empty
+    special selectors, that get warnings instead. The `key` is the tuple
+    of the selector texts, the same for the queries that match the same.
+    Use `compile_query` to get the cached plans.
+    '''
+
+    def __init__(self, selectors):
+        self.selectors = []
+        self.warnings = []
+        for text in selectors:
+            sel = QuerySelector(text)
+            if sel.kind == 'empty':
+                self.warnings.append(f'ignored the empty special selector: {text}')
+                continue
+            self.selectors.append(sel)
+
+        self.key = tuple(sel.text for sel in self.selectors)
+        self.value_dependent = any(sel.value_dependent for sel in self.selectors)
+        # the child selectors look at the children, so the new nodes
+        # may change the matches of their parents
+        self.tree_dependent = any(sel.child for sel in self.selectors)
+
+    def __len__(self):
+        return len(self.selectors)
+
+    def __repr__(self):
+        return f'QueryPlan({list(self.key)})'
+
+# the number of the recent query plans and result sets kept
+QUERY_CACHE_SIZE = 64
+QUERY_RESULTS_CACHE_SIZE = 16
+
+_query_plans = {} # the query -> QueryPlan, the most recent last
+_query_plans_lock = threading.Lock()
+
+def compile_query(query, logger=None):
+    '''compile_query(query, logger=None)
+
+    The `QueryPlan` of the query: a selector line, like the comline,
+    or a sequence of the selector strings. The recent plans are cached,
+    the warnings are logged when a plan is compiled.
+    '''
+    if isinstance(query, QueryPlan):
+        return query
+
+    key = tuple(query.split()) if isinstance(query, str) else tuple(query)
+    with _query_plans_lock:
+        plan = _query_plans.pop(key, None)
+        if plan is None:
+            plan = QueryPlan(key)
+            if logger is not None:
+                for warning in plan.warnings:
+                    logger.warning(warning)
+
+            if len(_query_plans) >= QUERY_CACHE_SIZE:
+                del _query_plans[next(iter(_query_plans))]
+
+        _query_plans[key] = plan
+
+    return plan
+
+def _match_node_step(node, selectors, sel_i, node_id=None, candidates=None, spans=None):
+    '''_match_node_step(node, selectors, sel_i, node_id=None, candidates=None, spans=None)
+
+    One step of `match_opts_list` for one node of a path:
+    returns the number of the compiled `selectors` consumed after this node,
+    when `sel_i` of them were consumed before it.
+
+    candidates -- optional list of the sets of node ids that can match
+                  each selector (None for a selector with no index lookup),
+                  the other nodes are not matched at all
+    spans      -- optional `MatchSpans` to record the highlights in
+    '''
+    while sel_i < len(selectors):
+        sel = selectors[sel_i]
+        sel_candidates = candidates[sel_i] if candidates is not None else None
+        if sel_candidates is not None and node_id not in sel_candidates:
+            return sel_i
+
+        if not sel.child:
+            if sel.match(node, spans):
+                sel_i += 1
+            return sel_i
+
+        # children names
+        # the matching process stays at this node, if it matches
+        if not sel.match(node, spans):
+            return sel_i
+
+        sel_i += 1
+
+    return sel_i
+
+def _path_consumed(table, path_id, selectors, consumed, candidates=None, spans=None):
+    '''_path_consumed(table, path_id, selectors, consumed, candidates=None, spans=None)
+
+    The number of selectors consumed at the end of the path `path_id`.
+    The `consumed` dict memoizes it for the paths that were already matched,
+    the missing parent paths are matched and memoized on the way.
+    '''
+    if path_id < 0:
+        return 0
+
+    # go up to the first known parent path
+    chain = []
+    while path_id >= 0 and path_id not in consumed:
+        chain.append(path_id)
+        path_id = table.parents[path_id]
+
+    sel_i = consumed[path_id] if path_id >= 0 else 0
+    for path_id in reversed(chain):
+        if sel_i < len(selectors):
+            sel_i = _match_node_step(table.nodes[path_id], selectors, sel_i, table.node_ids[path_id], candidates, spans)
+        consumed[path_id] = sel_i
+
+    return sel_i
+
+# how often the matching loops check if they were cancelled
+MATCH_CANCEL_CHECK = 4096
+# the getkey timeout in ms, to redraw while the matching is running
+MATCHING_TIMEOUT = 30
+# the matching worker asks for a redraw every this many streamed matches
+MATCH_NOTIFY_EVERY = 1024
+# the lazy trees expand at most this many nodes for a query at once,
+# the next ones after the query is matched on the expanded tree
+LAZY_EXPAND_LIMIT = 64
+# and a query expands the nodes where nothing matched yet only till
+# it has expanded this many in all, so a typo does not browse all the server
+LAZY_EXPAND_BUDGET = 2048
+# the growing tree table is rebuilt at most once per this many times
+# the time it took to build it, so the rebuilds do not take over the UI
+TABLE_REBUILD_FACTOR = 10
+
+def _iter_match_range(table, selectors, start, end, cancelled=None, candidates=None, ancestors_consumed=None, spans=None):
+    '''_iter_match_range(table, selectors, start, end, cancelled=None, candidates=None, ancestors_consumed=None, spans=None)
+
+    Yields the matched path ids from `start` to `end`, in the table order.
+    The matching state of a path is continued from its parent path.
+    The parent paths before `start` are matched on the way,
+    and memoized in `ancestors_consumed`.
+
+    selectors -- the compiled `QuerySelector`s
+    cancelled -- optional callable, the matching stops when it returns True
+    '''
+    if ancestors_consumed is None:
+        ancestors_consumed = {}
+
+    n_selectors = len(selectors)
+    nodes, parents, node_ids = table.nodes, table.parents, table.node_ids
+    # the number of consumed selectors at the end of each path
+    consumed = [0] * (end - start)
+    for path_id in range(start, end):
+        if cancelled is not None and (path_id - start) % MATCH_CANCEL_CHECK == 0 and cancelled():
+            return
+
+        parent_id = parents[path_id]
+        if parent_id >= start:
+            sel_i = consumed[parent_id - start]
+        else:
+            sel_i = _path_consumed(table, parent_id, selectors, ancestors_consumed, candidates, spans)
+
+        if sel_i < n_selectors:
+            sel_i = _match_node_step(nodes[path_id], selectors, sel_i, node_ids[path_id], candidates, spans)
+
+        consumed[path_id - start] = sel_i
+        if sel_i == n_selectors:
+            yield path_id
+
+def iter_match_opts_table(table, selectors, logger=None, path_ids=None, cancel=None, index=None, spans=None):
+    '''iter_match_opts_table(table, selectors, logger=None, path_ids=None, cancel=None, index=None, spans=None)
+
+    The same matching as `match_opts_list`, but run over all paths of
+    an `OptPathTable` at once. The matching state of a path is continued
+    from its parent path, so each node is matched once per path id,
+    and the nodes of the common prefixes are not matched again.
+
+    selectors -- the selector strings or their `QueryPlan`
+    path_ids -- optional ascending list of path ids to match,
+                instead of the whole table
+    cancel   -- optional `threading.Event`, the matching stops when it is set
+    index    -- optional `OptNameIndex` of the table, then only
+                the candidate nodes of the selectors are matched
+    spans    -- optional `MatchSpans` to record the highlights in
+
+    Yields the matched path ids, in the table order.
+    '''
+
+    plan = compile_query(selectors, logger)
+    checked_selectors = plan.selectors
+    n_selectors = len(checked_selectors)
+    cancelled = cancel.is_set if cancel is not None else None
+    candidates = index.candidates(plan.key) if index is not None else None
+
+    if path_ids is not None:
+        # match only the given paths
+        consumed = {}
+        for i, path_id in enumerate(path_ids):
+            if cancelled is not None and i % MATCH_CANCEL_CHECK == 0 and cancelled():
+                return
+
+            if not checked_selectors or _path_consumed(table, path_id, checked_selectors, consumed, candidates, spans) == n_selectors:
+                yield path_id
+
+        return
+
+    if not checked_selectors:
+        yield from range(len(table))
+        return
+
+    # the matched paths must go through a node that matches the first selector
+    # i.e. only the subtrees of its candidates need matching
+    ranges = [(0, len(table))]
+    if candidates is not None and candidates[0] is not None:
+        ranges = index.subtree_ranges(candidates[0])
+
+    ancestors_consumed = {}
+    for start, end in ranges:
+        if cancelled is not None and cancelled():
+            return
+
+        yield from _iter_match_range(table, checked_selectors, start, end,
+                                     cancelled, candidates, ancestors_consumed, spans)
+
+def match_opts_table(table, selectors, logger=None, path_ids=None, index=None, spans=None):
+    '''match_opts_table(table, selectors, logger=None, path_ids=None, index=None, spans=None)
+
+    Returns the list of the matched path ids of `iter_match_opts_table`.
+    '''
+    return list(iter_match_opts_table(table, selectors, logger, path_ids, index=index, spans=spans))
+
+def iter_query_frontier(table, selectors, logger=None, cancel=None, unmatched_limit=None):
+    '''iter_query_frontier(table, selectors, logger=None, cancel=None, unmatched_limit=None)
+
+    Yields the not expanded nodes of the lazy trees in the table that
+    the query needs the children of: first the ones whose paths matched
+    a part of the selectors, or when the next selector is for the children,
+    then the rest of them breadth-first, since the first selector
+    may match anywhere below them, at most `unmatched_limit` of the rest.
+    The empty query needs none of them.
+    '''
+    plan = compile_query(selectors, logger)
+    checked_selectors = plan.selectors
+    if not checked_selectors or not any(getattr(getattr(root, 'store', None), 'unexpanded', None) for root in table.roots):
+        return
+
+    cancelled = cancel.is_set if cancel is not None else None
+    consumed = {}
+    unmatched = [] # the path ids of the frontier where nothing matched yet
+    for path_id, node in enumerate(table.nodes):
+        if cancelled is not None and path_id % MATCH_CANCEL_CHECK == 0 and cancelled():
+            return
+
+        if node.expanded:
+            continue
+
+        sel_i = _path_consumed(table, path_id, checked_selectors, consumed)
+        if sel_i > 0 or checked_selectors[0].child:
+            yield node
+        else:
+            unmatched.append(path_id)
+
+    # the sort is stable, the table order stays within a level
+    unmatched.sort(key=table.depths.__getitem__)
+    for path_id in unmatched[:unmatched_limit]:
+        yield table.nodes[path_id]
+
+def expand_nodes(nodes, prefetch=False):
+    '''expand_nodes(nodes, prefetch=False)
+
+    Asks the lazy trees to fetch the children of the not expanded nodes
+    among `nodes`, in the background, see `OptTreeStore.expand`.
+    The other nodes are skipped.
+    '''
+    store_ids = {} # store -> node ids
+    for node in nodes:
+        if not node.expanded:
+            store_ids.setdefault(node.store, []).append(node.node_id)
+
+    for store, node_ids in store_ids.items():
+        store.expand(node_ids, prefetch)
+
+# the fuzzy match scores, like in fzf:
+# each matched char scores, the gaps between them cost,
+# and the chars at the word boundaries get bonuses
+FUZZY_SCORE_MATCH = 16
+FUZZY_GAP_START = -3
+FUZZY_GAP_EXTENSION = -1
+FUZZY_BONUS_BOUNDARY = 8 # at the name start or after a separator
+FUZZY_BONUS_CAMEL = 7 # at lower-to-upper case or at a digit
+FUZZY_BONUS_CONSECUTIVE = 4
+FUZZY_BONUS_FIRST_CHAR = 2 # the multiplier for the first pattern char
+FUZZY_BONUS_CASE = 1 # the same case as typed, when the case is ignored
+FUZZY_SEPARATORS = '._-/:; '
+
+def _fuzzy_char_bonus(prev, ch):
+    if prev is None or prev in FUZZY_SEPARATORS:
+        return FUZZY_BONUS_BOUNDARY
+
+    if (prev.islower() and ch.isupper()) or (not prev.isdigit() and ch.isdigit()):
+        return FUZZY_BONUS_CAMEL
+
+    return 0
+
+def _fuzzy_name_match(name, pattern):
+    '''_fuzzy_name_match(name, pattern)
+
+    The fuzzy match of the pattern chars as a subsequence of the name,
+    with a trailing $ matching the end of the name. An all lower case
+    pattern ignores the case. The shortest window with the pattern
+    is scored, like fzf does. Returns (score, start, end) or None.
+    '''
+    match_last = False
+    if pattern[-1] == '$':
+        pattern = pattern[:-1]
+        match_last = True
+
+    if not pattern:
+        return None
+
+    ignore_case = pattern == pattern.lower()
+    key = name.lower() if ignore_case else name
+
+    # forward: the first end of the pattern
+    pat_i = 0
+    end = -1
+    for i, ch in enumerate(key):
+        if ch == pattern[pat_i]:
+            pat_i += 1
+            if pat_i == len(pattern):
+                end = i + 1
+                break
+
+    if end < 0:
+        return None
+
+    if match_last:
+        if key[-1] != pattern[-1]:
+            return None
+        end = len(key)
+
+    # backward: the latest start, to get the shortest window
+    pat_i = len(pattern) - 1
+    start = end - 1
+    for i in range(end - 1, -1, -1):
+        if key[i] == pattern[pat_i]:
+            pat_i -= 1
+            if pat_i < 0:
+                start = i
+                break
+
+    # score the window
+    score = 0
+    pat_i = 0
+    in_gap = False
+    consecutive = 0
+    first_bonus = 0
+    prev = name[start-1] if start > 0 else None
+    for i in range(start, end):
+        ch = name[i]
+        if pat_i < len(pattern) and key[i] == pattern[pat_i]:
+            bonus = _fuzzy_char_bonus(prev, ch)
+            if consecutive == 0:
+                first_bonus = bonus
+            else:
+                # a chunk of consecutive chars keeps the bonus of its first char
+                if bonus >= FUZZY_BONUS_BOUNDARY and bonus > first_bonus:
+                    first_bonus = bonus
+                bonus = max(bonus, first_bonus, FUZZY_BONUS_CONSECUTIVE)
+
+            if pat_i == 0:
+                bonus *= FUZZY_BONUS_FIRST_CHAR
+
+            if ignore_case and ch == pattern[pat_i]:
+                bonus += FUZZY_BONUS_CASE
+
+            score += FUZZY_SCORE_MATCH + bonus
+            in_gap = False
+            consecutive += 1
+            pat_i += 1
+
+        else:
+            score += FUZZY_GAP_EXTENSION if in_gap else FUZZY_GAP_START
+            in_gap = True
+            consecutive = 0
+            first_bonus = 0
+
+        prev = ch
+
+    return score, start, end
+
+def _rank_node_step(node, selectors, sel_i, spans=None):
+    '''_rank_node_step(node, selectors, sel_i, spans=None)
+
+    `_match_node_step` with the fuzzy name matching:
+    returns the number of selectors consumed after this node,
+    and the score that this node adds to the path.
+    A child selector scores its best matched child.
+    '''
+    score = 0
+    while sel_i < len(selectors):
+        sel = selectors[sel_i]
+        if not sel.child:
+            sel_score = node.match_selector(sel.inner, spans, fuzzy=True)
+            if sel_score:
+                sel_i += 1
+                score += sel_score
+            return sel_i, score
+
+        # children names
+        best = 0
+        for c in node.children:
+            best = max(best, c.match_selector(sel.inner, spans, fuzzy=True))
+
+        if not best:
+            return sel_i, score
+
+        sel_i += 1
+        score += best
+
+    return sel_i, score
+
+def _path_ranked(table, path_id, selectors, ranked, spans=None):
+    '''_path_ranked(table, path_id, selectors, ranked, spans=None)
+
+    `_path_consumed` for the fuzzy matching: the `ranked` dict memoizes
+    the (consumed, score) of the paths. Returns the (consumed, score)
+    at the end of the path.
+    '''
+    chain = []
+    while path_id >= 0 and path_id not in ranked:
+        chain.append(path_id)
+        path_id = table.parents[path_id]
+
+    sel_i, score = ranked[path_id] if path_id >= 0 else (0, 0)
+    for path_id in reversed(chain):
+        if sel_i < len(selectors):
+            sel_i, node_score = _rank_node_step(table.nodes[path_id], selectors, sel_i, spans)
+            score += node_score
+        ranked[path_id] = sel_i, score
+
+    return sel_i, score
+
+def iter_rank_opts_table(table, selectors, logger=None, path_ids=None, cancel=None, spans=None):
+    '''iter_rank_opts_table(table, selectors, logger=None, path_ids=None, cancel=None, spans=None)
+
+    The fuzzy version of `iter_match_opts_table`: the name selectors
+    match as fuzzy subsequences, and a path scores the sum
+    of its matched selectors. The name index is not used.
+
+    Yields the (path id, score) of the matched paths, in the table order.
+    '''
+    checked_selectors = compile_query(selectors, logger).selectors
+    n_selectors = len(checked_selectors)
+    cancelled = cancel.is_set if cancel is not None else None
+
+    if path_ids is not None:
+        ranked = {}
+        for i, path_id in enumerate(path_ids):
+            if cancelled is not None and i % MATCH_CANCEL_CHECK == 0 and cancelled():
+                return
+
+            sel_i, score = _path_ranked(table, path_id, checked_selectors, ranked, spans)
+            if sel_i == n_selectors:
+                yield path_id, score
+
+        return
+
+    nodes, parents = table.nodes, table.parents
+    consumed = [0] * len(table)
+    scores   = [0] * len(table)
+    for path_id in range(len(table)):
+        if cancelled is not None and path_id % MATCH_CANCEL_CHECK == 0 and cancelled():
+            return
+
+        parent_id = parents[path_id]
+        sel_i, score = (consumed[parent_id], scores[parent_id]) if parent_id >= 0 else (0, 0)
+        if sel_i < n_selectors:
+            sel_i, node_score = _rank_node_step(nodes[path_id], checked_selectors, sel_i, spans)
+            score += node_score
+
+        consumed[path_id] = sel_i
+        scores[path_id] = score
+        if sel_i == n_selectors:
+            yield path_id, score
+
+def rank_opts_table(table, selectors, top_k, logger=None, cancel=None):
+    '''rank_opts_table(table, selectors, top_k, logger=None, cancel=None)
+
+    The `top_k` best scored paths of `iter_rank_opts_table`.
+    Only they are kept, in a heap, the rest are just counted.
+
+    Returns the list of the path ids, the best first,
+    and the number of all matched paths.
+    '''
+    heap = [] # (score, -path id), the worst on top
+    total = 0
+    for path_id, score in iter_rank_opts_table(table, selectors, logger, cancel=cancel):
+        total += 1
+        item = (score, -path_id) # the earlier path wins a tie
+        if len(heap) < top_k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    return [-neg_id for _, neg_id in sorted(heap, reverse=True)], total
+
+def _is_value_selector(sel):
+    '''_is_value_selector(sel)
+
+    True if the selector matches the values or their types,
+    for this node or for the child nodes.
+    '''
+    if sel[0] == '>':
+        sel = sel[1:]
+
+    return len(sel) > 0 and sel[0] in ('=', '.')
+
+# the length of the n-grams in the name index
+NAME_NGRAM = 3
+# the number of the cached index lookups
+INDEX_CACHE_SIZE = 64
+
+# the number of the compiled /regex/ selectors kept
+REGEX_CACHE_SIZE = 128
+
+def _is_regex_selector(text):
+    return len(text) > 2 and text[0] == '/' and text[-1] == '/'
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def _compile_regex(pattern):
+    '''_compile_regex(pattern)
+
+    The compiled regex, or None if the pattern is not valid,
+    like when it is still being typed. The recent ones are cached,
+    so retyping a query does not compile them again.
+    '''
+    try:
+        return re.compile(pattern)
+    except re.error:
+        return None
+
+def _regex_literal_prefix(pattern):
+    '''_regex_literal_prefix(pattern)
+
+    The literal text that every match of the regex starts with,
+    maybe empty. The name index looks it up before running the regex.
+    '''
+    # the alternatives and the flags can change any literal
+    if '|' in pattern or '(?' in pattern:
+        return ''
+
+    prefix = []
+    i = 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\':
+            escaped = pattern[i+1:i+2]
+            if not escaped or escaped.isalnum():
+                # a class like \d or \w
+                break
+            prefix.append(escaped)
+            i += 2
+
+        elif ch in '.^$*+?{}[]()':
+            break
+
+        else:
+            prefix.append(ch)
+            i += 1
+
+    # the last char is optional under these quantifiers
+    if i < len(pattern) and pattern[i] in '*?{':
+        prefix = prefix[:-1]
+
+    return ''.join(prefix)
+
+def _value_match(value_text, selector_value):
+    '''_value_match(value_text, selector_value)
+
+    The value selector match: the text of the value equals
+    the selector, or a /regex/ selector is found in it.
+    '''
+    if _is_regex_selector(selector_value):
+        regex = _compile_regex(selector_value[1:-1])
+        return regex is not None and regex.search(value_text) is not None
+
+    return value_text == selector_value
+
+def _name_match_span(name, substr):
+    '''_name_match_span(name, substr)
+
+    The name match of a selector substring, with a trailing $ matching
+    the end of the name, or of a /regex/ selector searched in the name.
+    Returns the (start, end) of the match or None.
+    '''
+    if _is_regex_selector(substr):
+        regex = _compile_regex(substr[1:-1])
+        match = regex.search(name) if regex is not None else None
+        return match.span() if match is not None else None
+
+    match_last = False
+    if substr[-1] == '$':
+        substr = substr[:-1]
+        match_last = True
+
+    if substr not in name:
+        return None
+
+    match_ind = name.index(substr)
+
+    if match_last and name[match_ind:] != substr:
+        return None
+
+    return match_ind, match_ind+len(substr)
+
+class OptNameIndex:
+    '''OptNameIndex(table, value_index=None)
+
+    The n-gram inverted index over the node names of an `OptPathTable`,
+    built once per table. The index maps the n-grams to the distinct names,
+    and the names to the node ids: a name selector is looked up through
+    its n-grams, and only the candidate names are verified.
+    The selectors shorter than NAME_NGRAM scan the distinct names.
+    The value and type selectors are looked up in the optional `OptValueIndex`.
+    '''
+
+    def __init__(self, table, value_index=None):
+        self.table = table
+        self.value_index = value_index
+
+        # name id -> name, and name id -> node ids
+        self.names, self.name_nodes = table.name_groups()
+
+        self.ngrams = {} # n-gram -> name ids
+        for name_id, name in enumerate(self.names):
+            for ngram in {name[i:i+NAME_NGRAM] for i in range(len(name) - NAME_NGRAM + 1)}:
+                self.ngrams.setdefault(ngram, array('i')).append(name_id)
+
+        # node id -> the ids of the paths that end at the node
+        self.node_paths_offsets = array('i', [0]) * (len(table.unique_nodes) + 1)
+        for node_id in table.node_ids:
+            self.node_paths_offsets[node_id+1] += 1
+        for node_id in range(len(table.unique_nodes)):
+            self.node_paths_offsets[node_id+1] += self.node_paths_offsets[node_id]
+
+        self._cache = {} # selector -> candidates
+
+        self.node_paths = array('i', [0]) * len(table)
+        filled = array('i', self.node_paths_offsets)
+        for path_id, node_id in enumerate(table.node_ids):
+            self.node_paths[filled[node_id]] = path_id
+            filled[node_id] += 1
+
+    def __repr__(self):
+        return f'OptNameIndex({len(self.names)} names, {len(self.ngrams)} {NAME_NGRAM}-grams)'
+
+    def paths_of(self, node_id):
+        return self.node_paths[self.node_paths_offsets[node_id]:self.node_paths_offsets[node_id+1]]
+
+    def name_candidates(self, substr):
+        '''name_candidates(self, substr)
+
+        The set of the ids of the nodes whose names match the selector substring.
+        A /regex/ is looked up by its literal prefix, and then
+        it runs only on the candidate names.
+        '''
+        if _is_regex_selector(substr):
+            if _compile_regex(substr[1:-1]) is None:
+                return set()
+            key = _regex_literal_prefix(substr[1:-1])
+
+        else:
+            key = substr[:-1] if substr[-1] == '$' else substr
+
+        if len(key) < NAME_NGRAM:
+            name_ids = range(len(self.names))
+
+        else:
+            postings = []
+            for i in range(len(key) - NAME_NGRAM + 1):
+                posting = self.ngrams.get(key[i:i+NAME_NGRAM])
+                if posting is None:
+                    return set()
+                postings.append(posting)
+
+            postings.sort(key=len)
+            name_ids = set(postings[0]).intersection(*postings[1:])
+
+        node_ids = set()
+        for name_id in name_ids:
+            if _name_match_span(self.names[name_id], substr) is not None:
+                node_ids.update(self.name_nodes[name_id])
+
+        return node_ids
+
+    def parent_candidates(self, node_ids):
+        '''parent_candidates(self, node_ids)
+
+        The set of the ids of the nodes that have a child among `node_ids`.
+        '''
+        parents, table_node_ids = self.table.parents, self.table.node_ids
+        parent_ids = set()
+        for node_id in node_ids:
+            for path_id in self.paths_of(node_id):
+                parent_id = parents[path_id]
+                if parent_id >= 0:
+                    parent_ids.add(table_node_ids[parent_id])
+
+        return parent_ids
+
+    def selector_candidates(self, sel):
+        '''selector_candidates(self, sel)
+
+        The set of the ids of the nodes that can match the selector,
+        or None if the index does not cover it.
+        The recent lookups of the names are cached.
+        '''
+        if _is_value_selector(sel):
+            # the values change
+            return self._selector_candidates(sel)
+
+        if sel not in self._cache:
+            if len(self._cache) >= INDEX_CACHE_SIZE:
+                del self._cache[next(iter(self._cache))]
+            self._cache[sel] = self._selector_candidates(sel)
+
+        return self._cache[sel]
+
+    def _selector_candidates(self, sel):
+        if sel[0] == '>':
+            child_candidates = self.selector_candidates(sel[1:]) if len(sel) > 1 else None
+            if child_candidates is None:
+                return None
+            return self.parent_candidates(child_candidates)
+
+        if sel[0] in ('=', '.') and self.value_index is None:
+            return None
+
+        if sel[0] == '.':
+            return self.value_index.type_candidates(sel[1:])
+
+        if sel[0] == '=':
+            # match_selector falls back to the name match
+            # when the value does not match
+            return self.value_index.value_candidates(sel[1:]) | self.name_candidates(sel)
+
+        return self.name_candidates(sel)
+
+    def candidates(self, selectors):
+        return [self.selector_candidates(sel) for sel in selectors]
+
+    def subtree_ranges(self, node_ids):
+        '''subtree_ranges(self, node_ids)
+
+        The sorted ranges (start, end) of the path ids in the subtrees
+        of the paths ending at the given nodes, without the nested ones.
+        '''
+        path_ids = sorted(path_id for node_id in node_ids for path_id in self.paths_of(node_id))
+
+        ranges = []
+        prev_end = -1
+        for path_id in path_ids:
+            if path_id < prev_end:
+                continue
+            prev_end = self.table.ends[path_id]
+            ranges.append((path_id, prev_end))
+
+        return ranges
+
+# the basic types of the . selectors
+_SELECTOR_TYPES = {'int': int, 'float': float, 'str': str}
+
+class OptValueIndex:
+    '''OptValueIndex(table)
+
+    The inverted indexes of the node values in an `OptPathTable`:
+    from the value text to the node ids, for the = selectors,
+    and from the value type to the node ids, for the . selectors.
+    It watches the node values, and moves the changed nodes
+    in the indexes, so it stays valid with no rebuild, till `close()`.
+    The index of a `MappedOptTree` table is read from the file columns.
+    '''
+
+    def __init__(self, table):
+        self.table = table
+        self._lock = threading.Lock()
+
+        # it watches before the scan, the changes during the scan
+        # are kept aside and moved in after it, not lost
+        with self._lock:
+            self._pending = [] # (node id, old value, new value)
+            OptNode.watch_values(self)
+
+        # str(value) -> node ids, and type(value) -> node ids
+        values, types = table.value_groups()
+        with self._lock:
+            self.values, self.types = values, types
+            for node_id, old_value, new_value in self._pending:
+                self._discard(node_id, old_value)
+                self._add(node_id, new_value)
+            self._pending = None
+
+    def __repr__(self):
+        return f'OptValueIndex({len(self.values)} values, {len(self.types)} types)'
+
+    def _add(self, node_id, value):
+        self.values.setdefault(str(value), set()).add(node_id)
+        self.types.setdefault(type(value), set()).add(node_id)
+
+    def _discard(self, node_id, value):
+        for index, key in ((self.values, str(value)), (self.types, type(value))):
+            node_ids = index.get(key)
+            if node_ids is None:
+                continue
+            node_ids.discard(node_id)
+            if not node_ids:
+                del index[key]
+
+    def value_changed(self, node, old_value, new_value):
+        node_id = self.table.node_id_of(node)
+        if node_id is None:
+            return
+
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((node_id, old_value, new_value))
+                return
+
+            self._discard(node_id, old_value)
+            self._add(node_id, new_value)
+
+    def close(self):
+        '''stop following the value changes, the index gets stale'''
+        OptNode.unwatch_values(self)
+
+    def value_candidates(self, value_text):
+        if _is_regex_selector(value_text):
+            # the regex runs once per distinct value
+            with self._lock:
+                return set(node_id for text, node_ids in self.values.items()
+                           if _value_match(text, value_text) for node_id in node_ids)
+
+        with self._lock:
+            return set(self.values.get(value_text, ()))
+
+    def type_candidates(self, type_name):
+        if type_name not in _SELECTOR_TYPES:
+            return set()
+
+        with self._lock:
+            return set(self.types.get(_SELECTOR_TYPES[type_name], ()))
+
+def _selector_narrows(prev_sel, sel):
+    '''_selector_narrows(prev_sel, sel)
+
+    True if every node that matches `sel` surely matches `prev_sel` too,
+    like when a character is appended to a name selector.
+    '''
+    if prev_sel == sel:
+        return True
+
+    # the child selectors narrow only the child selectors
+    if (prev_sel[0] == '>') != (sel[0] == '>'):
+        return False
+
+    if prev_sel[0] == '>':
+        prev_sel, sel = prev_sel[1:], sel[1:]
+
+    # a /regex/ is not a substring of anything
+    # and it is not one while its closing / is being typed
+    if _is_regex_selector(prev_sel) or _is_regex_selector(sel):
+        return False
+
+    # the value and type selectors are exact matches
+    # and a name match till the end does not narrow anything
+    if not prev_sel or prev_sel[0] in ('=', '.') or prev_sel[-1] == '$':
+        return False
+
+    if sel[0] in ('=', '.'):
+        return False
+
+    # the name substring of the new selector contains the previous one
+    if sel[-1] == '$':
+        sel = sel[:-1]
+
+    return prev_sel in sel
+
+def _query_narrows(prev_query, query):
+    '''_query_narrows(prev_query, query)
+
+    True if the matches of `query` are a subset of the `prev_query` matches:
+    the same selectors, or narrower ones, plus possibly more selectors.
+    '''
+    if len(query) < len(prev_query):
+        return False
+
+    return all(_selector_narrows(prev_sel, sel) for prev_sel, sel in zip(prev_query, query))
+
+class MatchStack:
+    '''MatchStack(table, logger=None)
+
+    The fzf-like stack of the result sets, keyed by the query.
+    When the query is extended, only the previous matches are filtered.
+    When it is shortened (backspace, Ctrl-W), the stack pops back to
+    the result set of that shorter query, with no matching at all.
+    The recent result sets are kept too, by their query plan keys,
+    so flipping back to a recent query needs no matching either.
+    '''
+
+    def __init__(self, table, logger=None, engine=None):
+        self.table = table
+        self.logger = logger
+        # optional ParallelMatcher for the matches over the whole table
+        self.engine = engine
+        # the indexes are built at the first query that needs them
+        self._index = None
+        # the bottom is the empty query, that matches everything
+        self.stack = [((), None)]
+        self.recent = {} # query -> matched path ids, the most recent last
+        self.value_version = OptNode.value_version
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = OptNameIndex(self.table, OptValueIndex(self.table))
+        return self._index
+
+    def __repr__(self):
+        return f'MatchStack({self.table}, {len(self.stack)} queries)'
+
+    def close(self):
+        '''drop the indexes, when the stack is not used any more'''
+        if self._index is not None and self._index.value_index is not None:
+            self._index.value_index.close()
+        self._index = None
+
+    def match(self, selectors):
+        '''match(self, selectors)
+
+        Returns the list of the matched path ids, like `match_opts_table`.
+        '''
+        return list(self.iter_match(selectors))
+
+    def iter_match(self, selectors, cancel=None):
+        '''iter_match(self, selectors, cancel=None)
+
+        Yields the matched path ids, like `iter_match_opts_table`.
+        The result set is pushed on the stack only if it was not cancelled.
+        '''
+        plan = compile_query(selectors, self.logger)
+        query = plan.key
+
+        if self.value_version != OptNode.value_version:
+            self.value_version = OptNode.value_version
+            # the values changed, the matches of the value selectors are stale
+            self.stack = [entry for entry in self.stack
+                          if not compile_query(entry[0]).value_dependent]
+            self.recent = {q: matched for q, matched in self.recent.items()
+                           if not compile_query(q).value_dependent}
+
+        # pop the queries that the new one does not extend
+        while len(self.stack) > 1 and not _query_narrows(self.stack[-1][0], query):
+            self.stack.pop()
+
+        prev_query, prev_matched = self.stack[-1]
+        if prev_query == query and prev_matched is not None:
+            yield from prev_matched
+            return
+
+        matched = self.recent.get(query)
+        if matched is not None:
+            self._push(prev_query, query, matched)
+            yield from matched
+            return
+
+        # filter only the survivors of the previous query
+        # (the empty query at the bottom matches everything)
+        # the whole table goes to the parallel engine,
+        # unless the index narrows the first selector
+        if prev_matched is None and self.engine is not None and \
+                (not query or self.index.selector_candidates(query[0]) is None):
+            matches = self.engine.iter_match(self.table, query, self.logger, cancel)
+        else:
+            matches = iter_match_opts_table(self.table, query, self.logger, prev_matched, cancel,
+                                            self.index if query else None)
+
+        matched = []
+        for path_id in matches:
+            matched.append(path_id)
+            yield path_id
+
+        if cancel is not None and cancel.is_set():
+            return
+
+        self._push(prev_query, query, matched)
+
+    def _push(self, prev_query, query, matched):
+        if prev_query == query:
+            # the empty query
+            self.stack[-1] = (query, matched)
+        else:
+            self.stack.append((query, matched))
+
+        self.recent.pop(query, None)
+        if len(self.recent) >= QUERY_RESULTS_CACHE_SIZE:
+            del self.recent[next(iter(self.recent))]
+        self.recent[query] = matched
+
+# the tables with this many paths are matched in parallel
+PARALLEL_MATCH_THRESHOLD = 200000
+
+class _ValueText(str):
+    '''_ValueText(text)
+
+    A value of a type that the type selectors do not match,
+    kept only as its text in the shared tables.
+    '''
+
+_VALUE_TAGS = {type(None): 'N', bool: 'b', int: 'i', float: 'f', str: 's'}
+
+def _decode_value(tag, text):
+    if tag == 'N':
+        return None
+    if tag == 'b':
+        return text == 'True'
+    if tag == 'i':
+        return int(text)
+    if tag == 'f':
+        return float(text)
+    if tag == 's':
+        return text
+    return _ValueText(text)
+
+# the value tag -> the type of the decoded values
+_TAG_TYPES = {tag: value_type for value_type, tag in _VALUE_TAGS.items()}
+_TAG_TYPES['o'] = _ValueText
+
+class SharedPathTable:
+    '''SharedPathTable(table)
+
+    An `OptPathTable` packed into one block of shared memory, once per table,
+    so that the matching processes get the tree without pickling it per query.
+
+    The block is a header with the sizes, and then the int32 columns:
+    path nodes, path parents, node children offsets, node children,
+    node name offsets, node value offsets; the value type tags,
+    and the names and the values as utf-8 text.
+    The values keep only their text and their basic type,
+    that is all the selectors look at.
+    '''
+
+    _header = struct.Struct('<5q')
+
+    def __init__(self, table):
+        node_ids = {}
+        nodes = []
+        def node_id(node):
+            i = node_ids.get(node)
+            if i is None:
+                i = node_ids[node] = len(nodes)
+                nodes.append(node)
+            return i
+
+        path_nodes   = array('i', (node_id(n) for n in table.nodes))
+        path_parents = array('i', table.parents)
+
+        # only the children of the path nodes are needed, for the > selectors
+        children_offsets = array('i', [0])
+        children = array('i')
+        for i in range(len(nodes)):
+            children.extend(node_id(c) for c in nodes[i].children)
+            children_offsets.append(len(children))
+
+        for _ in range(len(children_offsets), len(nodes) + 1):
+            children_offsets.append(len(children))
+
+        names  = [n.name.encode('utf-8', 'surrogatepass') for n in nodes]
+        values = [('' if n.value is None else str(n.value)).encode('utf-8', 'surrogatepass') for n in nodes]
+        tags   = ''.join(_VALUE_TAGS.get(type(n.value), 'o') for n in nodes).encode('ascii')
+
+        name_offsets  = array('i', [0])
+        value_offsets = array('i', [0])
+        for name, value in zip(names, values):
+            name_offsets.append(name_offsets[-1] + len(name))
+            value_offsets.append(value_offsets[-1] + len(value))
+
+        columns = [self._header.pack(len(path_nodes), len(nodes), len(children), name_offsets[-1], value_offsets[-1]),
+                   path_nodes, path_parents, children_offsets, children, name_offsets, value_offsets,
+                   tags, b''.join(names), b''.join(values)]
+        columns = [c.tobytes() if isinstance(c, array) else c for c in columns]
+
+        self.n_paths = len(path_nodes)
+        self.shm = SharedMemory(create=True, size=max(sum(len(c) for c in columns), 1))
+        offset = 0
+        for c in columns:
+            self.shm.buf[offset:offset+len(c)] = c
+            offset += len(c)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __repr__(self):
+        return f'SharedPathTable({self.name}, {self.n_paths} paths)'
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    @classmethod
+    def attach(cls, name):
+        '''attach(cls, name)
+
+        Unpack the shared block into an `OptPathTable` of plain `OptNode`-s,
+        in a matching process.
+        '''
+        shm = SharedMemory(name)
+        try:
+            # no memoryview of the block is kept, to close it at the end
+            n_paths, n_nodes, n_children, names_len, values_len = cls._header.unpack_from(shm.buf)
+            offset = cls._header.size
+
+            def int_column(buf, n):
+                nonlocal offset
+                column = array('i')
+                column.frombytes(buf[offset:offset + n*column.itemsize])
+                offset += n*column.itemsize
+                return column
+
+            def text_column(buf, n):
+                nonlocal offset
+                text = bytes(buf[offset:offset+n])
+                offset += n
+                return text
+
+            path_nodes       = int_column(shm.buf, n_paths)
+            path_parents     = int_column(shm.buf, n_paths)
+            children_offsets = int_column(shm.buf, n_nodes + 1)
+            children         = int_column(shm.buf, n_children)
+            name_offsets     = int_column(shm.buf, n_nodes + 1)
+            value_offsets    = int_column(shm.buf, n_nodes + 1)
+            tags   = text_column(shm.buf, n_nodes).decode('ascii')
+            names  = text_column(shm.buf, names_len)
+            values = text_column(shm.buf, values_len)
+
+        finally:
+            shm.close()
+
+        # the garbage collector passes only slow down the many new nodes
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            nodes = []
+            for i in range(n_nodes):
+                name  = names[name_offsets[i]:name_offsets[i+1]].decode('utf-8', 'surrogatepass')
+                value = values[value_offsets[i]:value_offsets[i+1]].decode('utf-8', 'surrogatepass')
+                nodes.append(OptNode(name, _decode_value(tags[i], value)))
+
+            for i, node in enumerate(nodes):
+                if children_offsets[i] != children_offsets[i+1]:
+                    node.children = set(nodes[c] for c in children[children_offsets[i]:children_offsets[i+1]])
+
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+        return OptPathTable.from_columns([nodes[i] for i in path_nodes], list(path_parents))
+
+# the state of a matching process
+_shard_generation = None
+_shard_tables = {}
+
+def _init_match_shards(generation):
+    global _shard_generation
+    _shard_generation = generation
+
+def _match_shard(shm_name, selectors, start, end, generation):
+    '''_match_shard(shm_name, selectors, start, end, generation)
+
+    Match the paths from `start` to `end` of a `SharedPathTable`,
+    in a matching process. The ancestor paths before `start` are
+    matched on the way. Stops when the query generation changes.
+    Returns the matched path ids as int32 bytes.
+    '''
+    table = _shard_tables.get(shm_name)
+    if table is None:
+        # keep only the latest table
+        _shard_tables.clear()
+        table = _shard_tables[shm_name] = SharedPathTable.attach(shm_name)
+
+    cancelled = lambda: _shard_generation.value != generation
+    matched = array('i', _iter_match_range(table, compile_query(selectors).selectors, start, end, cancelled))
+    if cancelled():
+        return b''
+
+    return matched.tobytes()
+
+class ParallelMatcher:
+    '''ParallelMatcher(threshold=PARALLEL_MATCH_THRESHOLD, n_workers=None)
+
+    Matches the large tables in a pool of processes.
+    The table is shared once as a `SharedPathTable`, and each query only
+    sends the selectors and the ranges of path ids to match.
+    The tables smaller than `threshold` are matched in this process.
+    '''
+
+    def __init__(self, threshold=PARALLEL_MATCH_THRESHOLD, n_workers=None):
+        self.threshold = threshold
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self._pool = None
+        self._generation = None
+        self._shared = None
+        self._shared_table = None
+        self._shared_version = None
+
+    def __repr__(self):
+        return f'ParallelMatcher(threshold={self.threshold}, n_workers={self.n_workers})'
+
+    def _share(self, table, plan):
+        if self._pool is None:
+            # not fork, this process runs threads
+            mp_context = multiprocessing.get_context('spawn')
+            self._generation = mp_context.RawValue('q', 0)
+            self._pool = concurrent.futures.ProcessPoolExecutor(self.n_workers, mp_context=mp_context,
+                    initializer=_init_match_shards, initargs=(self._generation,))
+
+        # the shared table keeps the values too, but only the = and . selectors
+        # look at them, the name queries match the old values all right
+        values_stale = self._shared_version != OptNode.value_version
+        if self._shared_table is not table or (values_stale and plan.value_dependent):
+            if self._shared is not None:
+                self._shared.unlink()
+            self._shared_version = OptNode.value_version
+            self._shared = SharedPathTable(table)
+            self._shared_table = table
+
+    def iter_match(self, table, selectors, logger=None, cancel=None):
+        '''iter_match(self, table, selectors, logger=None, cancel=None)
+
+        Yields the matched path ids in the table order,
+        like `iter_match_opts_table`.
+        '''
+        plan = compile_query(selectors, logger)
+        if len(table) < self.threshold or self.n_workers < 2 or not plan.selectors:
+            yield from iter_match_opts_table(table, plan, logger, cancel=cancel)
+            return
+
+        self._share(table, plan)
+        self._generation.value += 1
+        generation = self._generation.value
+
+        # a few shards per process, to balance the load
+        n_shards = self.n_workers * 4
+        shard_len = -(-len(table) // n_shards)
+        # the processes compile the plan on their side
+        futures = [self._pool.submit(_match_shard, self._shared.name, plan.key,
+                                     start, min(start + shard_len, len(table)), generation)
+                   for start in range(0, len(table), shard_len)]
+
+        try:
+            # the shards are merged in their order
+            for future in futures:
+                while True:
+                    try:
+                        shard_matched = future.result(timeout=MATCHING_TIMEOUT/1000)
+                        break
+
+                    except concurrent.futures.TimeoutError:
+                        if cancel is not None and cancel.is_set():
+                            return
+
+                if cancel is not None and cancel.is_set():
+                    return
+
+                matched = array('i')
+                matched.frombytes(shard_matched)
+                yield from matched
+
+        finally:
+            # stop the shards of an abandoned query
+            if not all(future.done() for future in futures):
+                self._generation.value += 1
+                for future in futures:
+                    future.cancel()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+        if self._shared is not None:
+            self._shared.unlink()
+            self._shared = None
+            self._shared_table = None
+
+class MatchResult:
+    '''MatchResult(table, selectors, top_k=None, previous=None)
+
+    The matched path ids of one query, as they are streamed by `MatchWorker`.
+    The `path_ids` list only grows, until the matching is done or cancelled.
+    The highlights of the query are in `spans`, they are matched
+    only for the paths that get shown, see `highlight`.
+
+    top_k -- rank the fuzzy matches, then `path_ids` gets only
+             the `top_k` best ones, the best first, when the matching is done,
+             and `total` is the number of all matches
+    previous -- the done result of the same query on an older table
+                of the same tree, while the tree grows: if only new paths
+                were added since, only they get matched
+    '''
+
+    def __init__(self, table, selectors, top_k=None, previous=None):
+        self.table = table
+        self.selectors = list(selectors)
+        self.top_k = top_k
+        self.previous = previous
+        self.total = 0
+        self.value_version = OptNode.value_version
+        self.path_ids = []
+        self.error = None
+        self.cancelled = threading.Event()
+        self.finished  = threading.Event()
+        self.spans = MatchSpans()
+        self._highlighted = set() # the path ids with the spans
+
+    def __repr__(self):
+        return f'MatchResult({self.selectors}, {self.n_matched} matched, done={self.done})'
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+    @property
+    def n_matched(self):
+        return self.total if self.top_k is not None else len(self.path_ids)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    def highlight(self, path_ids):
+        '''highlight(self, path_ids)
+
+        Matches the paths that were not highlighted yet, to record
+        their highlights. Returns the `spans`.
+        '''
+        new_ids = sorted(set(path_ids) - self._highlighted)
+        if new_ids and self.top_k is not None:
+            for _ in iter_rank_opts_table(self.table, self.selectors, path_ids=new_ids, spans=self.spans):
+                pass
+            self._highlighted.update(new_ids)
+
+        elif new_ids:
+            match_opts_table(self.table, self.selectors, path_ids=new_ids, spans=self.spans)
+            self._highlighted.update(new_ids)
+
+        return self.spans
+
+class MatchWorker(threading.Thread):
+    '''MatchWorker(logger=None, parallel_threshold=None, notify=None)
+
+    The thread that runs the matching off the UI loop.
+    It takes only the latest submitted query: submitting a new one
+    cancels the previous one, and the stale queries are skipped.
+    It keeps the `MatchStack` of the table it matched last.
+
+    notify -- called from the thread when there are new matches to show,
+              like `UiLoop.redraw_soon`
+    '''
 
-        elif matched and not matched_self:
-            # matched something in child nodes
-            # the matching process stays at this node
-            yield from self._match_selectors(next_selectors, prev_nodes)
+    def __init__(self, logger=None, parallel_threshold=None, notify=None):
+        super().__init__(name='MatchWorker', daemon=True)
+        self.logger = logger
+        self.notify = notify
+        self._requests = queue.Queue()
+        self._current = None
+        self._stack = None
+        # the query the lazy trees expand the nodes for, and how many it got
+        self._expand_query = None
+        self._expanded = 0
+        # the tables with at least parallel_threshold paths
+        # are matched in a process pool
+        self._engine = None
+        if parallel_threshold is not None:
+            self._engine = ParallelMatcher(parallel_threshold)
+
+    def submit(self, table, selectors, top_k=None, previous=None):
+        '''submit(self, table, selectors, top_k=None, previous=None)
+
+        Cancels the current query and returns the `MatchResult` of the new one.
+        With `top_k`, the query is ranked, with `previous`, it continues
+        the previous result on the grown table, see `MatchResult`.
+        '''
+        if self._current is not None:
+            self._current.cancel()
 
-        else:
-            for c in self.children:
-                yield from c._match_selectors(next_selectors, prev_nodes + [self])
+        self._current = MatchResult(table, selectors, top_k, previous)
+        self._requests.put(self._current)
+        return self._current
 
-# match the flat list of options, not the graph
-def match_opts_list(prev_opts, selectors, remaining_opts):
-    #assert len(selectors) > 0
-    if len(selectors) == 0:
-        # the all selectors got mathed
-        return True # prev_opts + remaining_opts
+    def stop(self):
+        if self._current is not None:
+            self._current.cancel()
+        self._requests.put(None)
 
-    sel = selectors[0]
-    assert len(sel) > 0
+    def run(self):
+        while True:
+            result = self._requests.get()
+            if result is None:
+                if self._engine is not None:
+                    self._engine.close()
+                if self._stack is not None:
+                    self._stack.close()
+                return
+
+            # the old tables are not kept along the chain of the results
+            previous, result.previous = result.previous, None
+
+            if result.cancelled.is_set():
+                # a newer query is in the queue
+                result.finished.set()
+                continue
 
-    if len(remaining_opts) == 0:
-        # no match
-        return False # []
+            if previous is not None and self._match_grown(result, previous):
+                result.finished.set()
+                if self.notify is not None:
+                    self.notify()
+                self._expand_frontier(result)
+                continue
 
-    cur_node = remaining_opts[0]
+            if self._stack is None or self._stack.table is not result.table:
+                if self._stack is not None:
+                    self._stack.close()
+                self._stack = MatchStack(result.table, self.logger, self._engine)
 
-    # skip empty special selectors
-    #if sel[0] in ('>', '=', '.') and len(sel) == 1:
-    if all(ch in ('>', '=', '.') for ch in sel):
-        if logger is not None: # TODO: add a default logger
-            logger.warning(f'got an empty special selector: {sel}')
-        #selectors = selectors[1:]
-        #sel = selectors[0]
-        return match_opts_list(prev_opts, selectors[1:], remaining_opts)
+            try:
+                if result.top_k is not None:
+                    path_ids, total = rank_opts_table(result.table, result.selectors, result.top_k,
+                                                      self.logger, result.cancelled)
+                    if not result.cancelled.is_set():
+                        result.total = total
+                        result.path_ids.extend(path_ids)
 
-    matched = False
-    matched_self = False
-    if sel[0] == '>':
-        # children names
-        cnode_selector = sel[1:]
+                else:
+                    for path_id in self._stack.iter_match(result.selectors, result.cancelled):
+                        result.path_ids.append(path_id)
+                        # the first matches fill the screen, then the count goes up
+                        if self.notify is not None and len(result.path_ids) % MATCH_NOTIFY_EVERY == 1:
+                            self.notify()
+
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.exception(f'MatchWorker: failed to match {result.selectors}')
+                result.error = e
+
+            result.finished.set()
+            if self.notify is not None:
+                self.notify()
+            self._expand_frontier(result)
+
+    def _expand_frontier(self, result):
+        # the lazy trees fetch the nodes that the query needs,
+        # the query is matched again on the grown tree, and it goes on
+        if result.error is not None or result.cancelled.is_set():
+            return
 
-        for c in cur_node.children:
-            #yield from c.match_selectors([sel[0][1:]] + selectors[1:], prev_nodes + [self])
-            matched |= c.match_selector(cnode_selector)
+        # the budget is counted over the rounds of the same query
+        query = compile_query(result.selectors, self.logger).key
+        if query != self._expand_query:
+            self._expand_query, self._expanded = query, 0
 
-    else:
-        matched = matched_self = cur_node.match_selector(sel)
+        needed = []
+        for node in iter_query_frontier(result.table, result.selectors, self.logger, result.cancelled,
+                                        max(LAZY_EXPAND_BUDGET - self._expanded, 0)):
+            needed.append(node)
+            if len(needed) >= LAZY_EXPAND_LIMIT:
+                break
 
-    next_selectors = selectors[1:] if matched else selectors
-    #if len(next_selectors) == 0:
-    #    # done
-    #    #for opt in self.opt_list():
-    #    #    yield prev_nodes + opt
-    #    return 
+        self._expanded += len(needed)
+        expand_nodes(needed)
 
-    if matched and not matched_self:
-        # matched something in child nodes
-        # the matching process stays at this node
-        #yield from self._match_selectors(next_selectors, prev_nodes)
-        # basically repeat matching the current node
-        return match_opts_list(prev_opts, next_selectors, remaining_opts)
+    def _match_grown(self, result, previous):
+        # the previous matches are kept, only the new paths are matched,
+        # False if the table changed in other ways than growing
+        if compile_query(result.selectors, self.logger).tree_dependent:
+            return False
 
-    else:
-        # matched or no this node - check children
-        # first check if all is fine
-        # TODO: all this logic needs to be corrected, including at the beginning of the func
-        if len(next_selectors)==0:
-            # all matched
-            return True # prev_opts + remaining_opts
+        try:
+            grown = result.table.grown_from(previous.table)
+            if grown is None:
+                return False
 
-        # matched self, but more selectors remain -- need to check children
-        # no children nodes -- no match
-        if not cur_node.children:
-            return False # []
+            kept, new_ids = grown
+            path_ids = [kept[path_id] for path_id in previous.path_ids]
+            path_ids.extend(iter_match_opts_table(result.table, result.selectors, self.logger,
+                                                  new_ids, result.cancelled))
 
-        for c in cur_node.children:
-            #yield from c._match_selectors(next_selectors, prev_nodes + [self])
-            return match_opts_list(prev_opts+[cur_node], next_selectors, remaining_opts[1:])
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.exception(f'MatchWorker: failed to match {result.selectors} on the new paths')
+            result.error = e
+            return True
 
-    assert False
+        if not result.cancelled.is_set():
+            # in the table order
+            path_ids.sort()
+            result.path_ids.extend(path_ids)
+        return True
 
-def opt_tree(pydict, parent_nodes=set()):
-    '''OptTree(pydict):
+def opt_tree(pydict, parent_nodes=None, store=None):
+    '''OptTree(pydict, parent_nodes=None, store=None):
 
     Translation from a Python Mapping to a tree of `OptNode` option nodes.
     A node is a name, an optional value, and an optional mapping to child nodes.
@@ -422,19 +2672,28 @@ def opt_tree(pydict, parent_nodes=set()):
       i.e. with no child nodes
     * a key with value that is a mapping becomes an OptNode with no value
       but with children made out of the mapping
+
+    With an `OptTreeStore` in `store`, the nodes are added to it,
+    and the set of their `StoredOptNode` views is returned.
     '''
 
     if isinstance(pydict, OptNode):
         return set((pydict,))
 
+    if store is not None:
+        return set(store.node(i) for i in store.add_tree(pydict))
+
+    # each node gets its own set of parents
+    parent_nodes = parent_nodes or set()
+
     if isinstance(pydict, tuple):
         node_name, node_val = pydict
-        return set((OptNode(node_name, node_val, children=set(), parents=parent_nodes),))
+        return set((OptNode(node_name, node_val, children=set(), parents=set(parent_nodes)),))
 
     if not isinstance(pydict, Mapping):
         # it is just one value
         # we save it as the node name
-        return set((OptNode(pydict, value=None, children=set(), parents=parent_nodes),))
+        return set((OptNode(pydict, value=None, children=set(), parents=set(parent_nodes)),))
 
     # it is a Python mapping
     # i.e. a set of nodes
@@ -442,17 +2701,412 @@ def opt_tree(pydict, parent_nodes=set()):
     for k, v in pydict.items():
         if isinstance(k, tuple):
             name, val = k
-            nodes.add(OptNode(name, val, children=opt_tree(v), parents=parent_nodes))
+            nodes.add(OptNode(name, val, children=opt_tree(v), parents=set(parent_nodes)))
 
         # leaf in the Python dict
         elif not isinstance(v, Mapping):
-            nodes.add(OptNode(k, v, children=set(), parents=parent_nodes))
+            nodes.add(OptNode(k, v, children=set(), parents=set(parent_nodes)))
 
         else:
-            nodes.add(OptNode(k, None, children=opt_tree(v), parents=parent_nodes))
+            nodes.add(OptNode(k, None, children=opt_tree(v), parents=set(parent_nodes)))
 
     return nodes
 
+def _xml_name(tag):
+    # the tag or the attribute without its {namespace}, like in d:class
+    return tag.rpartition('}')[2]
+
+class XmlOptTree:
+    '''XmlOptTree(source, attributes=True)
+
+    The options of an XML file, like the Quasar Design.xml, streamed with
+    `ElementTree.iterparse` straight into an `OptTreeStore`:
+    * an element becomes a node, named by its `name` attribute or by its tag,
+      so the class and the device elements become the branches
+    * the node value is the `value` attribute, as the `type` attribute
+      if it is int or float, or the text of a leaf element
+    * with `attributes`, the other attributes become the leaf nodes under it
+
+    A node is attached when its element starts, and the element is cleared
+    when it ends: the parsed XML never piles up, only the option tree grows.
+
+    It iterates over the root nodes, like `MappedOptTree`, to pass it to the menu.
+    `load()` parses all the file, `start()` parses it in a background thread,
+    and the menu shows the tree while it grows: the parse sets `state`,
+    the menu shows `status`, `notify` is called when it changes,
+    like `UiLoop.redraw_soon`.
+    '''
+
+    def __init__(self, source, attributes=True):
+        self.source = source
+        self.attributes = attributes
+        self.store = OptTreeStore()
+        self._roots = []
+        self.error = None # why the parse failed
+        self.notify = None
+        self._state = None
+        self._events = None # the iterparse events, made at the first parse
+        self._stack = [] # the open elements, their node ids and if they have children
+
+    def __repr__(self):
+        return f'XmlOptTree({self.source!r}, {len(self.store)} nodes)'
+
+    def __len__(self):
+        return len(self._roots)
+
+    def __iter__(self):
+        return iter(self.roots())
+
+    def roots(self):
+        return [self.store.node(i) for i in self._roots]
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+        if self.notify is not None:
+            self.notify()
+
+    @property
+    def status(self):
+        if self.state is not None:
+            return f'{self.state}: {len(self.store)} nodes'
+        if self.error is not None:
+            return f'parse failed: {self.error}'
+        return ''
+
+    def _add_element(self, elem, parent):
+        attrib = {_xml_name(k): v for k, v in elem.attrib.items()}
+        name = attrib.pop('name', None) or _xml_name(elem.tag)
+        value = attrib.pop('value', None)
+        if value is not None and attrib.get('type') in ('int', 'float'):
+            try:
+                value = _SELECTOR_TYPES[attrib.pop('type')](value)
+            except ValueError:
+                pass
+
+        node_id = self.store.add(name, value, parent)
+        if self.attributes:
+            for attr_name, attr_value in attrib.items():
+                self.store.add(attr_name, attr_value, node_id)
+        return node_id
+
+    def _parse(self, until_root=False):
+        '''_parse(self, until_root=False)
+
+        Runs the parse on, or only till the first root node starts.
+        '''
+        if self._events is None:
+            self._events = ElementTree.iterparse(self.source, events=('start', 'end'))
+
+        stack = self._stack
+        for event, elem in self._events:
+            if event == 'start':
+                parent = -1
+                if stack:
+                    # the children are dropped when they end, remember them here
+                    stack[-1][2] = True
+                    parent = stack[-1][1]
+                node_id = self._add_element(elem, parent)
+                stack.append([elem, node_id, False])
+                if parent < 0:
+                    self._roots.append(node_id)
+                    if until_root:
+                        return
+                continue
+
+            elem, node_id, has_children = stack.pop()
+            text = elem.text.strip() if elem.text else ''
+            if text and not has_children and self.store.values[node_id] is None:
+                self.store.node(node_id).value = text
+
+            # the children are gone already, drop the element too
+            elem.clear()
+            if stack:
+                stack[-1][0].remove(elem)
+
+    def load(self):
+        '''load(self)
+
+        Parses all the file, returns self.
+        '''
+        self._parse()
+        return self
+
+    def start(self):
+        '''start(self)
+
+        Parses till the root node, for the menu to start on it,
+        and the rest in a background thread. Returns the thread,
+        or None if the file cannot be parsed at all, then `error` tells why.
+        '''
+        self.state = 'parsing'
+        try:
+            self._parse(until_root=True)
+        except (ElementTree.ParseError, OSError) as e:
+            # a missing, empty or broken file
+            self.error = e
+            self.state = None
+            return None
+
+        thread = threading.Thread(target=self._parse_on, name='XmlOptTree', daemon=True)
+        thread.start()
+        return thread
+
+    def _parse_on(self):
+        try:
+            self._parse()
+        except (ElementTree.ParseError, OSError) as e:
+            self.error = e
+        finally:
+            self.state = None
+
+OPT_TREE_MAGIC = b'OPTTREE1'
+
+_opt_tree_header = struct.Struct('<8s4q')
+
+def write_opt_tree(opts_graph, path):
+    '''write_opt_tree(opts_graph, path)
+
+    Save a forest of option nodes, or a Python mapping like `opt_tree` takes,
+    to a file that `MappedOptTree` opens.
+
+    The file is a header with the sizes, and then the columns, one row per
+    node in the order of the paths of `OptPathTable` (a node shared by
+    several paths gets a row per path): the int32 parent ids, subtree ends,
+    depths and name ids; the int64 offsets of the names and of the values;
+    the value type tags; and the string table of the distinct names and
+    the values, as utf-8 text. The values keep only their text and their
+    basic type, like in `SharedPathTable`.
+    '''
+    if isinstance(opts_graph, Mapping):
+        # no OptNode objects for the big mappings
+        opts_graph = opt_tree(opts_graph, store=OptTreeStore())
+
+    table = OptPathTable(opts_graph)
+
+    name_index = {}
+    names = []
+    name_ids = array('i')
+    values = []
+    tags = []
+    for node in table.nodes:
+        name_id = name_index.get(node.name)
+        if name_id is None:
+            name_id = name_index[node.name] = len(names)
+            names.append(node.name.encode('utf-8', 'surrogatepass'))
+        name_ids.append(name_id)
+
+        values.append(('' if node.value is None else str(node.value)).encode('utf-8', 'surrogatepass'))
+        tags.append(_VALUE_TAGS.get(type(node.value), 'o'))
+
+    name_offsets  = array('q', [0])
+    value_offsets = array('q', [0])
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+    for value in values:
+        value_offsets.append(value_offsets[-1] + len(value))
+
+    # the int32 columns take 4 bytes per node each, so the int64 ones stay aligned
+    columns = [_opt_tree_header.pack(OPT_TREE_MAGIC, len(table), len(names), name_offsets[-1], value_offsets[-1]),
+               array('i', table.parents), array('i', table.ends), array('i', table.depths), name_ids,
+               name_offsets, value_offsets, ''.join(tags).encode('ascii'), b''.join(names), b''.join(values)]
+
+    with open(path, 'wb') as tree_file:
+        for column in columns:
+            tree_file.write(column)
+
+class _MappedTexts:
+    # the strings of a text column, decoded on demand
+
+    def __init__(self, text, offsets):
+        self.text = text
+        self.offsets = offsets
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        decoded = self._decoded.get(i)
+        if decoded is None:
+            decoded = self._decoded[i] = bytes(self.text[self.offsets[i]:self.offsets[i+1]]).decode('utf-8', 'surrogatepass')
+        return decoded
+
+class _MappedValues:
+    # the value column, the new values are kept aside, the file is read-only
+
+    def __init__(self, texts, tags):
+        self.texts = texts
+        self.tags = tags
+        self.changed = {} # node id -> the new value
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getitem__(self, node_id):
+        if node_id in self.changed:
+            return self.changed[node_id]
+        return self.stored(node_id)
+
+    def stored(self, node_id):
+        # the value in the file, the texts are not cached, there are many distinct ones
+        return _decode_value(chr(self.tags[node_id]), bytes(
+            self.texts.text[self.texts.offsets[node_id]:self.texts.offsets[node_id+1]]).decode('utf-8', 'surrogatepass'))
+
+    def __setitem__(self, node_id, value):
+        self.changed[node_id] = value
+
+class _MappedNodes(Sequence):
+    # the node views of a mapped tree, made on demand
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.tree.parents)
+
+    def __getitem__(self, node_id):
+        if not 0 <= node_id < len(self.tree.parents):
+            raise IndexError(node_id)
+        return StoredOptNode(self.tree, node_id)
+
+class MappedOptTree:
+    '''MappedOptTree(path)
+
+    A read-only forest of options in a file written by `write_opt_tree`.
+    The file is opened with mmap, the columns are read in place,
+    so only the pages that the matching and the menu look at get loaded.
+    The nodes are `StoredOptNode` views, like of `OptTreeStore`,
+    they are made only when they are looked at.
+    The values can be set, but they are kept in memory, not in the file.
+
+    It iterates over its root nodes, so it is passed to `MenuProg`
+    as the options graph, and the menu gets its `OptPathTable`
+    straight from the columns.
+    '''
+
+    # the file trees are complete, nothing to expand
+    unexpanded = frozenset()
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as tree_file:
+            self._mmap = mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+
+        magic, n_nodes, n_names, names_len, values_len = _opt_tree_header.unpack_from(buf)
+        if magic != OPT_TREE_MAGIC:
+            raise ValueError(f'not an option tree file: {path}')
+
+        offset = _opt_tree_header.size
+        def column(fmt, n):
+            nonlocal offset
+            size = n * struct.calcsize(fmt)
+            column = buf[offset:offset+size].cast(fmt)
+            offset += size
+            return column
+
+        self.parents  = column('i', n_nodes)
+        self.ends     = column('i', n_nodes)
+        self.depths   = column('i', n_nodes)
+        self.name_ids = column('i', n_nodes)
+        name_offsets  = column('q', n_names + 1)
+        value_offsets = column('q', n_nodes + 1)
+        tags          = column('B', n_nodes)
+        self.names  = _MappedTexts(column('B', names_len), name_offsets)
+        self.values = _MappedValues(_MappedTexts(column('B', values_len), value_offsets), tags)
+
+        # the node views take it to read the children,
+        # though the structure never changes here
+        self.lock = threading.RLock()
+
+        # the roots follow each other's subtrees
+        self._roots = array('i')
+        root = 0
+        while root < n_nodes:
+            self._roots.append(root)
+            root = self.ends[root]
+
+    def __repr__(self):
+        return f'MappedOptTree({self.path!r}, {len(self.parents)} nodes, {len(self.names)} names)'
+
+    def __len__(self):
+        return len(self._roots)
+
+    def __iter__(self):
+        return iter(self.roots())
+
+    def children_ids(self, node_id):
+        # the children subtrees follow each other inside the node subtree
+        child = node_id + 1
+        while child < self.ends[node_id]:
+            yield child
+            child = self.ends[child]
+
+    def node(self, node_id):
+        return StoredOptNode(self, node_id)
+
+    def roots(self):
+        return [self.node(i) for i in self._roots]
+
+    def name_groups(self):
+        '''name_groups(self)
+
+        The names are interned in the file already, no node views are made.
+        returns: the list of the names, and the list of the node ids of each name
+        '''
+        names = [self.names[name_id] for name_id in range(len(self.names))]
+        name_nodes = [array('i') for _ in names]
+        for node_id, name_id in enumerate(self.name_ids):
+            name_nodes[name_id].append(node_id)
+        return names, name_nodes
+
+    def value_groups(self):
+        '''value_groups(self)
+
+        The value texts in the file are the str() of the values, but for None,
+        they are grouped as bytes and only the distinct ones are decoded.
+        returns: the dicts from str(value) and from type(value) to the node ids
+        '''
+        texts, tags = self.values.texts, self.values.tags
+        text, offsets = texts.text, texts.offsets
+        none_tag = ord(_VALUE_TAGS[type(None)])
+        by_text = {} # value text bytes -> node ids
+        by_tag  = {} # value tag -> node ids
+        for node_id, tag in enumerate(tags):
+            key = b'None' if tag == none_tag else bytes(text[offsets[node_id]:offsets[node_id+1]])
+            by_text.setdefault(key, set()).add(node_id)
+            by_tag.setdefault(tag, set()).add(node_id)
+
+        values = {key.decode('utf-8', 'surrogatepass'): node_ids for key, node_ids in by_text.items()}
+        types  = {_TAG_TYPES[chr(tag)]: node_ids for tag, node_ids in by_tag.items()}
+
+        # the values set in memory
+        for node_id, value in list(self.values.changed.items()):
+            stored = self.values.stored(node_id)
+            for groups, old_key, new_key in ((values, str(stored), str(value)), (types, type(stored), type(value))):
+                groups[old_key].discard(node_id)
+                if not groups[old_key]:
+                    del groups[old_key]
+                groups.setdefault(new_key, set()).add(node_id)
+        return values, types
+
+    def add(self, name, value=None, parent=-1):
+        raise TypeError('the mapped option trees are read-only')
+
+    def attach(self, node_id, parent):
+        raise TypeError('the mapped option trees are read-only')
+
+def _path_table(opts_graph):
+    # the mapped trees come with their table, the nodes are not walked
+    if isinstance(opts_graph, MappedOptTree):
+        return OptPathTable.from_mapped(opts_graph)
+    return OptPathTable(opts_graph)
+
 # demo nested structure
 some_nested_structure = {'some':
         {'nested': 2, 'struct': {'bar': 3, 'baz': 5}},
@@ -477,12 +3131,9 @@ some_nested_structure_nodes = opt_tree(some_nested_structure)
 
 test_patterns = 'oo >qwe ena'.split()
 test_matched_opts = []
-for node in some_nested_structure_nodes:
-    #
-    opts_lists = list(node.opt_list())
-    for opt_list in opts_lists:
-        if match_opts_list([], test_patterns, opt_list):
-            test_matched_opts.append(opt_list)
+for opt_list in OptPathTable(some_nested_structure_nodes).paths():
+    if match_opts_list([], test_patterns, opt_list):
+        test_matched_opts.append(opt_list)
 
 #for node in some_nested_structure_nodes:
 #    node.print_flat()
@@ -710,10 +3361,335 @@ class Comline:
         # if one of known keys
         return True
 
+class Viewport:
+    '''Viewport(prefetch=None)
+
+    The window of the matched options on the screen: the selection cursor
+    and the scroll offset that follows it. Only the options in the window,
+    plus a prefetch margin around it, are turned into lists of nodes,
+    so scrolling by a line or a page reuses them.
+
+    prefetch -- the margin in options, one window height by default
+    '''
+
+    def __init__(self, prefetch=None):
+        self.cursor = 0
+        self.offset = 0
+        self.height = 1
+        self.prefetch = prefetch
+
+        self._paths = {} # path id -> list of nodes
+        self._paths_table = None
+
+    def __repr__(self):
+        return f'Viewport(cursor={self.cursor}, offset={self.offset}, height={self.height})'
+
+    def clamp(self, n_matched):
+        if self.cursor >= n_matched:
+            self.cursor = n_matched - 1
+            # it will make the cursor negative when there are no matches
+
+        if self.cursor < 0 and n_matched > 0:
+            self.cursor = 0
+
+        # the window follows the cursor
+        if self.cursor < self.offset:
+            self.offset = self.cursor
+        elif self.cursor >= self.offset + self.height:
+            self.offset = self.cursor - self.height + 1
+
+        # and it stays full when the matches shrink
+        self.offset = max(min(self.offset, n_matched - self.height), 0)
+
+    def window(self, n_matched):
+        return self.offset, min(self.offset + self.height, n_matched)
+
+    def up(self):
+        if self.cursor > 0:
+            self.cursor -= 1
+
+    def down(self, n_matched):
+        if self.cursor < n_matched - 1:
+            self.cursor += 1
+
+    def page_up(self):
+        self.cursor = max(self.cursor - self.height, 0)
+        self.offset = max(self.offset - self.height, 0)
+
+    def page_down(self, n_matched):
+        self.cursor = min(self.cursor + self.height, n_matched - 1)
+        self.offset += self.height
+        self.clamp(n_matched)
+
+    def home(self):
+        self.cursor = 0
+
+    def end(self, n_matched):
+        self.cursor = n_matched - 1
+
+    def paths(self, table, path_ids, start, stop):
+        '''paths(self, table, path_ids, start, stop)
+
+        The lists of nodes of the options from `start` to `stop`.
+        The ones in the prefetch margin around them are kept for the next call.
+        '''
+        if table is not self._paths_table:
+            self._paths = {}
+            self._paths_table = table
+
+        margin = self.height if self.prefetch is None else self.prefetch
+        paths = {}
+        for i in range(max(start - margin, 0), min(stop + margin, len(path_ids))):
+            path_id = path_ids[i]
+            path = self._paths.get(path_id)
+            paths[path_id] = path if path is not None else table.path(path_id)
+
+        self._paths = paths
+        return [paths[path_ids[i]] for i in range(start, stop)]
+
+class ScreenFrame:
+    '''ScreenFrame(cscreen)
+
+    The programs draw a frame into it, with the same `addstr` and `move`
+    calls as to the curses screen. It keeps the lines of text with their
+    attributes, and `draw()` compares them to the frame on the screen:
+    only the changed lines are written, with one `doupdate`,
+    and nothing at all when the frame did not change.
+    The lines are clipped to the screen.
+    '''
+
+    def __init__(self, cscreen):
+        self.cscreen = cscreen
+        self.lines = []       # line number -> list of (text, attr)
+        self.cursor = (0, 0)
+        self._pos = (0, 0)    # where the next addstr with no coordinates goes
+        self._drawn = None    # the lines on the screen, None to redraw all
+        self._drawn_cursor = None
+
+    def __repr__(self):
+        return f'ScreenFrame({len(self.lines)} lines)'
+
+    def getmaxyx(self):
+        return self.cscreen.getmaxyx()
+
+    def erase(self):
+        '''start a new frame'''
+        self.lines = []
+        self._pos = (0, 0)
+
+    def invalidate(self):
+        '''the screen was drawn by something else, redraw all of it'''
+        self._drawn = None
+
+    def move(self, line_num, char_pos):
+        self.cursor = line_num, char_pos
+        self._pos = line_num, char_pos
+
+    def _write(self, line_num, char_pos, text, attr):
+        while len(self.lines) <= line_num:
+            self.lines.append([])
+
+        # like curses, the text covers only its own columns of the line,
+        # the line is padded to the position, and the rest after it is kept
+        head, tail = [], []
+        end = char_pos + len(text)
+        length = 0
+        for seg_text, seg_attr in self.lines[line_num]:
+            seg_end = length + len(seg_text)
+            if length < char_pos:
+                head.append((seg_text[:char_pos - length], seg_attr))
+            if seg_end > end:
+                tail.append((seg_text[max(end - length, 0):], seg_attr))
+            length = seg_end
+
+        if length < char_pos:
+            head.append((' ' * (char_pos - length), curses.A_NORMAL))
+
+        self.lines[line_num] = head + ([(text, attr)] if text else []) + tail
+        self._pos = line_num, end
+
+    def addstr(self, *args):
+        '''addstr(self, [line_num, char_pos,] text[, attr])'''
+        if len(args) >= 3:
+            line_num, char_pos, *args = args
+        else:
+            line_num, char_pos = self._pos
+
+        text, attr = args[0], args[1] if len(args) > 1 else curses.A_NORMAL
+        self._write(line_num, char_pos, text, attr)
+
+    def draw(self):
+        '''draw(self)
+
+        Write the changed lines to the screen. Returns True if anything changed.
+        '''
+        max_y, max_x = self.cscreen.getmaxyx()
+        lines = self.lines[:max_y]
+
+        drawn = self._drawn
+        if drawn is None:
+            self.cscreen.erase()
+            drawn = []
+
+        changed = self._drawn is None
+        for line_num in range(min(max(len(lines), len(drawn)), max_y)):
+            line = lines[line_num] if line_num < len(lines) else []
+            if line_num < len(drawn) and drawn[line_num] == line:
+                continue
+
+            changed = True
+            self.cscreen.move(line_num, 0)
+            self.cscreen.clrtoeol()
+            char_pos = 0
+            for text, attr in line:
+                if char_pos >= max_x:
+                    break
+
+                text = text[:max_x - char_pos]
+                try:
+                    self.cscreen.addstr(line_num, char_pos, text, attr)
+                except curses.error:
+                    # writing the bottom right corner moves the cursor out of the screen
+                    pass
+                char_pos += len(text)
+
+        self._drawn = lines
+
+        if changed or self.cursor != self._drawn_cursor:
+            line_num, char_pos = self.cursor
+            self.cscreen.move(min(line_num, max_y-1), min(char_pos, max_x-1))
+            self.cscreen.noutrefresh()
+            curses.doupdate()
+            self._drawn_cursor = self.cursor
+
+        return changed
+
 #
 # it is also a graph, of programs now
+# the background changes are redrawn at most once per frame, in ms
+FRAME_INTERVAL = 40
+# shown after the lazy tree nodes with the children not fetched yet
+UNEXPANDED_MARK = ' [+]'
+# shown before the options selected with TAB
+SELECTED_MARK = '*'
+# the number of the recent cursor nodes, the lazy trees prefetch their children
+RECENT_NODES = 8
+
+class UiLoop:
+    '''UiLoop(frame_interval=FRAME_INTERVAL)
+
+    The asyncio event loop of the curses programs, in the UI thread.
+    The programs get the keys with `next_key`: it runs the loop
+    till stdin is readable or a redraw is due. The matching worker,
+    the tree and value changes and the I/O threads request the redraws
+    with `redraw_soon`, from any thread, and they are coalesced
+    into one redraw per frame. Nothing wakes the loop up in between,
+    so the idle UI takes no CPU.
+    '''
+
+    def __init__(self, frame_interval=FRAME_INTERVAL):
+        self.frame_interval = frame_interval
+        self.loop = asyncio.new_event_loop()
+        self.fd = sys.stdin.fileno()
+        self._waiter = None
+        # a redraw is requested, and not drawn yet
+        self._redraw_requested = False
+        self._redraw_due = False
+        self._last_redraw = 0.
+        if hasattr(signal, 'SIGWINCH'):
+            self.loop.add_signal_handler(signal.SIGWINCH, self._resized)
+
+        OptNode.watch_values(self)
+        OptNode.watch_tree(self)
+
+    def value_changed(self, node, old_value, new_value):
+        self.redraw_soon()
+
+    def tree_changed(self):
+        self.redraw_soon()
+
+    def redraw_soon(self):
+        '''redraw_soon(self)
+
+        Request a redraw at the next frame. It is thread-safe.
+        '''
+        # the requests till the redraw get into it
+        if self._redraw_requested:
+            return
+
+        self._redraw_requested = True
+        try:
+            self.loop.call_soon_threadsafe(self._schedule_redraw)
+        except RuntimeError:
+            pass # the loop is closed, the UI is gone
+
+    def _schedule_redraw(self):
+        delay = self._last_redraw + self.frame_interval/1000 - time()
+        self.loop.call_later(max(delay, 0), self._redraw)
+
+    def _redraw(self):
+        self._redraw_due = True
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _resized(self):
+        # the loop took SIGWINCH from curses, so resize it here,
+        # curses puts KEY_RESIZE into the input then
+        size = os.get_terminal_size(self.fd)
+        curses.resizeterm(size.lines, size.columns)
+        self._wake()
+
+    def next_key(self, cscreen):
+        '''next_key(self, cscreen)
+
+        Returns the next key, or the null character when it is time to redraw.
+        '''
+        cscreen.nodelay(True)
+        while True:
+            # curses may have read more keys than it returned
+            try:
+                return cscreen.getkey()
+
+            except curses.error as e:
+                if str(e) != "no input":
+                    raise e
+
+            if self._redraw_due:
+                # the changes from now on request a new redraw
+                self._redraw_due = False
+                self._redraw_requested = False
+                self._last_redraw = time()
+                return '\0' # null character
+
+            self._waiter = self.loop.create_future()
+            self.loop.add_reader(self.fd, self._wake)
+            try:
+                self.loop.run_until_complete(self._waiter)
+            finally:
+                self.loop.remove_reader(self.fd)
+                self._waiter = None
+
+    def redraw_later(self, delay):
+        '''redraw_later(self, delay)
+
+        Request a redraw in `delay` seconds, from the UI thread.
+        '''
+        self.loop.call_later(delay, self.redraw_soon)
+
+    def close(self):
+        # no more requests into the closed loop
+        self._redraw_requested = True
+        OptNode.unwatch_values(self)
+        OptNode.unwatch_tree(self)
+        if hasattr(signal, 'SIGWINCH'):
+            self.loop.remove_signal_handler(signal.SIGWINCH)
+        self.loop.close()
+
 class MenuProg:
-    def __init__(self, next_prog=None):
+    def __init__(self, next_prog=None, timeout=-1, parallel_threshold=PARALLEL_MATCH_THRESHOLD, fuzzy=False, ui=None, status=None):
         #self.comline_prog = comline_prog
         #self.poling_prog  = poling_prog
         # the options graph
@@ -721,8 +3697,20 @@ class MenuProg:
         #self.next_prog  = next_prog
         #self.logger = logger
 
-        self.cur_select_cursor = 0
+        # the selection cursor and the scrolling among the matched options
+        self.viewport = Viewport()
         self.next_prog = next_prog
+        self.timeout = timeout # time to wait for character, -1 is blocking
+        # match the tables of this size in a process pool, None to never do it
+        self.parallel_threshold = parallel_threshold
+        # rank the fuzzy matches, ctrl-f toggles it
+        self.fuzzy = fuzzy
+        # the UiLoop to wait for the keys and the redraws,
+        # with None the screen is polled every timeout
+        self.ui = ui
+        # optional source of the `status` text, shown under the matches count,
+        # like the browse that grows the tree in the background
+        self.status = status
 
     def __call__(self, cscreen, opts_graph=set(), logger=None):
         logger.debug('MenuProg')
@@ -735,6 +3723,31 @@ class MenuProg:
 
         comline = Comline(prompt='> ')
 
+        # the flat table of all option paths
+        # it is rebuilt only when the tree changes
+        opts_table = _path_table(opts_graph)
+        # while the tree grows, the table is rebuilt once in a while,
+        # not on every change: the time of the next rebuild
+        table_due = 0.
+        rebuild_requested = False
+        # only the changes of the frames get drawn
+        frame = ScreenFrame(cscreen)
+
+        # the lazy trees prefetch around the recently visited nodes
+        recent_nodes = []
+        last_cursor_node = None
+
+        # the matching runs in the background
+        match_worker = MatchWorker(logger, self.parallel_threshold,
+                                   self.ui.redraw_soon if self.ui is not None else None)
+        match_worker.start()
+        match_result = None
+
+        # the options selected with TAB, as the tuples of their path nodes,
+        # so they stay selected when the query or the table changes
+        # the dict keeps them in the order they were selected
+        selected_opts = {}
+
         styleMatchedText = curses.color_pair( 1 )
         #curses.init_pair(1,curses.COLOR_BLACK, curses.COLOR_CYAN)
         styleNormalText = curses.A_NORMAL
@@ -742,7 +3755,18 @@ class MenuProg:
 
         cscreen.clear()
         while True:
-            cscreen.erase()
+            if opts_table.is_stale(opts_graph):
+                now = time()
+                if now >= table_due:
+                    opts_table = _path_table(opts_graph)
+                    table_due = time() + TABLE_REBUILD_FACTOR*(time() - now)
+                    rebuild_requested = False
+
+                elif self.ui is not None and not rebuild_requested:
+                    self.ui.redraw_later(table_due - now)
+                    rebuild_requested = True
+
+            frame.erase()
             # comline program?
             # process the input and print the comline?
             # the comline returns processes the input and returns itself
@@ -750,17 +3774,11 @@ class MenuProg:
             # screen, comline, and options -- and returns selected options? or more?
             # the action prog does something on the selected options and the rest
             # action program is a nested MenuProg
-            # clear the previous highlights:
-            for n in opts_graph:
-                n.clear_highlights()
 
             ## act on the user input as a set of substrings to find
             #patterns = comline.split()
             logger.debug('MenuProg: poll iteration')
 
-            # the set of selected option lists
-            selected_opts = set()
-
             # TODO: global implicit expected styling: pair 1
             styleMatchedText = curses.color_pair( 1 )
             #curses.init_pair(1,curses.COLOR_BLACK, curses.COLOR_CYAN)
@@ -770,105 +3788,164 @@ class MenuProg:
             __max_y, __max_x = cscreen.getmaxyx()
 
             k = " "
-            #cur_select_cursor = 0
+            viewport = self.viewport
 
             cur_line = 0
             # print the UI for the user
-            cscreen.addstr(cur_line, 0, f'UI info: ESC to exit, type to search & select, up-down-tab to cherry pick, ENTER to act on selection')
+            frame.addstr(cur_line, 0, f'UI info: ESC to exit, type to search & select, up-down-tab to cherry pick, PgUp-PgDn-ctrl-Home-End to scroll, ctrl-f fuzzy, ENTER to act on selection')
             cur_line += 1
 
             # print the command line
-            cur_line += comline.print_to_scr(cscreen, cur_line, debug=DEBUG)
+            cur_line += comline.print_to_scr(frame, cur_line, debug=DEBUG)
 
             logger.debug(f'{cur_line:2} 0 user char: {k} {len(k)} {ord(k[0])} {ord(k[0]) == KEY_ESC}')
             #if DEBUG:
 
             #    #if ord(k[0]) != 0:
-            #    #    cscreen.addstr(cur_line, 0, f'user char: {k} {len(k)} {ord(k[0])} {ord(k[0]) == KEY_ESC}')
+            #    #    frame.addstr(cur_line, 0, f'user char: {k} {len(k)} {ord(k[0])} {ord(k[0]) == KEY_ESC}')
             #    #else:
-            #    #    cscreen.addstr(cur_line, 0, f'user char: <null_character> {len(k)} {ord(k[0])} {ord(k[0]) == KEY_ESC}')
+            #    #    frame.addstr(cur_line, 0, f'user char: <null_character> {len(k)} {ord(k[0])} {ord(k[0]) == KEY_ESC}')
             #    #cur_line += 1
 
             # act on the user input as a set of substrings to find
-            patterns = comline.split()
+            # it is compiled into a plan once, the recent plans are cached
+            query_plan = compile_query(comline.comline, logger)
+            patterns = list(query_plan.key)
 
             # seave through the substrings
-            matched_opts = []
-            if patterns:
-                #for n in opts_graph:
-                #    for opt in n.match_selectors(patterns):
-                #        matched_opt_paths.append(opt)
-
-                for node in opts_graph:
-                    #
-                    opts_lists = list(node.opt_list())
-                    for opt_list in opts_lists:
-                        if match_opts_list([], patterns, opt_list):
-                            matched_opts.append(opt_list)
-
-                #logger.debug(f'matched opts {len(matched_opts)}') # TODO: for some reason asyncua messes this up
-
+            # matched_opts is a list of path ids in the table of the match_result
+            # with no patterns, it is all possible options
+            # the new query cancels the previous one,
+            # and the matches get streamed into the list while it runs
+            # or re-matched when the values change under the value selectors
+            # the fuzzy matches are ranked, only the best ones are kept:
+            # enough to fill the viewport, and more when it scrolls further
+            rows_needed = max(viewport.offset + viewport.height, viewport.cursor + 1)
+            ranked_enough = match_result is not None and (match_result.top_k is not None) == self.fuzzy and \
+                    (not self.fuzzy or match_result.top_k >= rows_needed or
+                     (match_result.done and match_result.total <= match_result.top_k))
+            # when only the table changed, the tree grew: the running matching
+            # is not restarted, and then only the new paths get matched
+            query_changed = match_result is None or match_result.selectors != patterns or not ranked_enough or \
+                    (match_result.value_version != OptNode.value_version and query_plan.value_dependent)
+            if query_changed or (match_result.table is not opts_table and match_result.done):
+                previous = None
+                if not query_changed and match_result.top_k is None and match_result.error is None:
+                    previous = match_result
+                match_result = match_worker.submit(opts_table, patterns, 2*rows_needed if self.fuzzy else None, previous)
+            shown_table = match_result.table
+
+            matching_done = match_result.done
+            matched_opts = match_result.path_ids
+            #logger.debug(f'matched opts {len(matched_opts)}') # TODO: for some reason asyncua messes this up
+
+            if match_result.error is not None:
+                frame.addstr(cur_line, 0, f'matching failed: {match_result.error!r}')
+            elif not matching_done and self.fuzzy:
+                frame.addstr(cur_line, 0, 'ranking…')
+            elif not matching_done:
+                frame.addstr(cur_line, 0, f'matching… {len(matched_opts)} so far')
             else:
-                #matched_opts = opts_graph
-                # just return all possible options
-                # flat list of option lists
-                for node in opts_graph:
-                    matched_opts += list(node.opt_list())
+                frame.addstr(cur_line, 0, f'{match_result.n_matched} matched' + (', fuzzy ranked' if self.fuzzy else ''))
+            if query_plan.warnings:
+                frame.addstr(' -- ' + '; '.join(query_plan.warnings))
+            cur_line += 1
 
-            if self.cur_select_cursor >= len(matched_opts):
-                self.cur_select_cursor = len(matched_opts) - 1
-                # it will make the cursor negative when there are no matches
+            status = self.status.status if self.status is not None else ''
+            if status:
+                frame.addstr(cur_line, 0, status)
+                cur_line += 1
 
-            if self.cur_select_cursor < 0 and len(matched_opts) > 0:
-                self.cur_select_cursor = 0
+            # redraw soon, while the matching is running
+            if self.ui is None:
+                cscreen.timeout(self.timeout if matching_done else MATCHING_TIMEOUT)
 
             line_offset = cur_line
-            for matched_o_num, matched_opt_list in enumerate(matched_opts):
+            # only the window of the matched options is drawn
+            # the ranked options may be fewer than the matched ones,
+            # till the bigger ranking is done
+            n_matched = match_result.n_matched
+            viewport.height = max(__max_y - line_offset, 1)
+            viewport.clamp(n_matched)
+            window_start, window_stop = viewport.window(n_matched)
+            window_stop = min(window_stop, len(matched_opts))
+            window_start = min(window_start, window_stop)
+            if line_offset >= __max_y:
+                window_stop = window_start
+
+            visible_opts = matched_opts[window_start:window_stop]
+            visible_paths = viewport.paths(shown_table, matched_opts, window_start, window_stop)
+
+            # the result sets may come from the stack, with no matching done now
+            # so, re-match only the visible options to get their highlights
+            spans = match_result.highlight(visible_opts)
+
+            for matched_o_num, matched_opt_list in enumerate(visible_paths):
                 # split into substrings
-                if line_offset + matched_o_num >= __max_y: # if it goes outside the screen
-                    break
-
-                if matched_o_num == self.cur_select_cursor:
-                    select_prompt = '> '
+                if window_start + matched_o_num == viewport.cursor:
+                    select_prompt = '>'
 
                 else:
-                    select_prompt = '  '
+                    select_prompt = ' '
 
-                # TODO: add the selected options
                 line_opt = styleNormalText
-                #if opt_num in selected_opts:
-                #    line_opt = styleSelectLine
+                if tuple(matched_opt_list) in selected_opts:
+                    select_prompt += SELECTED_MARK
+                    line_opt = styleSelectLine
+                else:
+                    select_prompt += ' '
 
                 # Print the matched options
-                cscreen.addstr(line_offset+matched_o_num, 0, select_prompt)
+                frame.addstr(line_offset+matched_o_num, 0, select_prompt)
 
                 for i, opt in enumerate(matched_opt_list):
                     if i != 0:
-                        cscreen.addstr(FIELD_SEPARATOR, line_opt | styleNormalText)
-                    opt.print_to_menu(cscreen, styleMatchedText, styleNormalText)
-
-            # Print selected options (debugging?)
-            for i, sel_opt_num in enumerate(selected_opts):
-                cscreen.addstr(cur_line+i, 0, opts[sel_opt_num])
-
-            comline.set_cursor(cscreen)
+                        frame.addstr(FIELD_SEPARATOR, line_opt | styleNormalText)
+                    opt.print_to_menu(frame, styleMatchedText, styleNormalText, spans=spans)
+
+                if not matched_opt_list[-1].expanded:
+                    frame.addstr(UNEXPANDED_MARK, styleNormalText)
+
+            # the lazy trees: the node at the cursor gets its children now,
+            # the visible ones and the children of the recent cursor nodes
+            # get prefetched in the background
+            cursor_i = viewport.cursor - window_start
+            if 0 <= cursor_i < len(visible_paths):
+                cursor_node = visible_paths[cursor_i][-1]
+                expand_nodes([cursor_node])
+                if cursor_node != last_cursor_node:
+                    last_cursor_node = cursor_node
+                    recent_nodes = [node for node in recent_nodes if node != cursor_node][-RECENT_NODES+1:] + [cursor_node]
+                    expand_nodes([child for node in recent_nodes for child in node.children], prefetch=True)
+            expand_nodes([path[-1] for path in visible_paths], prefetch=True)
+
+            comline.set_cursor(frame)
             #screen.move(0, len(prompt) + comline.cur_pos)
+            frame.draw()
 
-            try:
-                #logger.debug('MenuProg: getkey()') # TODO: for some reason, when asyncua works this prints to stdout instead of the logger file
-                k = cscreen.getkey() # get character or timeout
-                #logger.debug(f'MenuProg: getkey()={k}')
-
-            except curses.error as e:
-                # capture the timeout
-                if str(e) == "no input":
-                    logger.debug(f'MenuProg: getkey() no input')
+            if self.ui is not None:
+                # the matching and the background changes wake it up to redraw
+                k = self.ui.next_key(cscreen)
+                if k == '\0':
                     continue
 
-                else:
-                    raise e
+            else:
+                try:
+                    #logger.debug('MenuProg: getkey()') # TODO: for some reason, when asyncua works this prints to stdout instead of the logger file
+                    k = cscreen.getkey() # get character or timeout
+                    #logger.debug(f'MenuProg: getkey()={k}')
 
-            cscreen.refresh()
+                except curses.error as e:
+                    # capture the timeout
+                    if str(e) == "no input":
+                        logger.debug(f'MenuProg: getkey() no input')
+                        continue
+
+                    else:
+                        raise e
+
+            if k == "KEY_RESIZE":
+                frame.invalidate()
 
             if ord(k[0]) == KEY_ESC:
                 # Don't wait for another key
@@ -898,17 +3975,31 @@ class MenuProg:
 
             # up-down control the selection among the matched options
             elif k == "KEY_UP":
-                if self.cur_select_cursor > 0:
-                    self.cur_select_cursor -= 1
+                viewport.up()
             elif k == "KEY_DOWN":
-                if self.cur_select_cursor < len(matched_opts) - 1:
-                    self.cur_select_cursor += 1
+                viewport.down(n_matched)
+
+            # scroll the matched options
+            elif k == "KEY_PPAGE": # page up
+                viewport.page_up()
+            elif k == "KEY_NPAGE": # page down
+                viewport.page_down(n_matched)
+            elif k == "kHOM5": # ctrl-home
+                viewport.home()
+            elif k == "kEND5": # ctrl-end
+                viewport.end(n_matched)
+
+            elif ord(k[0]) == KEY_CTRLF:
+                self.fuzzy = not self.fuzzy
+                viewport.home()
 
             # capture ENTER to select and deselect options?
             # ENTER is bad, because it is on the same side of keyboard
             # as the arrow keys -- the same hand types everything
             # there should be a large key button on the left hand!
             elif ord(k[0]) == 10 and len(matched_opts) > 0 and self.next_prog is not None:
+                # act on all the matches
+                match_result.wait()
                 logger.debug(f'{cur_line:2} key ENTER passed: len(matched_opts)={len(matched_opts)} next_prog={self.next_prog}')
 
                 #if next_prog:
@@ -920,29 +4011,32 @@ class MenuProg:
                 #    # -- it is supposed to call it?
                 #    # then why return selected options at all?
 
-                for n in opts_graph:
-                    n.clear_highlights()
-
                 # launch the action menu
                 if selected_opts:
                     #action_prog(screen, [opts[i] for i in selected_opts])
-                    _ = self.next_prog(cscreen, [opts[i] for i in selected_opts], patterns, logger)
+                    _ = self.next_prog(cscreen, [list(path) for path in selected_opts], patterns, logger)
 
                 else: # act on all matched
+                    if match_result.top_k is not None:
+                        # only the best of them were kept by the ranking
+                        matched_opts = [path_id for path_id, _ in iter_rank_opts_table(shown_table, patterns, logger)]
                     #opt_to_act = [opts[i] for i, _ in matched_opts]
                     #action_prog(screen, [opts[i] for i in matched_opts])
-                    _ = self.next_prog(cscreen, [i for i in matched_opts], patterns, logger)
+                    _ = self.next_prog(cscreen, [shown_table.path(i) for i in matched_opts], patterns, logger)
                     logger.debug('MenuProg: next_prog for matched options')
 
+                # the next program drew its own screen
+                frame.invalidate()
+
             # ok, just use TAB to move to the action on the selected options
-            elif ord(k[0]) == 9 and len(matched_opts) > 0:
-                logger.debug(f'{cur_line:2} key TAB passed: matched_opts={matched_opts} cur_select_cursor={self.cur_select_cursor}')
+            elif ord(k[0]) == 9 and 0 <= viewport.cursor < len(matched_opts):
+                logger.debug(f'{cur_line:2} key TAB passed: matched_opts={matched_opts} cur_select_cursor={viewport.cursor}')
 
-                opt_num, _ = matched_opts[self.cur_select_cursor]
-                if opt_num in selected_opts:
-                    selected_opts.discard(opt_num)
+                path = tuple(shown_table.path(matched_opts[viewport.cursor]))
+                if path in selected_opts:
+                    del selected_opts[path]
                 else:
-                    selected_opts.add(opt_num)
+                    selected_opts[path] = None
 
             # comline edit has to be the last
             # because of "printable" option:
@@ -959,13 +4053,33 @@ class MenuProg:
             #logger.debug('MenuProg: iteration pause') # TODO: asyncua messes up the logging
             #cscreen.getch()
 
+        match_worker.stop()
         logger.debug('MenuProg: exit the UI loop')
 
 class StdMonitor:
-    def __init__(self, next_prog=None, timeout=1000, line_offset=20):
+    '''StdMonitor(next_prog=None, timeout=1000, line_offset=20, live_values=None, ui=None)
+
+    Shows the selected options, and passes them to `next_prog` on ENTER.
+    If `next_prog` returns a status per option, like the write results,
+    they are shown next to the options. It may return
+    a `concurrent.futures.Future` of them, then they are shown when they come.
+
+    timeout     -- redraw every this many ms, with no `ui`
+    live_values -- optional source of the live values of the options,
+                   like `OpcLiveValues`: it has start(opts_lists), stop(),
+                   the `changed` threading.Event and the `status` text;
+                   the changes are redrawn once per FRAME_INTERVAL,
+                   however many values change in it
+    ui          -- the `UiLoop` to wait for the keys and the redraws,
+                   then it redraws only when something changes
+    '''
+
+    def __init__(self, next_prog=None, timeout=1000, line_offset=20, live_values=None, ui=None):
         self.next_prog = next_prog
         self.timeout = timeout
         self.line_offset = line_offset
+        self.live_values = live_values
+        self.ui = ui
 
     def __call__(self, cscreen, opts_list=[], enter_str='', logger=None):
         logger.debug('StdMonitor')
@@ -976,10 +4090,41 @@ class StdMonitor:
                 logger.debug('StdMonitor was called with no options')
             return
 
+        if self.live_values is None:
+            return self._monitor(cscreen, opts_list, logger)
+
+        self.live_values.start(opts_list)
+        try:
+            return self._monitor(cscreen, opts_list, logger)
+        finally:
+            self.live_values.stop()
+
+    def _next_key(self, cscreen):
+        # the next key, or the null character when it is time to redraw:
+        # every `timeout` ms, or at the next frame if the live values changed
+        if self.ui is not None:
+            # the live values request the redraws themselves, as the value changes
+            return self.ui.next_key(cscreen)
+
+        deadline = time() + self.timeout/1000
+        # time to wait for character, the ESC handling and the next programs change it
+        cscreen.timeout(self.timeout if self.live_values is None else FRAME_INTERVAL)
+        while True:
+            try:
+                return cscreen.getkey() # get character or timeout
+
+            except curses.error as e:
+                # capture the timeout
+                if str(e) != "no input":
+                    raise e
+
+            if self.live_values is None or self.live_values.changed.is_set() or time() >= deadline:
+                return '\0' # null character
+
+    def _monitor(self, cscreen, opts_list, logger):
         comline = Comline(prompt='> ')
 
         cscreen.clear()
-        cscreen.timeout(self.timeout) # time to wait for character
 
         styleMatchedText = curses.color_pair( 1 )
         #curses.init_pair(1,curses.COLOR_BLACK, curses.COLOR_CYAN)
@@ -988,23 +4133,43 @@ class StdMonitor:
 
         cscreen.clear()
 
+        # only the changes of the frames get drawn
+        frame = ScreenFrame(cscreen)
+
         prompt = "> "
         k = " "
+        # the statuses that the next program returned, one per option
+        statuses = None
+        # or the future of them
+        pending = None
         while True:
             logger.debug('StdMonitor: poll iteration')
-            cscreen.erase()
-
-            cscreen.addstr(0, 0, f'UI info: ESC to go back, type and ENTER to write to all selected options, it reads every {self.timeout}ms')
-            #cscreen.addstr(0, 0, f'{prompt}{comline}')
-            comline.print_to_scr(cscreen, 1, debug=DEBUG)
-            cscreen.addstr(2, 0, ' '*(len(prompt) + comline.cur_pos) + "^")
-            cscreen.addstr(3, 0, 'just printing the selected options, and no action on ENTER')
-            #cscreen.addstr(4, 0, f'writing: {action_writing_output}')
-            cscreen.addstr(5, 0, f'{time()}')
-            cscreen.addstr(6, 0, f'{len(opts_list)}')
+            frame.erase()
+            if pending is not None and pending.done():
+                statuses = self._statuses(pending.result(), opts_list)
+                pending = None
+            if self.live_values is not None:
+                # the changes after this get into the next frame
+                self.live_values.changed.clear()
+
+            frame.addstr(0, 0, f'UI info: ESC to go back, type and ENTER to write to all selected options, it reads every {self.timeout}ms')
+            #frame.addstr(0, 0, f'{prompt}{comline}')
+            comline.print_to_scr(frame, 1, debug=DEBUG)
+            frame.addstr(2, 0, ' '*(len(prompt) + comline.cur_pos) + "^")
+            frame.addstr(3, 0, 'just printing the selected options, and no action on ENTER')
+            #frame.addstr(4, 0, f'writing: {action_writing_output}')
+            if self.live_values is not None:
+                frame.addstr(4, 0, self.live_values.status)
+            frame.addstr(5, 0, f'{time()}')
+            frame.addstr(6, 0, f'{len(opts_list)}')
+            if pending is not None:
+                frame.addstr(7, 0, f'the last ENTER: waiting for {len(opts_list)} results')
+            elif statuses is not None:
+                n_good = sum(status == 'Good' for status in statuses)
+                frame.addstr(7, 0, f'the last ENTER: {n_good} Good, {len(statuses) - n_good} not')
 
             #cscreen.move(0, len(prompt) + comline.cur_pos)
-            comline.set_cursor(cscreen)
+            comline.set_cursor(frame)
 
             #action_polling(cscreen, opts_list)
 
@@ -1020,24 +4185,20 @@ class StdMonitor:
 
                 for opt_i, opt in enumerate(opt_list):
                     if opt_i != 0:
-                        cscreen.addstr(FIELD_SEPARATOR, line_opt | styleNormalText)
-                        opt.print_to_menu(cscreen, styleNormalText, styleNormalText)
+                        frame.addstr(FIELD_SEPARATOR, line_opt | styleNormalText)
+                        opt.print_to_menu(frame, styleNormalText, styleNormalText)
 
                     else:
-                        opt.print_to_menu(cscreen, styleNormalText, styleNormalText, (self.line_offset+i, 0))
+                        opt.print_to_menu(frame, styleNormalText, styleNormalText, (self.line_offset+i, 0))
 
-            # draw the cscreen and getkey
-            cscreen.refresh()
-            try:
-                k = cscreen.getkey() # get character or timeout
+                if statuses is not None:
+                    frame.addstr(f'  [{statuses[i]}]', styleNormalText)
 
-            except curses.error as e:
-                # capture the timeout
-                if str(e) == "no input":
-                    k = '\0' # null character
-                    continue
-                else:
-                    raise e
+            # draw the cscreen and getkey
+            frame.draw()
+            k = self._next_key(cscreen)
+            if k == '\0':
+                continue
 
             # if ENTER - action_writing
             # else: ESC to go back
@@ -1075,12 +4236,36 @@ class StdMonitor:
             elif ord(k[0]) == 10 and self.next_prog is not None:
                 # launch the write action
                 #action_writing_output = action_writing(cscreen, options, str(comline))
-                self.next_prog(cscreen, opts_list, str(comline), logger)
+                results = self.next_prog(cscreen, opts_list, str(comline), logger)
+                if isinstance(results, concurrent.futures.Future):
+                    if self.ui is None:
+                        results = results.result()
+
+                    else:
+                        # typing goes on, the results redraw the screen when they come
+                        pending = results
+                        pending.add_done_callback(lambda _: self.ui.redraw_soon())
+                        results = statuses = None
+
+                if results is not None:
+                    statuses = self._statuses(results, opts_list)
+                frame.invalidate()
+
+            elif k == "KEY_RESIZE":
+                frame.invalidate()
 
             elif comline.edit_key(k):
                 pass # if the comline knows how to processes this key
 
-def curses_setup(opts_graphs=some_nested_structure_nodes, menu_filter_classes=(), logger=None):
+    @staticmethod
+    def _statuses(results, opts_list):
+        if isinstance(results, (list, tuple)) and len(results) == len(opts_list):
+            return results
+
+def curses_setup(opts_graphs=some_nested_structure_nodes, menu_filter_classes=(), logger=None, menu_timeout=-1, ui_loop=True, status=None):
+    # with ui_loop, the programs wait for the keys and the redraws in one UiLoop,
+    # otherwise the menu polls the screen every menu_timeout
+    # the status text of the optional status object is shown in the menu
 
     def curses_prog(curses_screen):
         curses.start_color()
@@ -1094,14 +4279,24 @@ def curses_setup(opts_graphs=some_nested_structure_nodes, menu_filter_classes=()
         #m.opts = opts_graphs
         #m(curses_screen)
 
+        ui = UiLoop() if ui_loop else None
+        if ui is not None and hasattr(status, 'notify'):
+            status.notify = ui.redraw_soon
+
         prog_pipe = None
         for menu_filter in reversed(menu_filter_classes):
             menu_filter.next_prog = prog_pipe
+            if hasattr(menu_filter, 'ui'):
+                menu_filter.ui = ui
             prog_pipe = menu_filter
 
         #m = MenuProg(StdMonitor())
-        m = MenuProg(prog_pipe)
-        m(curses_screen, opts_graphs, logger)
+        m = MenuProg(prog_pipe, menu_timeout, ui=ui, status=status)
+        try:
+            m(curses_screen, opts_graphs, logger)
+        finally:
+            if ui is not None:
+                ui.close()
 
     print(logger.handlers)
     return curses_prog
@@ -1115,11 +4310,43 @@ if __name__ == "__main__":
     #logger.setLevel(logging.INFO)
     logger.setLevel(logging.ERROR)
 
+    opc_io = None
+    status = None
     if '--demo' in argv:
         print('running the demo')
         opts = some_nested_structure_nodes
         menu_filters = (StdMonitor(),)
 
+    elif '--convert' in argv:
+        # a JSON mapping or an XML file into the option tree file, for --tree
+        import json
+        json_path, tree_path = argv[argv.index('--convert')+1:argv.index('--convert')+3]
+        if json_path.endswith('.xml'):
+            try:
+                write_opt_tree(XmlOptTree(json_path).load(), tree_path)
+            except (ElementTree.ParseError, OSError) as e:
+                print(f'cannot convert {json_path}: {e}')
+                exit(1)
+        else:
+            with open(json_path) as json_file:
+                write_opt_tree(json.load(json_file), tree_path)
+        print(f'saved {MappedOptTree(tree_path)}')
+        exit(0)
+
+    elif '--tree' in argv:
+        opts = MappedOptTree(argv[argv.index('--tree')+1])
+        print(f'opened {opts}')
+        menu_filters = (StdMonitor(),)
+
+    elif '--xml' in argv:
+        # the menu is on while the file is parsed, the tree grows in it
+        opts = XmlOptTree(argv[argv.index('--xml')+1])
+        if opts.start() is None:
+            print(f'cannot parse {opts.source}: {opts.error}')
+            exit(1)
+        status = opts
+        menu_filters = (StdMonitor(),)
+
     else:
         import argparse
         parser = argparse.ArgumentParser(
@@ -1128,6 +4355,11 @@ if __name__ == "__main__":
             epilog = """Example:
    python3 curses_menu.py -u localhost:48010 -l0 -d 3 -n "ns=2;s=Can01"
    python3 curses_menu.py -u localhost:4841  -l0 -d 3 -n "ns=2;s=pp2"
+   python3 curses_menu.py -u localhost:4841 -n "ns=2;s=pp2" --save-tree pp2.optree
+   python3 curses_menu.py -u localhost:4841 -n "ns=2;s=pp2" --lazy
+   python3 curses_menu.py --convert config.json config.optree
+   python3 curses_menu.py --tree pp2.optree
+   python3 curses_menu.py --xml Design.xml
 
 Beware, uasync won't work on Python 3.6, it needs 3.9 or higher. Check python --version.
 """
@@ -1135,13 +4367,35 @@ Beware, uasync won't work on Python 3.6, it needs 3.9 or higher. Check python --
 
         # the asyncua example
         import asyncio
-        from get_opcua_datapoints import _uals, OpcWriteOptions
-
+        # get_opcua_datapoints imports this module: it must get this one,
+        # not a second copy with its own OptNode and tree versions
+        sys.modules.setdefault('curses_menu', sys.modules[__name__])
+        from get_opcua_datapoints import _uals, OpcWriteOptions, OpcLiveValues, OpcClientThread
+
+        # the OPC UA client lives in the loop of its I/O thread,
+        # the browse, the writes and the subscriptions run there,
+        # while the menu is on: the tree and the values show up as they come
+        opc_io = OpcClientThread()
         #opts = await _uals()
-        opts_node, opc_client = asyncio.run(_uals(parser))
+        snapshot, opc_client = opc_io.run(_uals(parser, background=True, opc_io=opc_io))
+        opc_io.client = opc_client
         print(f'opc_client: {opc_client}')
-        opts = {opts_node}
-        menu_filters = (StdMonitor(), OpcWriteOptions(opc_client))
+        opts = {snapshot.root}
+        # the menu shows how the browse goes
+        status = snapshot
+        # _uals has added all the OPC UA arguments
+        args = parser.parse_args()
+        # the writes and the subscriptions use the node ids the browse got
+        live_values = OpcLiveValues(opc_io, args.publishing_interval, args.queue_size, node_ids=snapshot.node_ids)
+        menu_filters = (StdMonitor(live_values=live_values),
+                        OpcWriteOptions(opc_io, chunk_size=args.write_chunk, concurrency=args.concurrency, wait=False,
+                                        node_ids=snapshot.node_ids))
+        # the background clients log on stderr, over the menu, send the logs to the file
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+        root_logger.addHandler(hdlr)
+        logger.propagate = False
 
         #for node in opts:
         #    #node.print_flat(' > ')
@@ -1157,5 +4411,8 @@ Beware, uasync won't work on Python 3.6, it needs 3.9 or higher. Check python --
 
         #exit(0)
 
-    wrapper(curses_setup(opts, menu_filters, logger))
+    wrapper(curses_setup(opts, menu_filters, logger, status=status))
+
+    if opc_io is not None:
+        opc_io.close()
 
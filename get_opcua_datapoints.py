@@ -1,9 +1,14 @@
 import asyncio
 from asyncua import ua
 from asyncua import Node, Client #, Server
+from asyncua.common.ua_utils import value_to_datavalue
 from asyncua.tools import add_minimum_args, add_common_args, parse_args, _configure_client_with_args, get_node, _lsprint_0, _lsprint_1, _lsprint_long
-import sys, concurrent
-from curses_menu import OptNode
+import sys, os, concurrent
+import time
+import hashlib
+import json
+import threading
+from curses_menu import OptTreeStore, write_opt_tree, _VALUE_TAGS, _decode_value
 
 #add_minimum_args(parser)
 
@@ -23,61 +28,602 @@ def print_node_description(desc):
     #return desc.NodeId.to_string()
     return desc.to_string()
 
-async def act_on_node(parent_node, parent_node_opt, prefix=''):
-    #
-    for child_node in await parent_node.get_children():
-        #print(type(child_node))
-        #
+# the number of the browse requests in flight at once
+BROWSE_CONCURRENCY = 32
+# the lazy browse leaves these nodes to expand at the depth limit,
+# the Variable leaves are not marked
+EXPANDABLE_NODE_CLASSES = (ua.NodeClass.Object, ua.NodeClass.View)
 
-        #if desc.NodeClass == ua.NodeClass.Variable:
-        #    try:
-        #        val = await Node(node.session, desc.NodeId).read_value()
-        #    except UaStatusCodeError as err:
-        #        val = "Bad (0x{0:x})".format(err.code)
+class BrowseProgress:
+    '''BrowseProgress(report_every=1.0, out=None)
 
-        #res_list.append(print_node_description(desc))
+    Counts the browsed nodes, and prints how many nodes per second
+    get browsed, every `report_every` seconds.
+    '''
+
+    def __init__(self, report_every=1.0, out=None):
+        self.nodes = 0
+        self.report_every = report_every
+        self.out = out if out is not None else sys.stdout
+        self.start = self._last_report = time.monotonic()
+
+    def __repr__(self):
+        return f'BrowseProgress({self.nodes} nodes, {self.rate:.0f} nodes/s)'
+
+    @property
+    def rate(self):
+        return self.nodes / max(time.monotonic() - self.start, 1e-6)
+
+    def add(self, n_nodes):
+        self.nodes += n_nodes
+        now = time.monotonic()
+        if now - self._last_report >= self.report_every:
+            self._last_report = now
+            self.report()
+
+    def report(self, end='\r'):
+        print(f'browsed {self.nodes} nodes, {self.rate:.0f} nodes/s', end=end, file=self.out, flush=True)
+
+async def _limited(limit, request):
+    # at most the semaphore value of requests wait for the server at once
+    async with limit:
+        return await request
+
+async def _server_chunk_size(client, limit_id, chunk_size):
+    # the chunk size within an operation limit of the server
+    try:
+        max_nodes = await client.get_node(ua.NodeId(limit_id)).read_value()
+
+    except ua.UaError:
+        # the server does not tell its limits
+        return chunk_size
+
+    # 0 means no limit
+    return min(chunk_size, max_nodes) if max_nodes else chunk_size
+
+# the number of the values read in one Read request, by default
+READ_CHUNK_SIZE = 1000
+
+class BatchValueReader:
+    '''BatchValueReader(chunk_size=READ_CHUNK_SIZE)
+
+    Collects the leaf nodes during the browse, and then reads their values
+    in chunks, one Read request per chunk, instead of one per node.
+    The values are set to the option nodes of the leaves.
+    The chunks are not bigger than the server MaxNodesPerRead limit.
+    '''
+
+    def __init__(self, chunk_size=READ_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.leaves = [] # (OPC UA node, option node)
+
+    def __repr__(self):
+        return f'BatchValueReader({len(self.leaves)} leaves, chunk_size={self.chunk_size})'
+
+    def add(self, node, opt):
+        self.leaves.append((node, opt))
+
+    async def server_chunk_size(self, client):
+        '''server_chunk_size(self, client)
+
+        The chunk size within the MaxNodesPerRead operation limit of the server.
+        '''
+        return await _server_chunk_size(client, ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerRead,
+                                        self.chunk_size)
+
+    async def _read_chunk(self, client, chunk, limit):
+        data_values = await _limited(limit, client.read_attributes([node for node, _ in chunk], ua.AttributeIds.Value))
+        for (node, opt), data_value in zip(chunk, data_values):
+            # a bad value is None, like a failed read of one node
+            good = data_value.StatusCode is None or data_value.StatusCode.is_good()
+            value = data_value.Value.Value if good and data_value.Value is not None else None
+            # the same values are not set again, on a refresh,
+            # so the cached matches of the value selectors stay valid
+            if value != opt.value or type(value) is not type(opt.value):
+                opt.value = value
+
+    async def read_all(self, client, limit=None):
+        '''read_all(self, client, limit=None)
+
+        Read the values of all the collected leaves, the chunks concurrently.
+
+        limit -- optional `asyncio.Semaphore`, the limit of the requests in flight
+        '''
+        if limit is None:
+            limit = asyncio.Semaphore(BROWSE_CONCURRENCY)
+
+        chunk_size = await self.server_chunk_size(client)
+        leaves, self.leaves = self.leaves, []
+        await asyncio.gather(*(self._read_chunk(client, leaves[start:start+chunk_size], limit)
+                               for start in range(0, len(leaves), chunk_size)))
+
+async def _read_value(node, limit):
+    try:
+        #attr = await child_node.read_attribute(ua.AttributeIds.Value)
+        return await _limited(limit, node.read_value())
+
+    #except Exception as e:
+    except ua.uaerrors._auto.BadCommunicationError as e:
+        #print(f'Error reading value of OPC node {child_node}', e)
+        return None
+
+def _node_session(node):
+    # newer asyncua and Python have session,
+    # older, Python 3.6 (which is deprecated and unsafe since a few years already) has server
+    if hasattr(node, 'session'):
+        return node.session
+    elif hasattr(node, 'server'):
+        return node.server
+    else:
+        raise Exception('unknown version of asyncua')
+
+def _node_opt_name(node_id):
+    # the option name is the last part of the dotted node id
+    return node_id.split('.')[-1]
+
+async def act_on_node(parent_node, parent_node_opt, prefix='', limit=None, progress=None, reader=None,
+                      depth=None, node_classes=ua.NodeClass.Unspecified, refs=ua.ObjectIds.HierarchicalReferences,
+                      node_ids=None, unexpanded=None):
+    '''act_on_node(parent_node, parent_node_opt, prefix='', limit=None, progress=None, reader=None,
+                   depth=None, node_classes=ua.NodeClass.Unspecified, refs=ua.ObjectIds.HierarchicalReferences,
+                   node_ids=None, unexpanded=None)
+
+    Browse the subtree of the OPC UA node into the option node.
+    Each node is browsed once: the references come with the node class,
+    and the Variable nodes get their values.
+    The sibling subtrees are browsed concurrently, in asyncio tasks.
+    The child options are added in the order of the browse,
+    so the tree is the same as with one request at a time.
+
+    limit    -- optional `asyncio.Semaphore`, the limit of the requests in flight,
+                BROWSE_CONCURRENCY by default
+    progress -- optional `BrowseProgress`, to count the browsed nodes
+    reader   -- optional `BatchValueReader`, to collect the Variable nodes
+                and read their values later, in batches
+    depth    -- optional number of the levels to browse, all of them by default
+    node_classes -- the mask of the node classes to browse, the server filters them
+    refs     -- the reference type to browse, with its subtypes
+    node_ids -- optional dict, to record the OPC UA node id strings of the option nodes
+    unexpanded -- optional list, to collect the option nodes at the depth limit,
+                  that were not browsed, of the EXPANDABLE_NODE_CLASSES
+    '''
+    if depth is not None and depth <= 0:
+        if unexpanded is not None:
+            unexpanded.append(parent_node_opt)
+        return
+
+    if limit is None:
+        limit = asyncio.Semaphore(BROWSE_CONCURRENCY)
+
+    session = _node_session(parent_node)
+
+    # one browse request gives the children and their node classes
+    descs = await _limited(limit, parent_node.get_children_descriptions(refs, node_classes))
+    child_nodes = [Node(session, desc.NodeId) for desc in descs]
+    is_variable = [desc.NodeClass == ua.NodeClass.Variable for desc in descs]
+
+    values = [None] * len(child_nodes)
+    if reader is None:
+        values = await asyncio.gather(*(_read_value(child_node, limit) if variable else asyncio.sleep(0)
+                                        for child_node, variable in zip(child_nodes, is_variable)))
+
+    new_opts = []
+    for child_node, variable, value in zip(child_nodes, is_variable, values):
         #desc = await child_node.read_description()
         #full_name = print_node_description(desc)
         full_name = child_node.nodeid.to_string()
-        #
-
-        # check if that's a leaf node
-        next_children_nodes = await child_node.get_children()
-        value = None
-        #print(next_children_nodes)
-        if not next_children_nodes:
-            # this is a leaf node, save its value etc
-            try:
-                #attr = await child_node.read_attribute(ua.AttributeIds.Value)
-                value = await child_node.read_value()
+        name = _node_opt_name(full_name)
+        new_opt = parent_node_opt.new_child(name, value)
+        new_opts.append(new_opt)
+        if node_ids is not None:
+            node_ids[new_opt] = full_name
+        #print(prefix + name + f' : {new_opt}')
 
-            #except Exception as e:
-            except ua.uaerrors._auto.BadCommunicationError as e:
-                #print(f'Error reading value of OPC node {child_node}', e)
-                value = None
+        if variable and reader is not None:
+            reader.add(child_node, new_opt)
 
-        name = full_name.split('.')[-1]
-        new_opt = OptNode(name, value, set(), {parent_node_opt})
+    if progress is not None:
+        progress.add(len(new_opts))
 
-        parent_node_opt.children.add(new_opt)
+    # and recurse into the child nodes
+    child_depth = depth - 1 if depth is not None else None
+    if child_depth is not None and child_depth <= 0:
+        # the depth limit, only the nodes that can have children are left to expand
+        if unexpanded is not None:
+            unexpanded.extend(new_opt for new_opt, desc in zip(new_opts, descs)
+                              if desc.NodeClass in EXPANDABLE_NODE_CLASSES)
+        return
 
-        #print(prefix + name + f' : {new_opt}')
+    await asyncio.gather(*(act_on_node(child_node, new_opt, prefix+'-', limit, progress, reader,
+                                       child_depth, node_classes, refs, node_ids, unexpanded)
+                           for child_node, new_opt in zip(child_nodes, new_opts)))
+
+# the browse snapshots are saved here by default
+SNAPSHOT_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'curses_menu')
+# bump it when the snapshot contents change
+SNAPSHOT_FORMAT = 2
+
+class BrowseSnapshot:
+    '''BrowseSnapshot(url, root_nodeid, options=(), snapshot_dir=SNAPSHOT_DIR)
+
+    The browsed tree of an OPC UA server, with the node ids of its option
+    nodes, saved on disk by the endpoint URL and the root node id.
+    The file is plain JSON data: the names, the parents, the node ids,
+    and the values as their text and type tag, like in `write_opt_tree`.
+    It is loaded at once at the start, and `refresh` browses the server
+    again and patches the tree in place: only the nodes with changed
+    children get relinked, only the new subtrees get built, and only
+    the changed values get set, so the indexes follow them as usual.
+
+    options -- the browse options, the snapshot is good only for the same ones
+
+    The browse in the background sets `state`, and the menu shows `status`,
+    `notify` is called when it changes, like `UiLoop.redraw_soon`.
+    '''
+
+    def __init__(self, url, root_nodeid, options=(), snapshot_dir=SNAPSHOT_DIR):
+        self.url = url
+        self.root_nodeid = root_nodeid
+        self.options = tuple(options)
+        self.snapshot_dir = snapshot_dir
+        # the server trees are large, keep them in the compact store
+        self.store = OptTreeStore()
+        self.root = self.store.node(self.store.add(root_nodeid))
+        self.node_ids = {self.root: root_nodeid} # option node -> OPC UA node id string
+        self.error = None # why the last refresh failed
+        self.notify = None
+        self._state = None # what runs in the background: browsing, refreshing...
+
+    def __repr__(self):
+        return f'BrowseSnapshot({self.root_nodeid!r}, {len(self.node_ids)} nodes)'
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+        if self.notify is not None:
+            self.notify()
+
+    @property
+    def status(self):
+        if self.state is not None:
+            return f'{self.state}: {len(self.node_ids)} nodes'
+        if self.error is not None:
+            return f'browse failed: {self.error}'
+        return ''
+
+    @property
+    def key(self):
+        # the URL may have the password, it is not saved as it is
+        return hashlib.sha1(f'{self.url}\n{self.root_nodeid}'.encode()).hexdigest()
+
+    @property
+    def path(self):
+        return os.path.join(self.snapshot_dir, self.key + '.json')
+
+    @classmethod
+    def load(cls, url, root_nodeid, options=(), snapshot_dir=SNAPSHOT_DIR):
+        '''load(cls, url, root_nodeid, options=(), snapshot_dir=SNAPSHOT_DIR)
+
+        Returns the saved snapshot, or None if there is none
+        or it was saved with other browse options.
+        '''
+        snapshot = cls(url, root_nodeid, options, snapshot_dir)
+        try:
+            with open(snapshot.path, 'r', encoding='utf-8') as snapshot_file:
+                saved = json.load(snapshot_file)
+
+        except (OSError, ValueError):
+            return None
+
+        # the options are saved as a JSON list
+        if not isinstance(saved, dict) or saved.get('format') != SNAPSHOT_FORMAT or \
+                (saved.get('key'), saved.get('options')) != (snapshot.key, list(snapshot.options)):
+            return None
+
+        # a broken or stale file is browsed again, like a missing one
+        try:
+            names, tags, values = saved['names'], saved['tags'], saved['values']
+            parents, saved_node_ids = saved['parents'], saved['node_ids']
+            if not len(names) == len(tags) == len(values) == len(parents) == len(saved_node_ids) > 0:
+                return None
+
+            # the nodes are saved in the depth-first order,
+            # so they get the same ids in the new store
+            store = OptTreeStore()
+            for name, tag, value, parent, node_id in zip(names, tags, values, parents, saved_node_ids):
+                # only the plain data is taken
+                if not (isinstance(name, str) and isinstance(value, str) and isinstance(node_id, str) and
+                        type(parent) is int and -1 <= parent < len(store) and
+                        (tag == 'o' or tag in _VALUE_TAGS.values())):
+                    return None
+                store.add(name, _decode_value(tag, value), parent)
+
+            node_ids = {store.node(i): node_id for i, node_id in enumerate(saved_node_ids)}
+
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        snapshot.store = store
+        snapshot.root = store.node(0)
+        snapshot.node_ids = node_ids
+        return snapshot
+
+    def save(self):
+        '''save(self)
+
+        Writes the tree to the snapshot file, without the detached nodes.
+        Returns False if it could not be saved.
+        '''
+        names, tags, values, node_ids, parents = [], [], [], [], []
+        stack = [(self.root, -1)]
+        while stack:
+            opt, parent = stack.pop()
+            names.append(opt.name)
+            # the values are kept as their text and their basic type,
+            # the other types come back as text, and the refresh reads them again
+            tags.append(_VALUE_TAGS.get(type(opt.value), 'o'))
+            values.append(str(opt.value))
+            node_ids.append(self.node_ids[opt])
+            parents.append(parent)
+            stack.extend((child, len(names)-1) for child in reversed(opt.children))
+
+        saved = {'format': SNAPSHOT_FORMAT, 'key': self.key, 'options': list(self.options),
+                 'names': names, 'tags': tags, 'values': values, 'node_ids': node_ids, 'parents': parents}
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as snapshot_file:
+                json.dump(saved, snapshot_file)
+            # a crash in the middle does not leave a broken snapshot
+            os.replace(tmp_path, self.path)
+
+        except (OSError, TypeError, ValueError):
+            return False
+
+        return True
+
+    async def refresh(self, client, root_node, limit=None, reader=None, depth=None,
+                      node_classes=ua.NodeClass.Unspecified, refs=ua.ObjectIds.HierarchicalReferences):
+        '''refresh(self, client, root_node, limit=None, reader=None, depth=None,
+                   node_classes=ua.NodeClass.Unspecified, refs=ua.ObjectIds.HierarchicalReferences)
+
+        Browse the server again, and patch the tree in place.
+        The options are like in `act_on_node`.
+        '''
+        if limit is None:
+            limit = asyncio.Semaphore(BROWSE_CONCURRENCY)
+        if reader is None:
+            reader = BatchValueReader()
+
+        await self._refresh_node(root_node, self.root, limit, reader, depth, node_classes, refs)
+        await reader.read_all(client, limit)
+
+    async def _refresh_node(self, node, opt, limit, reader, depth, node_classes, refs):
+        if depth is not None and depth <= 0:
+            return
+
+        session = _node_session(node)
+        descs = await _limited(limit, node.get_children_descriptions(refs, node_classes))
+
+        old_children = opt.children
+        # the same node may be referenced more than once
+        known = {}
+        for child_opt in old_children:
+            known.setdefault(self.node_ids[child_opt], []).append(child_opt)
+
+        children = []
+        new_subtrees = []
+        old_subtrees = []
+        for desc in descs:
+            child_node = Node(session, desc.NodeId)
+            node_id = desc.NodeId.to_string()
+            same_opts = known.get(node_id)
+            if same_opts:
+                child_opt = same_opts.pop(0)
+                old_subtrees.append((child_node, child_opt))
+            else:
+                # a new root, it gets in the tree when its subtree is browsed
+                child_opt = self.store.node(self.store.add(_node_opt_name(node_id)))
+                self.node_ids[child_opt] = node_id
+                new_subtrees.append((child_node, child_opt))
+
+            if desc.NodeClass == ua.NodeClass.Variable:
+                reader.add(child_node, child_opt)
+            children.append(child_opt)
+
+        child_depth = depth - 1 if depth is not None else None
+        await asyncio.gather(*(act_on_node(child_node, child_opt, limit=limit, reader=reader, depth=child_depth,
+                                           node_classes=node_classes, refs=refs, node_ids=self.node_ids)
+                               for child_node, child_opt in new_subtrees),
+                             *(self._refresh_node(child_node, child_opt, limit, reader, child_depth, node_classes, refs)
+                               for child_node, child_opt in old_subtrees))
+
+        if children != list(old_children):
+            self.store.set_children(opt.node_id, [child_opt.node_id for child_opt in children])
+
+            # the gone children are dropped with their subtrees, not kept as roots
+            kept = set(children)
+            for child_opt in old_children:
+                if child_opt not in kept:
+                    for node_id in self.store.drop(child_opt.node_id):
+                        self.node_ids.pop(self.store.node(node_id), None)
+
+async def _new_client(args):
+    # a client of its own, with its own session
+    client = Client(args.url, timeout=args.timeout)
+    await _configure_client_with_args(client, args)
+    return client
+
+# the loop keeps only weak references to the tasks
+_background_tasks = set()
+
+async def _refresh_snapshot(snapshot, args, **browse_options):
+    # it has its own client and session,
+    # so the requests of the menu do not queue behind the long browse
+    client = await _new_client(args)
+
+    snapshot.state = 'refreshing'
+    try:
+        async with client:
+            node = await get_node(client, args)
+            await snapshot.refresh(client, node, asyncio.Semaphore(args.concurrency),
+                                   BatchValueReader(args.read_chunk), **browse_options)
+
+    except (OSError, concurrent.futures.TimeoutError, ua.UaError) as e:
+        # the menu keeps the loaded snapshot
+        snapshot.error = e
+        return
+
+    finally:
+        snapshot.state = None
+
+    snapshot.save()
+
+async def _browse_snapshot(snapshot, args, **browse_options):
+    # the first browse, while the menu is on already:
+    # the nodes show up in the menu as they are browsed
+    client = await _new_client(args)
+
+    snapshot.state = 'browsing'
+    try:
+        async with client:
+            node = await get_node(client, args)
+            limit = asyncio.Semaphore(args.concurrency)
+            reader = BatchValueReader(args.read_chunk)
+            await act_on_node(node, snapshot.root, limit=limit, reader=reader,
+                              node_ids=snapshot.node_ids, **browse_options)
+            snapshot.state = 'reading the values'
+            await reader.read_all(client, limit)
+
+    except (OSError, concurrent.futures.TimeoutError, ua.UaError) as e:
+        # the menu keeps what was browsed
+        snapshot.error = e
+        return
+
+    finally:
+        snapshot.state = None
+
+    if not args.no_snapshot:
+        snapshot.save()
+    if args.save_tree:
+        write_opt_tree({snapshot.root}, args.save_tree)
+
+# at most this many prefetched nodes get expanded at once, in the lazy browse,
+# the node at the cursor and the ones the query needs are not limited
+LAZY_PREFETCH = 16
+
+class LazyBrowse:
+    '''LazyBrowse(snapshot, opc_io, depth=1, concurrency=BROWSE_CONCURRENCY, read_chunk=READ_CHUNK_SIZE, **browse_options)
+
+    The lazy browse of the snapshot tree: the option nodes get their
+    children from the server only when the menu asks for them,
+    with `OptTreeStore.expand`, `depth` levels at a time.
+    The nodes with the children not browsed yet are marked
+    in `OptTreeStore.unexpanded`.
+    The browse requests run in the session of the `OpcClientThread` `opc_io`.
+
+    browse_options -- node_classes and refs, like in `act_on_node`
+    '''
+
+    def __init__(self, snapshot, opc_io, depth=1, concurrency=BROWSE_CONCURRENCY, read_chunk=READ_CHUNK_SIZE, **browse_options):
+        self.snapshot = snapshot
+        self.opc_io = opc_io
+        self.depth = depth
+        self.concurrency = concurrency
+        self.read_chunk = read_chunk
+        self.browse_options = browse_options
+        self._lock = threading.Lock()
+        self._pending = set() # the node ids being expanded
+        self._prefetching = 0
+        self._limit = None # the semaphore is made in the loop
+        snapshot.store.expander = self.expand
+
+    def __repr__(self):
+        return f'LazyBrowse({len(self._pending)} expanding, {len(self.snapshot.store.unexpanded)} not expanded)'
+
+    def expand(self, node_ids, prefetch=False):
+        '''expand(self, node_ids, prefetch=False)
+
+        Browse the children of the nodes, in the background.
+        The nodes that are being expanded already are skipped,
+        and the prefetch ones when LAZY_PREFETCH of them are in flight.
+        '''
+        with self._lock:
+            node_ids = [node_id for node_id in node_ids if node_id not in self._pending]
+            if prefetch:
+                node_ids = node_ids[:max(LAZY_PREFETCH - self._prefetching, 0)]
+                self._prefetching += len(node_ids)
+            self._pending.update(node_ids)
+
+        if not node_ids:
+            return
+
+        self.snapshot.state = 'expanding'
+        request = self.opc_io.submit(self._expand, node_ids)
+        request.add_done_callback(lambda request: self._expanded(request, node_ids, prefetch))
+
+    def _expanded(self, request, node_ids, prefetch):
+        with self._lock:
+            self._pending.difference_update(node_ids)
+            if prefetch:
+                self._prefetching -= len(node_ids)
+            pending = bool(self._pending)
+
+        if not request.cancelled() and request.exception() is not None:
+            # the nodes stay not expanded, they are asked for again
+            self.snapshot.error = request.exception()
+        self.snapshot.state = 'expanding' if pending else None
+
+    async def _expand(self, client, node_ids):
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.concurrency)
+
+        reader = BatchValueReader(self.read_chunk)
+        await asyncio.gather(*(self._expand_node(client, self.snapshot.store.node(node_id), reader)
+                               for node_id in node_ids))
+        await reader.read_all(client, self._limit)
+
+    async def _expand_node(self, client, opt, reader):
+        store = self.snapshot.store
+        if opt.expanded:
+            return # the request was sent again, after the session was lost
+
+        unexpanded = []
+        node = client.get_node(self.snapshot.node_ids[opt])
+        await act_on_node(node, opt, limit=self._limit, reader=reader, depth=self.depth,
+                          node_ids=self.snapshot.node_ids, unexpanded=unexpanded, **self.browse_options)
+        store.mark_expanded(opt.node_id, [child.node_id for child in unexpanded])
 
-        # and recurse into the child nodes
-        if hasattr(parent_node, 'session'): # newer asyncua and Python
-            #await act_on_node(Node(parent_node.session, desc.NodeId), new_opt, prefix+'-')
-            await act_on_node(child_node, new_opt, prefix+'-')
-        elif hasattr(parent_node, 'server'): # older, Python 3.6 (which is deprecated and unsafe since a few years already)
-            #await act_on_node(Node(parent_node.server,  desc.NodeId), new_opt, prefix+'-')
-            await act_on_node(child_node, new_opt, prefix+'-')
-        else:
-            raise Exception('unknown version of asyncua')
+def _run_in_background(coro):
+    # it runs on, in the loop of the client, if the loop runs on after this
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
-async def _uals(parser) -> set:
-    '''_uals(parser)
+def _node_class_mask(names):
+    '''_node_class_mask(names)
+
+    The NodeClass mask of the node class names, like Object and Variable.
+    '''
+    mask = ua.NodeClass.Unspecified
+    for name in names or ():
+        mask |= ua.NodeClass[name]
+    return mask
+
+async def _uals(parser, background=False, opc_io=None) -> set:
+    '''_uals(parser, background=False, opc_io=None)
 
     parser: argparse.ArgumentParser
-    returns: a list of strings with full DP names
+    background: return at once, and browse into the root node
+                in the background, in the running loop
+    opc_io: the `OpcClientThread` of the running loop, with --lazy
+            the nodes are browsed in its session when the menu needs them
+    returns: the `BrowseSnapshot`, with the root option node
+             and the node ids of the options, and the client
     '''
 
     #parser = argparse.ArgumentParser(description="Browse OPC-UA node and print result")
@@ -85,17 +631,87 @@ async def _uals(parser) -> set:
     parser.add_argument(
         "-l", dest="long_format", const=3, nargs="?", type=int, help="use a long listing format"
     )
-    parser.add_argument("-d", "--depth", default=1, type=int, help="Browse depth")
+    parser.add_argument("-d", "--depth", default=0, type=int, help="Browse depth, 0 for the whole tree")
+    parser.add_argument("-j", "--concurrency", default=BROWSE_CONCURRENCY, type=int,
+                        help=f"The number of the browse, read and write requests in flight at once, {BROWSE_CONCURRENCY} by default")
+    parser.add_argument("--read-chunk", default=READ_CHUNK_SIZE, type=int,
+                        help=f"The number of the values read in one request, {READ_CHUNK_SIZE} by default, "
+                              "or less if the server limits it")
+    parser.add_argument("--node-class", action="append", choices=[c.name for c in ua.NodeClass if c.value],
+                        help="Browse only the nodes of this class, can be repeated, e.g. --node-class Object --node-class Variable")
+    parser.add_argument("--refs", default="HierarchicalReferences",
+                        help="Browse only this reference type and its subtypes, e.g. Organizes or HasComponent, "
+                             "HierarchicalReferences by default")
+    parser.add_argument("--snapshot-dir", default=SNAPSHOT_DIR,
+                        help=f"Where the browsed trees are saved, to start with them next time, {SNAPSHOT_DIR} by default")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="Do not start with the saved tree, browse it again, and do not save it")
+    parser.add_argument("--write-chunk", default=WRITE_CHUNK_SIZE, type=int,
+                        help=f"The number of the values written in one request, {WRITE_CHUNK_SIZE} by default, "
+                              "or less if the server limits it")
+    parser.add_argument("--save-tree", metavar="FILE",
+                        help="Save the browsed tree to the option tree file, to open it later with --tree")
+    parser.add_argument("--publishing-interval", default=PUBLISHING_INTERVAL, type=float,
+                        help=f"The publishing interval of the live values in the monitor, in ms, {PUBLISHING_INTERVAL} by default")
+    parser.add_argument("--queue-size", default=MONITOR_QUEUE_SIZE, type=int,
+                        help=f"The server queue size of a monitored value, {MONITOR_QUEUE_SIZE} by default")
+    parser.add_argument("--lazy", action="store_true",
+                        help="Browse the nodes only when the menu needs them, -d levels at a time, 1 by default; "
+                             "the partial tree is not saved in the snapshot")
 
     args = parse_args(parser)
     if args.long_format is None:
         args.long_format = 1
 
+    refs = getattr(ua.ObjectIds, args.refs, None)
+    if not isinstance(refs, int):
+        parser.error(f'unknown reference type: {args.refs}')
+
     client = Client(args.url, timeout=args.timeout)
     await _configure_client_with_args(client, args)
 
+    browse_options = dict(depth=args.depth if args.depth > 0 else None,
+                          node_classes=_node_class_mask(args.node_class),
+                          refs=refs)
+    # the snapshot is only good for the same browse
+    snapshot_options = (args.path, args.depth, int(browse_options['node_classes']), refs)
+
+    if args.lazy and background and opc_io is not None:
+        # the root gets expanded at once, the rest when the menu asks
+        snapshot = BrowseSnapshot(args.url, args.nodeid, snapshot_options, args.snapshot_dir)
+        opc_io.client = client
+        lazy = LazyBrowse(snapshot, opc_io, browse_options['depth'] or 1, args.concurrency, args.read_chunk,
+                          node_classes=browse_options['node_classes'], refs=refs)
+        snapshot.store.unexpanded.add(snapshot.root.node_id)
+        lazy.expand([snapshot.root.node_id])
+        print(f"Browsing {args.nodeid} at {args.url} lazily\n")
+        return snapshot, client
+
+    if not args.no_snapshot:
+        snapshot = BrowseSnapshot.load(args.url, args.nodeid, snapshot_options, args.snapshot_dir)
+        if snapshot is not None:
+            if args.save_tree:
+                write_opt_tree({snapshot.root}, args.save_tree)
+
+            if not background:
+                # no loop runs on after this, the task would be cancelled at once
+                print(f"Loaded {snapshot} from {snapshot.path}, refreshing it\n")
+                await _refresh_snapshot(snapshot, args, **browse_options)
+                return snapshot, client
+
+            # start with the saved tree, it gets patched in the background
+            print(f"Loaded {snapshot} from {snapshot.path}, refreshing it in the background\n")
+            _run_in_background(_refresh_snapshot(snapshot, args, **browse_options))
+            return snapshot, client
+
     #all_the_dps = []
-    opt_graph = OptNode(args.nodeid, None, set(), set())
+    snapshot = BrowseSnapshot(args.url, args.nodeid, snapshot_options, args.snapshot_dir)
+    opt_graph = snapshot.root
+
+    if background:
+        print(f"Browsing {args.nodeid} at {args.url} in the background\n")
+        _run_in_background(_browse_snapshot(snapshot, args, **browse_options))
+        return snapshot, client
 
     try:
         async with client:
@@ -116,7 +732,14 @@ async def _uals(parser) -> set:
 
             # the problem is that all of this is done under async routines
             # so, the browsing recursion must be an async def
-            await act_on_node(node, opt_graph)
+            progress = BrowseProgress()
+            limit = asyncio.Semaphore(args.concurrency)
+            # the leaf values are read after the browse, in batches
+            reader = BatchValueReader(args.read_chunk)
+            await act_on_node(node, opt_graph, limit=limit, progress=progress, reader=reader,
+                              node_ids=snapshot.node_ids, **browse_options)
+            progress.report(end='\n')
+            await reader.read_all(client, limit)
 
     except (OSError, concurrent.futures.TimeoutError) as e:
         print(e)
@@ -124,56 +747,389 @@ async def _uals(parser) -> set:
         sys.exit(1)
     #sys.exit(0)
 
-    return opt_graph, client
+    if not args.no_snapshot:
+        snapshot.save()
+    if args.save_tree:
+        write_opt_tree({opt_graph}, args.save_tree)
 
-async def write_opc(client, opts_lists, enter_value, logger=None):
-    node_fullname = None
-    try:
-        async with client:
-            for opt_list in opts_lists:
-                node_fullname = '.'.join(n.name for n in opt_list)
-                #node = await get_node(client, node_fullname)
-                node = client.get_node(node_fullname)
-                print(f"Browsing node {node}")
-                #await act_on_node(node, opt_graph)
-                if enter_value in ("true", "True", "false", "False"):
-                    value = enter_value in ("true", "True")
-                else:
-                    value = enter_value
-
-                await node.write_value(value)
+    return snapshot, client
 
-    except (OSError, concurrent.futures.TimeoutError) as e:
-        print(e)
-        print(f"node {node_fullname}")
-        client.disconnect()
-        sys.exit(1)
+# the number of the values written in one Write request, by default
+WRITE_CHUNK_SIZE = 1000
 
-    except Exception as e:
-        #print(e)
+def _convert_value(enter_value, value_type):
+    '''_convert_value(enter_value, value_type)
 
-        #import pdb
-        #pdb.set_trace()
+    The entered text as a value of the type of the current node value.
+    With no known type, true and false are bools, and the rest is text.
+    Raises ValueError if the text is not of the type.
+    '''
+    if value_type is bool:
+        if enter_value not in ("true", "True", "false", "False"):
+            raise ValueError(enter_value)
+        return enter_value in ("true", "True")
 
-        raise Exception(f"node {node_fullname} client {client}") from e
-        client.disconnect()
-        sys,exit(2)
-    #sys.exit(0)
+    if value_type in (int, float, str):
+        return value_type(enter_value)
+
+    if enter_value in ("true", "True", "false", "False"):
+        return enter_value in ("true", "True")
+    return enter_value
+
+def _opt_node_id(opt_list, node_ids=None):
+    # the OPC UA node id of the option path, the one the browse recorded,
+    # or the path of the names, for the trees without the recorded ids
+    if node_ids is not None:
+        return node_ids.get(opt_list[-1])
+    return '.'.join(n.name for n in opt_list)
+
+async def write_opc(client, opts_lists, enter_value, logger=None, chunk_size=WRITE_CHUNK_SIZE, limit=None, node_ids=None):
+    '''write_opc(client, opts_lists, enter_value, logger=None, chunk_size=WRITE_CHUNK_SIZE, limit=None, node_ids=None)
+
+    Write the entered value to the nodes of the option paths, in chunks,
+    one Write request per chunk, the chunks concurrently, in the session
+    of the connected client. The chunks are not bigger than the server
+    MaxNodesPerWrite limit. The text is converted once per type
+    of the current values, not per node.
+    Returns the list of the status names, one per path.
+
+    limit -- optional `asyncio.Semaphore`, the limit of the requests in flight
+    node_ids -- optional dict of the OPC UA node id strings of the option nodes,
+                like `BrowseSnapshot.node_ids`, otherwise the node ids
+                are the option paths joined with dots
+    '''
+    if limit is None:
+        limit = asyncio.Semaphore(BROWSE_CONCURRENCY)
+
+    statuses = [None] * len(opts_lists)
+    data_values = {} # value type -> DataValue, or None if the text is not of the type
+    to_write = [] # (path index, node, DataValue)
+    for i, opt_list in enumerate(opts_lists):
+        value_type = type(opt_list[-1].value)
+        if value_type not in data_values:
+            try:
+                data_values[value_type] = value_to_datavalue(_convert_value(enter_value, value_type))
+            except ValueError:
+                data_values[value_type] = None
+
+        if data_values[value_type] is None:
+            statuses[i] = f'not {value_type.__name__}'
+            continue
+
+        node_fullname = _opt_node_id(opt_list, node_ids)
+        if node_fullname is None:
+            if logger is not None:
+                logger.debug(f'write_opc: no node id for {".".join(n.name for n in opt_list)}')
+            statuses[i] = 'no node id'
+            continue
+        try:
+            node = client.get_node(node_fullname)
+        except ua.UaError as e:
+            statuses[i] = f'bad node id: {e}'
+            continue
+        to_write.append((i, node, data_values[value_type]))
+
+    async def write_chunk(chunk):
+        results = await _limited(limit, client.write_values([node for _, node, _ in chunk],
+                                                            [data_value for _, _, data_value in chunk],
+                                                            raise_on_partial_error=False))
+        for (i, node, data_value), status in zip(chunk, results):
+            statuses[i] = status.name
+            if status.is_good():
+                # keep the tree in sync, it updates the value indexes
+                opts_lists[i][-1].value = data_value.Value.Value
+
+    if to_write:
+        chunk_size = await _server_chunk_size(client, ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerWrite,
+                                              chunk_size)
+        await asyncio.gather(*(write_chunk(to_write[start:start+chunk_size])
+                               for start in range(0, len(to_write), chunk_size)))
+
+    if logger is not None:
+        logger.debug(f'write_opc: wrote {enter_value} to {len(to_write)} of {len(opts_lists)} nodes')
+    return statuses
+
+# the server refused the request, the session is gone: connect again and resend it
+_SESSION_LOST = (ua.uaerrors.BadSessionIdInvalid, ua.uaerrors.BadSessionClosed, ua.uaerrors.BadConnectionClosed)
+# the connection is gone, the request may have been done or not:
+# connect again, but resend only the requests that can run twice
+_CONNECTION_LOST = (ConnectionError, concurrent.futures.TimeoutError)
+
+# the longest a synchronous call waits on the I/O thread, in seconds
+CALL_TIMEOUT = 10
+
+class OpcClientThread:
+    '''OpcClientThread(client=None, timeout=CALL_TIMEOUT)
+
+    The I/O thread of the OPC UA client: one asyncio event loop, running
+    for the whole program, owns the client and keeps its session open.
+    The synchronous curses programs submit the requests to it,
+    and get `concurrent.futures.Future`-s of their results.
+
+    A request is a coroutine function `request(client, *args, **kwargs)`.
+    The client is connected at the first request, and again
+    if the session was lost in the meantime. A request is sent again
+    on the new session, unless it is submitted with `retry=False`,
+    like the writes: then it fails when the connection is lost
+    in the middle of it, it may have been done already.
+
+    timeout -- the default timeout of `call`, in seconds, None to wait
+    '''
+
+    def __init__(self, client=None, timeout=CALL_TIMEOUT):
+        self.client = client
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self._connected = False
+        self._connecting = None # the lock is made in the loop
+        self._thread = threading.Thread(target=self._run, name='opc client', daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f'OpcClientThread({self.client}, connected={self._connected})'
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        '''run(self, coro)
+
+        Run a coroutine in the loop, with no client, and wait for its result.
+        '''
+        exited, result = asyncio.run_coroutine_threadsafe(self._exit_here(coro), self.loop).result()
+        if exited:
+            raise result
+        return result
+
+    async def _exit_here(self, coro):
+        # sys.exit in the coroutine exits in the calling thread,
+        # the loop thread runs on
+        try:
+            return False, await coro
+        except SystemExit as e:
+            return True, e
+
+    def submit(self, request, *args, retry=True, **kwargs):
+        '''submit(self, request, *args, retry=True, **kwargs)
+
+        Schedule `request(client, *args, **kwargs)` with the connected client.
+        Returns the `concurrent.futures.Future` of its result.
+        '''
+        return asyncio.run_coroutine_threadsafe(self._request(request, args, kwargs, retry), self.loop)
+
+    def call(self, request, *args, timeout=None, **kwargs):
+        '''call(self, request, *args, timeout=None, **kwargs)
+
+        Like `submit`, but wait for the result.
+        '''
+        return self.submit(request, *args, **kwargs).result(timeout if timeout is not None else self.timeout)
+
+    async def _request(self, request, args, kwargs, retry=True):
+        await self._connect()
+        try:
+            return await request(self.client, *args, **kwargs)
+
+        except _SESSION_LOST:
+            # the session may have expired, or the server restarted
+            await self._disconnect()
+
+        except _CONNECTION_LOST:
+            # the next requests get a new connection
+            await self._disconnect()
+            if not retry:
+                raise
+
+        await self._connect()
+        return await request(self.client, *args, **kwargs)
+
+    async def _connect(self):
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+
+        # the concurrent requests wait for one connection
+        async with self._connecting:
+            if not self._connected:
+                await self.client.connect()
+                self._connected = True
+
+    async def _disconnect(self):
+        if not self._connected:
+            return
+
+        self._connected = False
+        try:
+            await self.client.disconnect()
+        except (OSError, concurrent.futures.TimeoutError, ua.UaError):
+            pass # it is closed already
+
+    def close(self, timeout=5):
+        '''close(self, timeout=5)
+
+        Disconnect the client, and stop the loop.
+        '''
+        try:
+            asyncio.run_coroutine_threadsafe(self._disconnect(), self.loop).result(timeout)
+        except concurrent.futures.TimeoutError:
+            pass # the thread is a daemon, it does not hold the exit
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+async def _write_opc_limited(client, opts_lists, enter_str, logger, chunk_size, concurrency, node_ids):
+    # the semaphore is made in the loop that uses it
+    return await write_opc(client, opts_lists, enter_str, logger, chunk_size, asyncio.Semaphore(concurrency), node_ids)
 
 class OpcWriteOptions:
-    def __init__(self, opc_client, next_prog=None):
-        self.opc_client = opc_client
+    '''OpcWriteOptions(opc_io, next_prog=None, chunk_size=WRITE_CHUNK_SIZE, concurrency=BROWSE_CONCURRENCY, wait=True, node_ids=None)
+
+    Writes the entered value to the selected options with `write_opc`,
+    in the `OpcClientThread` `opc_io`, in its open session,
+    and returns the status names of the writes, for the monitor to show.
+    With `wait=False`, it returns a `concurrent.futures.Future` of them
+    right away, and the writes go on while the user types.
+    The `node_ids` of the options are passed to `write_opc`.
+    '''
+
+    def __init__(self, opc_io, next_prog=None, chunk_size=WRITE_CHUNK_SIZE, concurrency=BROWSE_CONCURRENCY, wait=True,
+                 node_ids=None):
+        self.opc_io = opc_io
         self.next_prog = next_prog
-        
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.wait = wait
+        self.node_ids = node_ids
+
     def __call__(self, cscreen, opts_lists=[], enter_str='', logger=None):
         logger.debug('OpcWriteOptions')
-        asyncio.run(write_opc(self.opc_client, opts_lists, enter_str, logger))
+        # a write that timed out may be done on the server, it is not sent twice
+        request = self.opc_io.submit(_write_opc_limited, opts_lists, enter_str, logger, self.chunk_size, self.concurrency,
+                                     self.node_ids, retry=False)
+        if self.wait:
+            return self._statuses(request, opts_lists, enter_str, logger, self.opc_io.timeout)
+
+        statuses = concurrent.futures.Future()
+
+        def written(request):
+            try:
+                statuses.set_result(self._statuses(request, opts_lists, enter_str, logger))
+            except Exception as e:
+                statuses.set_exception(e)
+
+        request.add_done_callback(written)
+        return statuses
+
+    def _statuses(self, request, opts_lists, enter_str, logger, timeout=None):
+        try:
+            return request.result(timeout)
+
+        except (OSError, concurrent.futures.TimeoutError, ua.UaError) as e:
+            logger.error(f'OpcWriteOptions: failed to write {enter_str}: {e!r}')
+            return [f'failed: {e}'] * len(opts_lists)
+
+# the subscription of the live values in the monitor
+PUBLISHING_INTERVAL = 500 # ms
+MONITOR_QUEUE_SIZE = 1 # only the latest value
+
+class OpcLiveValues:
+    '''OpcLiveValues(opc_io, publishing_interval=PUBLISHING_INTERVAL, queue_size=MONITOR_QUEUE_SIZE, node_ids=None)
+
+    The live values of the options in `StdMonitor`: an OPC UA subscription
+    with a monitored item per selected leaf, the data change notifications
+    set the values of the option nodes and the `changed` event.
+    The monitor redraws once per frame when it is set, not per notification.
+    The subscription is made in the session of the `OpcClientThread` `opc_io`,
+    from `start` till `stop`.
+    The node ids are looked up in `node_ids`, like in `write_opc`.
+    '''
+
+    def __init__(self, opc_io, publishing_interval=PUBLISHING_INTERVAL, queue_size=MONITOR_QUEUE_SIZE, node_ids=None):
+        self.opc_io = opc_io
+        self.node_ids = node_ids
+        self.publishing_interval = publishing_interval
+        self.queue_size = queue_size
+        self.changed = threading.Event()
+        self.error = None
+        self._opts = {} # node id string -> option nodes
+        self._nodes = {} # NodeId -> option nodes
+        self._subscribed = None # the future of the subscription
+
+    def __repr__(self):
+        return f'OpcLiveValues({len(self._opts)} nodes, every {self.publishing_interval}ms)'
+
+    @property
+    def status(self):
+        if self.error is not None:
+            return f'live values failed: {self.error}'
+        return f'live values of {len(self._opts)} nodes, published every {self.publishing_interval}ms'
+
+    def start(self, opts_lists):
+        '''start(self, opts_lists)
+
+        Subscribe to the values of the leaves among the option paths.
+        It does not wait for the subscription.
+        '''
+        self.stop()
+        self.error = None
+        self._opts = {}
+        for opt_list in opts_lists:
+            node_id = _opt_node_id(opt_list, self.node_ids)
+            if node_id is not None and not opt_list[-1].children:
+                self._opts.setdefault(node_id, []).append(opt_list[-1])
+
+        if not self._opts:
+            return
+
+        self._subscribed = self.opc_io.submit(self._subscribe)
+        self._subscribed.add_done_callback(self._subscribe_done)
+
+    def _subscribe_done(self, subscribed):
+        if not subscribed.cancelled() and subscribed.exception() is not None:
+            self.error = subscribed.exception()
+            self.changed.set()
+
+    def stop(self):
+        '''stop(self)
+
+        Delete the subscription. It does not wait for that either,
+        the subscription is deleted in the loop once it is made.
+        '''
+        if self._subscribed is None:
+            return
+
+        subscribed, self._subscribed = self._subscribed, None
+        self.opc_io.submit(self._unsubscribe, subscribed, retry=False)
+
+    async def _subscribe(self, client):
+        nodes = [client.get_node(node_id) for node_id in self._opts]
+        self._nodes = {node.nodeid: opts for node, opts in zip(nodes, self._opts.values())}
+
+        subscription = await client.create_subscription(self.publishing_interval, self)
+        await subscription.subscribe_data_change(nodes, queuesize=self.queue_size)
+        return subscription
+
+    async def _unsubscribe(self, client, subscribed):
+        try:
+            subscription = await asyncio.wrap_future(subscribed)
+            await subscription.delete()
+
+        except (OSError, concurrent.futures.TimeoutError, concurrent.futures.CancelledError, ua.UaError):
+            pass # the subscription failed, or the session is gone with it
+
+    def datachange_notification(self, node, val, data):
+        # the asyncua subscription handler, it runs in the loop of the client
+        for opt in self._nodes.get(node.nodeid, ()):
+            # the first notification is usually the same value
+            if val != opt.value or type(val) is not type(opt.value):
+                opt.value = val
+        self.changed.set()
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description="Browse OPC-UA server and print all the DPs")
 
-    dps, client = asyncio.run(_uals(parser))
+    snapshot, client = asyncio.run(_uals(parser))
+    dps = snapshot.root
     #dps = await _uals()
 
     opts_lists = dps.opt_list()
@@ -0,0 +1,179 @@
+import pytest
+from xml.etree import ElementTree
+
+import curses_menu as cm
+
+# the names, the values and the types that the selectors look at
+TREE = {
+    'dev0': {'ch0': {'dp_0_enable': 'PPB0A', 'dp1': 0, 'dp2': 1.5},
+             'ch1': {'dp_0_enable': 'PPB1A', 'dp1': 1, 'dp2': None}},
+    'dev1': {'ch0': {'dp_0_enable': True, 'dp1': 2, 'bar': {'baz': 'work'}},
+             'Foo': {'bar': {'baz': 88}, 'qwe': 5}},
+    'ünï': {'cödé': 'ñé'},
+}
+
+QUERIES = [
+    ['dev'], ['ch1'], ['dp1$'], ['dev1', 'bar'], ['>ch0', '>dp1'], ['dev', '>Foo', 'baz'],
+    ['=PPB1A'], ['=1'], ['=None'], ['.int'], ['.str'], ['.float'], ['ch', '.int', '=2'],
+    ['enable', '=True'], ['/d[p]?1$/'], ['=/PPB[01]A/'], ['ü', '=ñé'], ['nothing'], ['a', 'b', 'c'],
+]
+
+def expected_matches(table, query):
+    # the reference: the recursive matching of each path
+    return [path_id for path_id, path in enumerate(table.paths()) if cm.match_opts_list([], query, path)]
+
+@pytest.fixture(scope='module')
+def table():
+    return cm.OptPathTable(cm.opt_tree(TREE))
+
+def test_table_paths_like_opt_list(table):
+    paths = [path for root in table.roots for path in root.opt_list()]
+    assert [list(map(id, path)) for path in table.paths()] == [list(map(id, path)) for path in paths]
+
+@pytest.mark.parametrize('query', QUERIES, ids=' '.join)
+def test_match_table(table, query):
+    assert cm.match_opts_table(table, query) == expected_matches(table, query)
+
+@pytest.mark.parametrize('query', QUERIES, ids=' '.join)
+def test_match_name_index(table, query):
+    index = cm.OptNameIndex(table, cm.OptValueIndex(table))
+    try:
+        assert cm.match_opts_table(table, query, index=index) == expected_matches(table, query)
+    finally:
+        index.value_index.close()
+
+def test_match_stack(table):
+    stack = cm.MatchStack(table)
+    try:
+        for query in QUERIES:
+            # extended one selector at a time, then shortened back
+            for n in list(range(1, len(query)+1)) + list(range(len(query)-1, 0, -1)):
+                assert list(stack.match(query[:n])) == expected_matches(table, query[:n]), query[:n]
+    finally:
+        stack.close()
+
+def test_match_stack_follows_values():
+    table = cm.OptPathTable(cm.opt_tree(TREE))
+    stack = cm.MatchStack(table)
+    try:
+        assert list(stack.match(['=changed'])) == []
+        table.nodes[-1].value = 'changed'
+        assert list(stack.match(['=changed'])) == [len(table) - 1]
+    finally:
+        stack.close()
+
+def test_parallel_matcher(table):
+    engine = cm.ParallelMatcher(threshold=0, n_workers=2)
+    try:
+        for query in QUERIES:
+            assert list(engine.iter_match(table, query)) == expected_matches(table, query), query
+    finally:
+        engine.close()
+
+def test_mapped_tree_round_trip(table, tmp_path):
+    path = tmp_path / 'tree.optree'
+    cm.write_opt_tree(table.roots, path)
+    tree = cm.MappedOptTree(path)
+
+    mapped = cm.OptPathTable.from_mapped(tree)
+    assert len(mapped) == len(table)
+    assert [[(node.name, node.value, type(node.value)) for node in path] for path in mapped.paths()] == \
+           [[(node.name, node.value, type(node.value)) for node in path] for path in table.paths()]
+
+    for query in QUERIES:
+        assert cm.match_opts_table(mapped, query) == expected_matches(table, query), query
+
+    # the indexes are read from the file columns
+    stack = cm.MatchStack(mapped)
+    try:
+        for query in QUERIES:
+            assert list(stack.match(query)) == expected_matches(table, query), query
+    finally:
+        stack.close()
+
+def test_mapped_tree_keeps_other_values_as_text(tmp_path):
+    path = tmp_path / 'tree.optree'
+    cm.write_opt_tree({'a': {'b': [1, 2]}}, path)
+    (leaf,) = [path[-1] for path in cm.OptPathTable.from_mapped(cm.MappedOptTree(path)).paths() if path[-1].name == 'b']
+    assert leaf.value == '[1, 2]' and isinstance(leaf.value, cm._ValueText)
+
+def test_mapped_tree_read_only(tmp_path):
+    path = tmp_path / 'tree.optree'
+    cm.write_opt_tree(TREE, path)
+    tree = cm.MappedOptTree(path)
+    with pytest.raises(TypeError):
+        tree.add('new')
+
+    # the values set in memory are matched, the file is not changed
+    mapped = cm.OptPathTable.from_mapped(tree)
+    last = len(mapped) - 1
+    stored = mapped.nodes[last].value
+    mapped.nodes[last].value = 'changed'
+    assert cm.match_opts_table(mapped, ['=changed']) == [last]
+    assert cm.MappedOptTree(path).node(last).value == stored
+
+def test_mapped_tree_rejects_other_files(tmp_path):
+    path = tmp_path / 'tree.optree'
+    path.write_bytes(b'not an option tree' * 4)
+    with pytest.raises(ValueError):
+        cm.MappedOptTree(path)
+
+DESIGN_XML = '''<?xml version="1.0"?>
+<d:design xmlns:d="http://cern.ch/quasar/Design">
+  <d:class name="Channel">
+    <d:cachevariable name="voltage" dataType="OpcUa_Double"/>
+    <d:configentry name="id" value="7" type="int"/>
+  </d:class>
+  <d:root>
+    <d:hasobjects class="Channel" instantiateUsing="configuration"/>
+    <d:comment>  the channels  </d:comment>
+  </d:root>
+</d:design>
+'''
+
+def xml_paths(tree):
+    return [('.'.join(node.name for node in path), path[-1].value) for path in cm.OptPathTable(tree).paths()]
+
+def test_xml_tree(tmp_path):
+    path = tmp_path / 'Design.xml'
+    path.write_text(DESIGN_XML)
+    paths = xml_paths(cm.XmlOptTree(str(path)).load())
+    assert ('design.Channel.voltage.dataType', 'OpcUa_Double') in paths
+    assert ('design.Channel.id', 7) in paths
+    assert ('design.root.comment', 'the channels') in paths
+    assert ('design.root.hasobjects.instantiateUsing', 'configuration') in paths
+
+    # the same tree when it is parsed in the background
+    started = cm.XmlOptTree(str(path))
+    started.start().join()
+    assert (started.state, started.error) == (None, None)
+    assert xml_paths(started) == paths
+
+    assert not any(name.endswith('.dataType') for name, _ in xml_paths(cm.XmlOptTree(str(path), attributes=False).load()))
+
+def test_xml_tree_truncated(tmp_path):
+    path = tmp_path / 'Design.xml'
+    path.write_text(DESIGN_XML[:DESIGN_XML.index('<d:root>')])
+
+    with pytest.raises(ElementTree.ParseError):
+        cm.XmlOptTree(str(path)).load()
+
+    # the menu starts on the root, the error shows in the status
+    tree = cm.XmlOptTree(str(path))
+    tree.start().join()
+    assert tree.state is None
+    assert isinstance(tree.error, ElementTree.ParseError)
+    assert tree.status.startswith('parse failed')
+    assert [node.name for node in tree] == ['design']
+
+@pytest.mark.parametrize('content', [None, '', 'no xml', '<a><b>'[:2]])
+def test_xml_tree_no_root(tmp_path, content):
+    path = tmp_path / 'Design.xml'
+    if content is not None:
+        path.write_text(content)
+
+    tree = cm.XmlOptTree(str(path))
+    assert tree.start() is None
+    assert isinstance(tree.error, (ElementTree.ParseError, OSError))
+    assert tree.state is None
+    assert list(tree) == []
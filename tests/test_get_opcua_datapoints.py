@@ -0,0 +1,95 @@
+import json
+import os
+import pickle
+
+import pytest
+
+pytest.importorskip('asyncua')
+
+import get_opcua_datapoints as gop
+from curses_menu import _ValueText
+
+URL, ROOT = 'opc.tcp://localhost:4841/', 'ns=2;s=pp2'
+OPTIONS = ('', 0, 0, 33)
+
+def snapshot_of(snapshot_dir):
+    # a browsed tree, with a value of each kind
+    snapshot = gop.BrowseSnapshot(URL, ROOT, OPTIONS, snapshot_dir)
+    store = snapshot.store
+    for name, value, parent in [('dev0', None, 0), ('ch0', None, 1), ('dp0', 5, 2), ('dp1', 'PPB0A', 2),
+                                ('dp2', 1.5, 2), ('dp3', True, 2), ('dp4', [1, 2], 2)]:
+        node = store.node(store.add(name, value, parent))
+        snapshot.node_ids[node] = f'{snapshot.node_ids[store.node(parent)]}.{name}'
+    return snapshot
+
+def tree_of(snapshot):
+    return [[(node.name, node.value, snapshot.node_ids[node]) for node in path] for path in snapshot.root.opt_list()]
+
+def test_snapshot_round_trip(tmp_path):
+    snapshot = snapshot_of(tmp_path)
+    assert snapshot.save()
+
+    loaded = gop.BrowseSnapshot.load(URL, ROOT, OPTIONS, tmp_path)
+    assert loaded is not None
+    # the other values come back as their text
+    assert tree_of(loaded) == [[(name, '[1, 2]' if value == [1, 2] else value, node_id) for name, value, node_id in path]
+                               for path in tree_of(snapshot)]
+    assert [type(node.value) for node in loaded.store.node(2).children] == [int, str, float, bool, _ValueText]
+
+def test_snapshot_of_other_browse(tmp_path):
+    assert snapshot_of(tmp_path).save()
+    assert gop.BrowseSnapshot.load(URL, ROOT, OPTIONS[:-1] + (34,), tmp_path) is None
+    assert gop.BrowseSnapshot.load(URL, 'ns=2;s=other', OPTIONS, tmp_path) is None
+
+class _Payload:
+    def __reduce__(self):
+        return (os.remove, (self.path,))
+
+def test_snapshot_rejects_pickle(tmp_path):
+    snapshot = snapshot_of(tmp_path)
+    # the code in a pickle is not run on load
+    canary = tmp_path / 'canary'
+    canary.write_text('')
+    payload = _Payload()
+    payload.path = str(canary)
+    with open(snapshot.path, 'wb') as snapshot_file:
+        pickle.dump(payload, snapshot_file)
+
+    assert gop.BrowseSnapshot.load(URL, ROOT, OPTIONS, tmp_path) is None
+    assert canary.exists()
+
+def broken(saved, key, fix):
+    saved[key] = fix(saved[key])
+    return saved
+
+@pytest.mark.parametrize('breaking', [
+    lambda saved: broken(saved, 'key', lambda key: key[::-1]),
+    lambda saved: broken(saved, 'format', lambda fmt: fmt + 1),
+    lambda saved: broken(saved, 'parents', lambda parents: parents[:3] + [100] + parents[4:]),
+    lambda saved: broken(saved, 'parents', lambda parents: parents[:3] + [1.5] + parents[4:]),
+    lambda saved: broken(saved, 'node_ids', lambda node_ids: node_ids[:-1]),
+    lambda saved: broken(saved, 'node_ids', lambda node_ids: node_ids[:-1] + [5]),
+    lambda saved: broken(saved, 'tags', lambda tags: ['X'] + tags[1:]),
+    lambda saved: broken(saved, 'values', lambda values: values[:-1] + [{'a': 1}]),
+    lambda saved: broken(saved, 'names', lambda names: []),
+    lambda saved: {key: value for key, value in saved.items() if key != 'values'},
+    lambda saved: [saved],
+])
+def test_snapshot_rejects_broken(tmp_path, breaking):
+    snapshot = snapshot_of(tmp_path)
+    assert snapshot.save()
+    with open(snapshot.path) as snapshot_file:
+        saved = json.load(snapshot_file)
+    with open(snapshot.path, 'w') as snapshot_file:
+        json.dump(breaking(saved), snapshot_file)
+
+    assert gop.BrowseSnapshot.load(URL, ROOT, OPTIONS, tmp_path) is None
+
+@pytest.mark.parametrize('content', [b'', b'{"format": 2', b'\xff\xfe', b'null'])
+def test_snapshot_rejects_garbage(tmp_path, content):
+    snapshot = snapshot_of(tmp_path)
+    os.makedirs(tmp_path, exist_ok=True)
+    with open(snapshot.path, 'wb') as snapshot_file:
+        snapshot_file.write(content)
+
+    assert gop.BrowseSnapshot.load(URL, ROOT, OPTIONS, tmp_path) is None